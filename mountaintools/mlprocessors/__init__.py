@@ -8,6 +8,7 @@ from .temporarydirectory import TemporaryDirectory
 from .jobqueue import JobQueue
 from .paralleljobhandler import ParallelJobHandler
 from .slurmjobhandler import SlurmJobHandler
+from .runtimestats import RuntimeStats, runtime_stats, compute_job_input_size
 
 PLACEHOLDER = '<placeholder>'
 
@@ -29,6 +29,13 @@ class JobHandler():
     def cleanup(self) -> None:
         pass
 
+    def waitForEvents(self, timeout: float) -> None:
+        """Block until a job may have finished (or something else needs
+        attention in iterate()), or until timeout seconds have passed.
+        Handlers that can be notified (e.g., by pipes) should override this;
+        by default it just sleeps."""
+        time.sleep(timeout)
+
     def wait(self, timeout: float=-1):
         timer = time.time()
         while not self.isFinished():
@@ -37,5 +44,5 @@ class JobHandler():
             if (timeout >= 0) and (elapsed > timeout):
                 return False
             if not self.isFinished():
-                time.sleep(0.2)
+                self.waitForEvents(timeout=0.2)
         return True
@@ -1,17 +1,31 @@
+import os
 import time
+import heapq
 import mlprocessors as mlpr
 import traceback
-import multiprocessing
-from .mountainjob import MountainJob
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from .mountainjob import MountainJob, local_client
 from .mountainjobresult import MountainJobResult
 from mountainclient import client as mt
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 from .jobhandler import JobHandler
 from .defaultjobhandler import DefaultJobHandler
 
 
 class JobQueue():
-    def __init__(self, job_handler: JobHandler=DefaultJobHandler()):
+    def __init__(self, job_handler: JobHandler=DefaultJobHandler(), num_cache_check_workers: Optional[int]=None):
+        """A queue of jobs that are run (by the job handler) as their inputs
+        become available.
+
+        Parameters
+        ----------
+        job_handler : JobHandler, optional
+            The job handler (e.g., parallel, slurm), by default DefaultJobHandler()
+        num_cache_check_workers : Optional[int], optional
+            The number of threads that load the results of jobs found in the
+            local cache, by default from the MLPROCESSORS_CACHE_CHECK_WORKERS
+            environment variable, or 10
+        """
         super().__init__()
 
         self._all_jobs: dict = dict()
@@ -24,6 +38,18 @@ class JobQueue():
         self._job_handler: JobHandler = job_handler  # The job handler (e.g., parallel, slurm, default)
         # self._job_manager = None
 
+        # The dependency graph: for each queued job, the number of inputs that
+        # are outputs of unfinished jobs, and for each job, the (job id, input)
+        # pairs that are waiting on its outputs. When a job finishes its
+        # dependents are released, so the queued jobs are never rescanned.
+        self._num_pending_inputs: Dict[int, int] = dict()
+        self._dependents: Dict[int, List[Tuple[int, dict]]] = dict()
+        self._ready_job_ids: List[int] = []  # heap, so jobs are started in the order they were queued
+        self._output_hashes: Dict[Tuple[int, str], Optional[str]] = dict()
+        self._timestamps: Dict[int, Dict[str, float]] = dict()  # queued, ready, started, finished
+        self._iterate_elapsed: float = 0
+        self._cache_checker = _CacheChecker(num_workers=num_cache_check_workers)
+
     def queueJob(self, job: MountainJob) -> MountainJobResult:
         """Queue a job. This happens automatically by the framework when .execute() is called on a processor
         
@@ -55,6 +81,21 @@ class JobQueue():
         )
         result0 = MountainJobResult(result_object=obj0, job_queue=self)
         setattr(job, 'result', result0)
+
+        self._timestamps[job_id] = dict(queued=time.time())
+        self._num_pending_inputs[job_id] = 0
+        for input0 in _pending_inputs(job):
+            qj_id = input0['object']['queue_job_id']
+            if qj_id in self._finished_jobs:
+                if not self._resolve_input(input0):
+                    self._set_failed_input(job_id)
+                    self._set_finished(job_id)
+                    return result0
+            else:
+                self._num_pending_inputs[job_id] = self._num_pending_inputs[job_id] + 1
+                self._dependents.setdefault(qj_id, []).append((job_id, input0))
+        if self._num_pending_inputs[job_id] == 0:
+            self._set_ready(job_id)
         return result0
 
     def iterate(self) -> None:
@@ -66,18 +107,16 @@ class JobQueue():
         """
         if self._halted:
             return
+        timer = time.time()
 
         if self._job_handler:
             self._job_handler.iterate()
         self._check_for_finished_jobs()
 
-        queued_job_ids = sorted(list(self._queued_jobs.keys()))
         job_ids_to_run = []
-        for id in queued_job_ids:
-            job = self._queued_jobs[id]
-            if self._job_is_ready_to_run(job):
-                job_ids_to_run.append(id)
-        
+        while self._ready_job_ids:
+            job_ids_to_run.append(heapq.heappop(self._ready_job_ids))
+
         newly_running_jobs = []
         for id in job_ids_to_run:
             if self._halted:
@@ -86,26 +125,31 @@ class JobQueue():
             del self._queued_jobs[id]
             self._running_jobs[id] = job
             job.result._status = 'running'
+            self._timestamps[id]['started'] = time.time()
 
             newly_running_jobs.append(job)
 
         if len(newly_running_jobs) > 0:
             print('Checking cache for {} jobs...'.format(len(newly_running_jobs)))
-            newly_running_job_results_from_cache = _check_cache_for_job_results(newly_running_jobs)
-            for ii, job in enumerate(newly_running_jobs):
-                newly_running_job_result = newly_running_job_results_from_cache[ii]
-                if newly_running_job_result is not None:
-                    jobj = job.getObject()
-                    print('Using result from cache: {}'.format(jobj.get('label', jobj.get('processor_name', '<>'))))
-                    job.result.fromObject(newly_running_job_result.getObject())
-                    job.result._status = 'finished'
-                else:
-                    self._job_handler.executeJob(job)
+            # the jobs that are certainly not in the cache are dispatched right away
+            for job in self._cache_checker.submit(newly_running_jobs):
+                self._job_handler.executeJob(job)
+
+        # handle the cache checks that have completed so far
+        for job, result_from_cache in self._cache_checker.collectResults():
+            if result_from_cache is not None:
+                jobj = job.getObject(copy=False)
+                print('Using result from cache: {}'.format(jobj.get('label', jobj.get('processor_name', '<>'))))
+                job.result.fromObject(result_from_cache.getObject())
+                job.result._status = 'finished'
+            else:
+                self._job_handler.executeJob(job)
 
         if self._job_handler:
             self._job_handler.iterate()
         self._check_for_finished_jobs()
-    
+        self._iterate_elapsed = self._iterate_elapsed + (time.time() - timer)
+
     def wait(self, timeout: float=-1) -> bool:
         """Wait until all queued jobs have completed or until timeout.
         
@@ -126,47 +170,108 @@ class JobQueue():
             if (timeout >= 0) and (elapsed > timeout):
                 return False
             if not self.isFinished():
-                time.sleep(0.2)
+                self._wait_for_events(timeout=0.2)
         return True
 
+    def metrics(self) -> dict:
+        """Queue depth and latency metrics.
+
+        Returns
+        -------
+        dict
+            num_waiting (queued jobs waiting for the outputs of other jobs),
+            num_ready, num_running, num_finished, ready_latency (seconds from
+            the inputs being available to the job being started), run_time
+            (seconds from started to finished) -- each as dict(mean, max) over
+            the finished jobs -- and iterate_time (total seconds spent in
+            iterate(), including the job handler)
+        """
+        ready_latencies = []
+        run_times = []
+        for id in self._finished_jobs.keys():
+            ts = self._timestamps[id]
+            if ('started' in ts) and ('finished' in ts):
+                ready_latencies.append(ts['started'] - ts['ready'])
+                run_times.append(ts['finished'] - ts['started'])
+        return dict(
+            num_waiting=len(self._queued_jobs) - len(self._ready_job_ids),
+            num_ready=len(self._ready_job_ids),
+            num_running=len(self._running_jobs),
+            num_finished=len(self._finished_jobs),
+            ready_latency=_mean_max(ready_latencies),
+            run_time=_mean_max(run_times),
+            iterate_time=self._iterate_elapsed
+        )
+
+    def _wait_for_events(self, timeout: float) -> None:
+        # Jobs that were released by the last iteration can start right away.
+        # Otherwise wait until the job handler has something to report.
+        if self._ready_job_ids or self._halted:
+            return
+        if self._cache_checker.numPending() > 0:
+            # the cache checks are usually quick
+            self._cache_checker.waitForResults(timeout=timeout / 4)
+            return
+        if self._job_handler:
+            self._job_handler.waitForEvents(timeout=timeout)
+        else:
+            time.sleep(timeout)
+
     def _check_for_finished_jobs(self) -> None:
-        for jobs0 in [self._running_jobs, self._queued_jobs]:
-            finished_job_ids = []
-            for id, job in jobs0.items():
-                if job.result.status() == 'finished':
-                    finished_job_ids.append(id)
-            for id in finished_job_ids:
-                job = jobs0[id]
-                del jobs0[id]
-                self._finished_jobs[id] = job
-
-    def _job_is_ready_to_run(self, job: MountainJob) -> bool:
-        obj0 = job.getObject(copy=False)
-        inputs0 = obj0['inputs']
-        all_inputs: List[dict] = []
-        for _, input0 in inputs0.items():
-            if type(input0) == list:
-                all_inputs.extend(input0)
-            else:
-                all_inputs.append(input0)
-        for input0 in all_inputs:
-            if input0.get('pending', False):
-                qj_id = input0['object']['queue_job_id']
-                output_name = input0['object']['output_name']
-                qj = self._all_jobs[qj_id]
-                if qj.result.status() == 'finished':
-                    if qj.result.retcode == 0:
-                        input0['path'] = qj.result.outputs[output_name]
-                        input0['hash'] = mt.computeFileSha1(input0['path'])
-                    else:
-                        # in this case the input is not available because the dependent job failed
-                        job.result.retcode = 7  # for now this signifies that it failed in this way
-                        job.result._status = 'finished'
-                        return False
+        finished_job_ids = []
+        for id, job in self._running_jobs.items():
+            if job.result.status() == 'finished':
+                finished_job_ids.append(id)
+        for id in finished_job_ids:
+            del self._running_jobs[id]
+            self._set_finished(id)
+
+    def _set_ready(self, job_id: int) -> None:
+        self._timestamps[job_id]['ready'] = time.time()
+        heapq.heappush(self._ready_job_ids, job_id)
+
+    def _set_finished(self, job_id: int) -> None:
+        # Release the jobs that depend on this one. If it failed, they fail
+        # too (and so on down the graph).
+        finished_job_ids = [job_id]
+        while finished_job_ids:
+            id = finished_job_ids.pop()
+            self._finished_jobs[id] = self._all_jobs[id]
+            self._timestamps[id]['finished'] = time.time()
+            for dependent_job_id, input0 in self._dependents.pop(id, []):
+                if dependent_job_id not in self._queued_jobs:
+                    # already failed because of another input
+                    continue
+                if self._resolve_input(input0):
+                    self._num_pending_inputs[dependent_job_id] = self._num_pending_inputs[dependent_job_id] - 1
+                    if self._num_pending_inputs[dependent_job_id] == 0:
+                        self._set_ready(dependent_job_id)
                 else:
-                    return False
+                    self._set_failed_input(dependent_job_id)
+                    finished_job_ids.append(dependent_job_id)
+
+    def _set_failed_input(self, job_id: int) -> None:
+        # the job cannot run because a job that it depends on failed
+        job = self._all_jobs[job_id]
+        job.result.retcode = 7  # for now this signifies that it failed in this way
+        job.result._status = 'finished'
+        del self._queued_jobs[job_id]
+
+    def _resolve_input(self, input0: dict) -> bool:
+        # Set the path and hash of an input that is the output of a finished
+        # job. Returns False if that job failed.
+        qj_id = input0['object']['queue_job_id']
+        output_name = input0['object']['output_name']
+        qj = self._all_jobs[qj_id]
+        if qj.result.retcode != 0:
+            return False
+        key = (qj_id, output_name)
+        if key not in self._output_hashes:
+            self._output_hashes[key] = mt.computeFileSha1(qj.result.outputs[output_name])
+        input0['path'] = qj.result.outputs[output_name]
+        input0['hash'] = self._output_hashes[key]
         return True
-    
+
     def isFinished(self) -> bool:
         """Whether all queued jobs have finished.
         
@@ -188,6 +293,7 @@ class JobQueue():
         """
         if self._job_handler:
             self._job_handler.halt()
+        self._cache_checker.shutdown()
         self._halted = True
 
     def __enter__(self):
@@ -217,24 +323,89 @@ def _setCurrentJobQueue(jqueue: Optional[JobQueue]) -> None:
     _internal.current_job_queue = jqueue
 
 
-def _check_cache_for_job_results(jobs: List[MountainJob]) -> List[Optional[MountainJobResult]]:
-    pool = multiprocessing.Pool(10)
-    result_objects = pool.map(_execute_job_check_cache, [job.getObject() for job in jobs])
-    pool.close()
-    pool.join()
-    results: List[Optional[MountainJobResult]] = []
-    for robj in result_objects:
-        if robj:
-            results.append(MountainJobResult(result_object=robj))
+def _pending_inputs(job: MountainJob) -> List[dict]:
+    obj0 = job.getObject(copy=False)
+    inputs0 = obj0['inputs']
+    all_inputs: List[dict] = []
+    for _, input0 in inputs0.items():
+        if type(input0) == list:
+            all_inputs.extend(input0)
         else:
-            results.append(None)
-    return results
+            all_inputs.append(input0)
+    return [input0 for input0 in all_inputs if input0.get('pending', False)]
+
+
+def _mean_max(values: List[float]) -> dict:
+    if not values:
+        return dict(mean=None, max=None)
+    return dict(mean=sum(values) / len(values), max=max(values))
+
+
+class _CacheChecker():
+    def __init__(self, num_workers: Optional[int]=None):
+        # Looks up the results of jobs in the local cache. The signatures of
+        # the runtime info of all the jobs are looked up in a single query of
+        # the local database, so the jobs that were never run are known right
+        # away. The others are loaded by a persistent pool of threads, and
+        # the results are collected as they complete.
+        if num_workers is None:
+            num_workers = int(os.environ.get('MLPROCESSORS_CACHE_CHECK_WORKERS', 10))
+        self._num_workers = num_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[Future, MountainJob] = dict()
+
+    def submit(self, jobs: List[MountainJob]) -> List[MountainJob]:
+        """Start checking the cache for the jobs, and return the ones that
+        are not in the cache"""
+        ignore_local_cache = (os.environ.get('MLPROCESSORS_IGNORE_LOCAL_CACHE', 'FALSE') == 'TRUE')
+        jobs_to_check = []
+        misses = []
+        for job in jobs:
+            jobj = job.getObject(copy=False)
+            if jobj['use_cache'] and (not jobj['force_run']) and (not ignore_local_cache):
+                jobs_to_check.append(job)
+            else:
+                misses.append(job)
+        if not jobs_to_check:
+            return misses
+        values = local_client.getValues(keys=[job.runtimeInfoSignature() for job in jobs_to_check], check_alt=True)
+        for job, value in zip(jobs_to_check, values):
+            if value:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._num_workers)
+                self._pending[self._executor.submit(_execute_job_check_cache, job)] = job
+            else:
+                misses.append(job)
+        return misses
+
+    def collectResults(self) -> List[Tuple[MountainJob, Optional[MountainJobResult]]]:
+        """The (job, result or None) of the checks that have completed"""
+        ret = []
+        for future in [f for f in self._pending.keys() if f.done()]:
+            job = self._pending.pop(future)
+            ret.append((job, future.result()))
+        return ret
+
+    def numPending(self) -> int:
+        return len(self._pending)
+
+    def waitForResults(self, timeout: float) -> None:
+        if self._pending:
+            wait(list(self._pending.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+
+    def shutdown(self) -> None:
+        for future in self._pending.keys():
+            future.cancel()
+        self._pending = dict()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
 
 
-def _execute_job_check_cache(job_object: dict) -> Optional[dict]:
-    job = MountainJob(job_object=job_object)
-    result = job._execute_check_cache()
-    if result:
-        return result.getObject()
-    else:
+def _execute_job_check_cache(job: MountainJob) -> Optional[MountainJobResult]:
+    try:
+        return job._execute_check_cache()
+    except:
+        traceback.print_exc()
+        print('Problem checking cache for job. Running the job.')
         return None
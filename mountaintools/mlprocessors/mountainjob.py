@@ -15,6 +15,9 @@ import numpy as np
 from .mountainjobresult import MountainJobResult
 from typing import Optional, List, Union, Any, Tuple, TYPE_CHECKING, Type
 from .consolecapture import ConsoleCapture
+from .warmworkers import WarmWorkerJob, warm_workers_enabled, paths_are_visible_in_container
+from .runtimestats import runtime_stats, runtime_stats_enabled, compute_job_input_size
+from .resourcemonitor import ResourceMonitor
 
 if TYPE_CHECKING:
     # avoid cyclic dependency
@@ -91,6 +94,10 @@ class MountainJob():
             for ii, fname in enumerate(self._job_object['additional_files_to_realize']):
                 self._job_object['additional_files_to_realize'][ii] = _make_remote_url_for_file(fname)
 
+    def setTimeout(self, timeout: Optional[float]) -> None:
+        # the timeout is not part of the signatures of the outputs
+        self._job_object['timeout'] = timeout
+
     def setUseCachedResultsOnly(self, val: bool) -> None:
         self._use_cached_results_only = val
 
@@ -187,6 +194,14 @@ class MountainJob():
         if self._use_cached_results_only:
             return MountainJobResult()
 
+        # download the input files (and the container) in parallel before they are used one by one below
+        files_to_prefetch = [
+            fname for fname in self.getFilesToRealize()
+            if fname.startswith('sha1://') and (fname != self._job_object['processor_code'])
+        ]
+        if len(files_to_prefetch) > 1:
+            mt.realizeFiles(files_to_prefetch)
+
         with TemporaryDirectory(remove=(not keep_temp_files), prefix='tmp_execute_outputdir_' + self._job_object['processor_name']) as tmp_output_path:
             attributes_for_processor: dict = dict()
             tmp_output_file_names = dict()
@@ -284,144 +299,158 @@ class MountainJob():
 
             runtime_capture = ConsoleCapture()
             runtime_capture.start_capturing()
-            print('Job: {}'.format(label))
-            print('Timestamp: {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()))
-            R = MountainJobResult()
-            if (not container) and (self._processor is not None):
-                # This means we can just run it directly
-                # The following is sort of confusing in terms of types.
-                X: 'Processor' = self._processor()  # instance
-                for attr_name, attr_val in attributes_for_processor.items():
-                    setattr(X, attr_name, attr_val)
-                try:
-                    print('Running processor directly...')
-                    mtlogging.sublog('running-directly')
-                    X.run()
-                    mtlogging.sublog(None)
-                    retcode = 0
-                except:
-                    traceback.print_exc()
-                    retcode = -1
-            else:
-                # Otherwise we need to do code generation
-                timer = time.time()
-                with TemporaryDirectory(remove=(not keep_temp_files), prefix='tmp_execute_' + self._job_object['processor_name']) as temp_path:
-                    self._generate_execute_code(temp_path, attributes_for_processor=attributes_for_processor)
-
-                    run_sh_script = ShellScript("""
-                        #!/bin/bash
-                        set -e
-
-                        {env_vars}
-
-                        python3 {temp_path}/run.py > {console_out_fname} 2>&1
-                    """, script_path=os.path.join(temp_path, 'run.sh'))
-
-                    # The following was not needed after all -- better to set the locale in the docker/singularity image
-                    # Set the following variables if not already set
-                    # For example, this is important when Click is used
-                    # in python, in a singularity container.
-                    # if [ -z "$LC_ALL" ]; then
-                    #     export LC_ALL=en_US.UTF-8
-                    # fi
-                    # if [ -z "$LANG" ]; then
-                    #     export LANG=en_US.UTF-8
-                    # fi
+            resource_monitor: Optional[ResourceMonitor] = None
+            if os.environ.get('MLPROCESSORS_RESOURCE_MONITOR', 'FALSE') == 'TRUE':
+                # when the job runs in a script, only the script's processes are measured
+                resource_monitor = ResourceMonitor(include_self=((not container) and (self._processor is not None)))
+                resource_monitor.start()
+            try:
+                print('Job: {}'.format(label))
+                print('Timestamp: {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()))
+                R = MountainJobResult()
+                if (not container) and (self._processor is not None):
+                    # This means we can just run it directly
+                    # The following is sort of confusing in terms of types.
+                    X: 'Processor' = self._processor()  # instance
+                    for attr_name, attr_val in attributes_for_processor.items():
+                        setattr(X, attr_name, attr_val)
+                    try:
+                        print('Running processor directly...')
+                        mtlogging.sublog('running-directly')
+                        X.run()
+                        mtlogging.sublog(None)
+                        retcode = 0
+                    except:
+                        traceback.print_exc()
+                        retcode = -1
+                else:
+                    # Otherwise we need to do code generation
+                    timer = time.time()
+                    with TemporaryDirectory(remove=(not keep_temp_files), prefix='tmp_execute_' + self._job_object['processor_name']) as temp_path:
+                        self._generate_execute_code(temp_path, attributes_for_processor=attributes_for_processor)
 
-                    if not container:
-                        env_vars = []
-                        env_vars.append('PYTHONPATH={}/processor_source/_local_modules'.format(temp_path))
-                        run_sh_script.substitute('{temp_path}', temp_path)
-                        run_sh_script.substitute('{console_out_fname}', tmp_process_console_out_fname)
-                        run_sh_script.substitute('{env_vars}', '\n'.join(['export ' + env_var for env_var in env_vars]))
-                        shell_script = run_sh_script
-                    else:
-                        print('Realizing container file: {}'.format(container))
-                        container_orig = container
-                        container = mt.realizeFile(container)
-                        if not container:
-                            raise Exception('Unable to realize container file: {}'.format(container_orig))
-                        singularity_opts, env_vars = _get_singularity_opts_and_env_vars()
-                        singularity_opts.append('-B {}:{}'.format(temp_path, '/run_in_container'))
-                        singularity_opts.append('-B {}:{}'.format(tmp_output_path, '/processor_outputs'))
-                        source_path = os.path.dirname(os.path.realpath(__file__))
-                        singularity_opts.append('-B {}:/python/mountaintools'.format(os.path.abspath(os.path.join(source_path, '..'))))
-                        for tobind in inputs_to_bind:
-                            singularity_opts.append('-B {}:{}'.format(tobind[0], tobind[1]))
-                        environment_variables = self._job_object.get('environment_variables', [])
-                        for v in environment_variables:
-                            val = os.environ.get(v, '')
-                            if val:
-                                env_vars.append('{}={}'.format(v, val))
-                        env_vars.append('PYTHONPATH=/python/mountaintools:/run_in_container/processor_source/_local_modules')
-
-                        run_sh_script.substitute('{temp_path}', '/run_in_container')
-                        run_sh_script.substitute('{console_out_fname}', tmp_process_console_out_fname_in_container)
-                        run_sh_script.substitute('{env_vars}', '\n'.join(['export ' + env_var for env_var in env_vars]))
-                        run_sh_script.write()
-
-                        # num_retries = 4
-                        # for try_num in range(1, num_retries + 1):
-                        singularity_sh_script = ShellScript("""
+                        run_sh_script = ShellScript("""
                             #!/bin/bash
                             set -e
 
-                            singularity exec {singularity_opts} {container} {temp_path}/run.sh
-                        """, script_path=os.path.join(temp_path, 'singularity_run.sh'))
-                        singularity_sh_script.substitute('{temp_path}', '/run_in_container')
-                        singularity_sh_script.substitute('{temp_path_host}', temp_path)
-                        singularity_sh_script.substitute('{singularity_opts}', ' '.join(singularity_opts))
-                        singularity_sh_script.substitute('{container}', container)
+                            {env_vars}
 
-                        shell_script = singularity_sh_script
+                            python3 {temp_path}/run.py > {console_out_fname} 2>&1
+                        """, script_path=os.path.join(temp_path, 'run.sh'))
 
-                    mtlogging.sublog('running-script')
-                    shell_script.start()
-                    try:
-                        while shell_script.isRunning():
-                            shell_script.wait(5)
-                            if job_timeout:
-                                if shell_script.elapsedTimeSinceStart() > job_timeout:
-                                    print('Elapsed time exceeded timeout for process: {} > {} sec'.format(shell_script.elapsedTimeSinceStart(), job_timeout))
-                                    R.timed_out = True
-                                    shell_script.stop()
-                    except:
-                        shell_script.stop()
-                    retcode = shell_script.returnCode()
-                    # if (retcode != 0) and (not os.path.exists(tmp_process_console_out_fname)):
-                    #     if try_num < num_retries:
-                    #         print('Got no console out for process - could be a singularity failure - retrying...')
-                    #         time.sleep(random.uniform(1, 2))
-                    # else:
-                    #     break
-                    mtlogging.sublog(None)
-
-                # we may want to restore the following at some point
-                if retcode != 0:
-                    print_console_out = True
-                if os.path.exists(tmp_process_console_out_fname):
-                    process_console_out = _read_text_file(tmp_process_console_out_fname) or ''
-                    if process_console_out:
-                        lines0 = process_console_out.splitlines()
-                        for line0 in lines0:
-                            console0 = '>> {}'.format(line0)
-                            if print_console_out:
-                                print(console0)
-                            else:
-                                runtime_capture.addToConsoleOut(console0 + '\n')
+                        # The following was not needed after all -- better to set the locale in the docker/singularity image
+                        # Set the following variables if not already set
+                        # For example, this is important when Click is used
+                        # in python, in a singularity container.
+                        # if [ -z "$LC_ALL" ]; then
+                        #     export LC_ALL=en_US.UTF-8
+                        # fi
+                        # if [ -z "$LANG" ]; then
+                        #     export LANG=en_US.UTF-8
+                        # fi
+
+                        if not container:
+                            env_vars = []
+                            env_vars.append('PYTHONPATH={}/processor_source/_local_modules'.format(temp_path))
+                            run_sh_script.substitute('{temp_path}', temp_path)
+                            run_sh_script.substitute('{console_out_fname}', tmp_process_console_out_fname)
+                            run_sh_script.substitute('{env_vars}', '\n'.join(['export ' + env_var for env_var in env_vars]))
+                            shell_script = run_sh_script
+                        elif warm_workers_enabled() and paths_are_visible_in_container([temp_path, tmp_output_path] + [tobind[0] for tobind in inputs_to_bind], _get_singularity_opts_and_env_vars()[0]):
+                            # run in a long-lived python process in the container
+                            # (the worker is started without the job-specific
+                            # binds, so the inputs must already be visible)
+                            shell_script = self._create_warm_worker_job(
+                                container=container,
+                                temp_path=temp_path,
+                                tmp_output_path=tmp_output_path,
+                                inputs_to_bind=inputs_to_bind,
+                                attributes_for_processor=attributes_for_processor,
+                                console_out_fname=tmp_process_console_out_fname
+                            )
+                        else:
+                            shell_script = self._create_singularity_script(
+                                container=container,
+                                temp_path=temp_path,
+                                tmp_output_path=tmp_output_path,
+                                inputs_to_bind=inputs_to_bind,
+                                run_sh_script=run_sh_script,
+                                console_out_fname=tmp_process_console_out_fname_in_container
+                            )
+
+                        mtlogging.sublog('running-script')
+                        if isinstance(shell_script, WarmWorkerJob):
+                            try:
+                                shell_script.start()
+                            except:
+                                # a problem with the worker, not with the job
+                                traceback.print_exc()
+                                print('Unable to run job in warm worker. Running it with singularity exec.')
+                                shell_script = self._create_singularity_script(
+                                    container=container,
+                                    temp_path=temp_path,
+                                    tmp_output_path=tmp_output_path,
+                                    inputs_to_bind=inputs_to_bind,
+                                    run_sh_script=run_sh_script,
+                                    console_out_fname=tmp_process_console_out_fname_in_container
+                                )
+                                shell_script.start()
+                        else:
+                            shell_script.start()
+                        if (resource_monitor is not None) and isinstance(shell_script, WarmWorkerJob):
+                            # the warm worker is not a child of this process
+                            resource_monitor.addProcess(shell_script.workerPid())
+                        try:
+                            while shell_script.isRunning():
+                                shell_script.wait(5)
+                                if job_timeout:
+                                    if shell_script.elapsedTimeSinceStart() > job_timeout:
+                                        print('Elapsed time exceeded timeout for process: {} > {} sec'.format(shell_script.elapsedTimeSinceStart(), job_timeout))
+                                        R.timed_out = True
+                                        shell_script.stop()
+                        except:
+                            shell_script.stop()
+                        retcode = shell_script.returnCode()
+                        # if (retcode != 0) and (not os.path.exists(tmp_process_console_out_fname)):
+                        #     if try_num < num_retries:
+                        #         print('Got no console out for process - could be a singularity failure - retrying...')
+                        #         time.sleep(random.uniform(1, 2))
+                        # else:
+                        #     break
+                        mtlogging.sublog(None)
+
+                    # we may want to restore the following at some point
+                    if retcode != 0:
+                        print_console_out = True
+                    if os.path.exists(tmp_process_console_out_fname):
+                        process_console_out = _read_text_file(tmp_process_console_out_fname) or ''
+                        if process_console_out:
+                            lines0 = process_console_out.splitlines()
+                            for line0 in lines0:
+                                console0 = '>> {}'.format(line0)
+                                if print_console_out:
+                                    print(console0)
+                                else:
+                                    runtime_capture.addToConsoleOut(console0 + '\n')
+                        else:
+                            print('>> No console out for process')
                     else:
-                        print('>> No console out for process')
-                else:
-                    print('WARNING: no process console out file found: ' + tmp_process_console_out_fname)
-                elapsed = time.time() - timer
-                print('========== {} exited with code {} after {} sec'.format(self._job_object['processor_name'], retcode, elapsed))
-                print('================================================================================')
+                        print('WARNING: no process console out file found: ' + tmp_process_console_out_fname)
+                    elapsed = time.time() - timer
+                    print('========== {} exited with code {} after {} sec'.format(self._job_object['processor_name'], retcode, elapsed))
+                    print('================================================================================')
+            finally:
+                # also when there is an exception, so that the sampling thread does not keep running
+                if resource_monitor is not None:
+                    resource_monitor.stop()
 
             runtime_capture.stop_capturing()
             R.retcode = retcode
             R.runtime_info = runtime_capture.runtimeInfo()
             R.runtime_info['retcode'] = retcode
             R.runtime_info['timed_out'] = R.timed_out
+            if resource_monitor is not None:
+                R.runtime_info.update(resource_monitor.resources())
             R.console_out = local_client.saveText(text=runtime_capture.consoleOut(), basename='console_out.txt')
             R.outputs = dict()
             if retcode == 0:
@@ -439,6 +468,14 @@ class MountainJob():
                 # specified (i.e., skip_failing skip_timed_out)
                 self._store_result_in_cache(R)
 
+            if runtime_stats_enabled():
+                # for predicting the durations of future jobs
+                try:
+                    runtime_stats().record(self._job_object, R.runtime_info, input_size=compute_job_input_size(self._job_object))
+                except:
+                    traceback.print_exc()
+                    print('WARNING: unable to record runtime stats for job.')
+
             if (retcode == 0):
                 R = self._post_process_result(R)
 
@@ -525,6 +562,79 @@ class MountainJob():
 
         run_py_script.write(os.path.join(temp_path, 'run.py'))
 
+    def _create_singularity_script(self, *, container: str, temp_path: str, tmp_output_path: str, inputs_to_bind: List[Tuple[str, str]], run_sh_script: ShellScript, console_out_fname: str) -> ShellScript:
+        print('Realizing container file: {}'.format(container))
+        container_orig = container
+        container = mt.realizeFile(container)
+        if not container:
+            raise Exception('Unable to realize container file: {}'.format(container_orig))
+        singularity_opts, env_vars = _get_singularity_opts_and_env_vars()
+        singularity_opts.append('-B {}:{}'.format(temp_path, '/run_in_container'))
+        singularity_opts.append('-B {}:{}'.format(tmp_output_path, '/processor_outputs'))
+        source_path = os.path.dirname(os.path.realpath(__file__))
+        singularity_opts.append('-B {}:/python/mountaintools'.format(os.path.abspath(os.path.join(source_path, '..'))))
+        for tobind in inputs_to_bind:
+            singularity_opts.append('-B {}:{}'.format(tobind[0], tobind[1]))
+        environment_variables = self._job_object.get('environment_variables', [])
+        for v in environment_variables:
+            val = os.environ.get(v, '')
+            if val:
+                env_vars.append('{}={}'.format(v, val))
+        env_vars.append('PYTHONPATH=/python/mountaintools:/run_in_container/processor_source/_local_modules')
+
+        run_sh_script.substitute('{temp_path}', '/run_in_container')
+        run_sh_script.substitute('{console_out_fname}', console_out_fname)
+        run_sh_script.substitute('{env_vars}', '\n'.join(['export ' + env_var for env_var in env_vars]))
+        run_sh_script.write()
+
+        # num_retries = 4
+        # for try_num in range(1, num_retries + 1):
+        singularity_sh_script = ShellScript("""
+            #!/bin/bash
+            set -e
+
+            singularity exec {singularity_opts} {container} {temp_path}/run.sh
+        """, script_path=os.path.join(temp_path, 'singularity_run.sh'))
+        singularity_sh_script.substitute('{temp_path}', '/run_in_container')
+        singularity_sh_script.substitute('{temp_path_host}', temp_path)
+        singularity_sh_script.substitute('{singularity_opts}', ' '.join(singularity_opts))
+        singularity_sh_script.substitute('{container}', container)
+
+        return singularity_sh_script
+
+    def _create_warm_worker_job(self, *, container: str, temp_path: str, tmp_output_path: str, inputs_to_bind: List[Tuple[str, str]], attributes_for_processor: dict, console_out_fname: str) -> WarmWorkerJob:
+        print('Realizing container file: {}'.format(container))
+        container_orig = container
+        container = mt.realizeFile(container)
+        if not container:
+            raise Exception('Unable to realize container file: {}'.format(container_orig))
+        # the job-specific directories and inputs are not bound, since the
+        # worker is shared by many jobs
+        singularity_opts, env_vars = _get_singularity_opts_and_env_vars()
+        source_path = os.path.dirname(os.path.realpath(__file__))
+        singularity_opts.append('-B {}:/python/mountaintools'.format(os.path.abspath(os.path.join(source_path, '..'))))
+        environment_variables = self._job_object.get('environment_variables', [])
+        for v in environment_variables:
+            val = os.environ.get(v, '')
+            if val:
+                env_vars.append('{}={}'.format(v, val))
+        env_vars.append('PYTHONPATH=/python/mountaintools')
+        path_map = dict()
+        path_map['/run_in_container'] = temp_path
+        path_map['/processor_outputs'] = tmp_output_path
+        for tobind in inputs_to_bind:
+            path_map[tobind[1]] = tobind[0]
+        return WarmWorkerJob(
+            container=container,
+            singularity_opts=singularity_opts,
+            env_vars=env_vars,
+            code_dir=temp_path,
+            processor_class_name=self._job_object['processor_class_name'],
+            attributes=attributes_for_processor,
+            path_map=path_map,
+            console_out_fname=console_out_fname
+        )
+
     def runtimeInfoSignature(self) -> str:
         return self.outputSignature('--runtime-info--')
 
@@ -545,7 +655,18 @@ class MountainJob():
 
         runtime_info_signature = self.runtimeInfoSignature()
         assert runtime_info_signature
-        output_paths['--runtime-info--'] = local_client.getValue(key=runtime_info_signature, check_alt=True)
+        console_out_signature = self.consoleOutSignature()
+        assert console_out_signature
+        output_signatures = dict()
+        for output_name in self._job_object['outputs'].keys():
+            signature0 = self.outputSignature(output_name)
+            assert signature0
+            output_signatures[output_name] = signature0
+
+        # look up all the signatures in a single query of the local database
+        values = local_client.getValues(keys=[runtime_info_signature, console_out_signature] + list(output_signatures.values()), check_alt=True)
+
+        output_paths['--runtime-info--'] = values[0]
         if not output_paths['--runtime-info--']:
             return None
 
@@ -556,17 +677,12 @@ class MountainJob():
 
         retcode = runtime_info.get('retcode', 0)  # for now default is 0, but that should be unnecessary later
 
-        console_out_signature = self.consoleOutSignature()
-        assert console_out_signature
-        output_paths['--console-out--'] = local_client.getValue(key=console_out_signature, check_alt=True)
+        output_paths['--console-out--'] = values[1]
         if not output_paths['--console-out--']:
             return None
 
         if retcode == 0:
-            for output_name in self._job_object['outputs'].keys():
-                signature0 = self.outputSignature(output_name)
-                assert signature0
-                output_path = local_client.getValue(key=signature0, check_alt=True)
+            for output_name, output_path in zip(output_signatures.keys(), values[2:]):
                 if not output_path:
                     return None
                 output_paths[output_name] = output_path
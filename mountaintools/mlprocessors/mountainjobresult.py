@@ -38,9 +38,18 @@ class MountainJobResult():
             if (timeout >= 0) and (elapsed > timeout):
                 return False
             if self._status != 'finished':
-                time.sleep(0.2)
+                self._job_queue._wait_for_events(timeout=0.2)
         return True
 
+    def resources(self) -> Optional[dict]:
+        """The resources used by the job (peak_rss_bytes, cpu_user_sec,
+        cpu_system_sec, read_bytes, write_bytes, and resource_timeline), if
+        they were measured (MLPROCESSORS_RESOURCE_MONITOR=TRUE)"""
+        if (self.runtime_info is None) or ('peak_rss_bytes' not in self.runtime_info):
+            return None
+        keys = ['peak_rss_bytes', 'cpu_user_sec', 'cpu_system_sec', 'read_bytes', 'write_bytes', 'resource_timeline']
+        return {key: self.runtime_info.get(key, None) for key in keys}
+
     def getObject(self) -> dict:
         return dict(
             retcode=self.retcode,
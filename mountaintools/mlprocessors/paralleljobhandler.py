@@ -1,5 +1,5 @@
 import multiprocessing
-from multiprocessing.connection import Connection
+from multiprocessing.connection import Connection, wait
 import time
 import signal
 import mlprocessors as mlpr
@@ -7,6 +7,7 @@ from .jobhandler import JobHandler
 from .mountainjobresult import MountainJobResult
 from typing import List
 from .mountainjob import MountainJob
+from .runtimestats import predict_job_duration
 
 
 class ParallelJobHandler(JobHandler):
@@ -23,7 +24,8 @@ class ParallelJobHandler(JobHandler):
             job=job,
             process=process,
             pipe_to_child=pipe_to_child,
-            pjh_status='pending'
+            pjh_status='pending',
+            estimated_duration=predict_job_duration(job.getObject(copy=False))
         ))
         return job.result
 
@@ -45,13 +47,24 @@ class ParallelJobHandler(JobHandler):
             if p['pjh_status'] == 'running':
                 num_running = num_running + 1
 
-        for p in self._processes:
+        # start the longest jobs first (those with no prediction are treated as long)
+        pending = [p for p in self._processes if p['pjh_status'] == 'pending']
+        pending.sort(key=lambda p: -p['estimated_duration'] if p['estimated_duration'] is not None else -float('inf'))
+        for p in pending:
             if p['pjh_status'] == 'pending':
                 if num_running < self._num_workers:
                     p['pjh_status'] = 'running'
                     p['process'].start()
                     num_running = num_running + 1
     
+    def waitForEvents(self, timeout: float) -> None:
+        # the running jobs send their results through the pipes
+        pipes = [p['pipe_to_child'] for p in self._processes if p['pjh_status'] == 'running']
+        if not pipes:
+            time.sleep(timeout)
+            return
+        wait(pipes, timeout=timeout)
+
     def isFinished(self) -> bool:
         if self._halted:
             return True
@@ -0,0 +1,267 @@
+import os
+import resource
+import threading
+import time
+from typing import Optional, List, Dict, Tuple
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+TIMELINE_COLUMNS = ['elapsed_sec', 'rss_bytes', 'cpu_sec', 'read_bytes', 'write_bytes']
+
+
+class ResourceMonitor():
+    def __init__(self, include_self: bool=True, interval: Optional[float]=None, max_num_samples: Optional[int]=None):
+        """Measures the resources used by a job: this process (if
+        include_self) and the child processes started after start() (e.g.,
+        the shell script running a container), with their descendants, plus
+        any other processes added with addProcess (e.g., a warm worker).
+
+        CPU times come from getrusage (for this process and the child
+        processes that have been waited for) plus the sampled CPU times of
+        the added processes. Peak RSS, bytes read and written, and the
+        timeline come from sampling /proc (Linux only).
+
+        Parameters
+        ----------
+        include_self : bool, optional
+            Whether to include this process (when the job runs in it), by default True
+        interval : Optional[float], optional
+            The sampling interval in seconds, by default from the
+            MLPROCESSORS_RESOURCE_SAMPLE_INTERVAL environment variable, or 1
+        max_num_samples : Optional[int], optional
+            When the timeline exceeds this many samples, every other sample
+            is dropped and the interval is doubled, by default 600
+        """
+        if interval is None:
+            interval = float(os.environ.get('MLPROCESSORS_RESOURCE_SAMPLE_INTERVAL', 1))
+        self._include_self = include_self
+        # the processes that were running before start() (other than this one
+        # if include_self), which are not measured
+        self._excluded: set = set()
+        self._interval = interval
+        self._max_num_samples = max_num_samples or 600
+        self._added_pids: List[int] = []
+        # the processes in the trees of the added processes
+        self._added_tree: set = set()
+        self._first: Dict[int, tuple] = dict()
+        self._last: Dict[int, tuple] = dict()
+        self._peak_rss = 0
+        self._timeline: List[list] = []
+        self._rusage_start: Optional[Tuple[resource.struct_rusage, resource.struct_rusage]] = None
+        self._rusage_stop: Optional[Tuple[resource.struct_rusage, resource.struct_rusage]] = None
+        self._time_start: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._time_start = time.time()
+        self._rusage_start = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        procs = _read_process_table([os.getpid()])
+        if procs is not None:
+            self._excluded = set(_descendants(procs, [os.getpid()]))
+            if self._include_self:
+                self._excluded.discard(os.getpid())
+        self._sample(baseline=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def addProcess(self, pid: Optional[int]) -> None:
+        """Also measure the process (and its descendants), which is not a
+        child of this process. Only what it uses from now on is counted."""
+        if pid is None:
+            return
+        with self._lock:
+            if pid not in self._added_pids:
+                self._added_pids.append(pid)
+        self._sample(baseline=True)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+        self._rusage_stop = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+
+    def resources(self) -> dict:
+        """The resources used (after stop): peak_rss_bytes, cpu_user_sec,
+        cpu_system_sec, read_bytes, write_bytes, and resource_timeline
+        (dict with columns and samples)"""
+        assert self._rusage_start is not None and self._rusage_stop is not None
+        self_start, children_start = self._rusage_start
+        self_stop, children_stop = self._rusage_stop
+        cpu_user = children_stop.ru_utime - children_start.ru_utime
+        cpu_system = children_stop.ru_stime - children_start.ru_stime
+        if self._include_self:
+            cpu_user = cpu_user + (self_stop.ru_utime - self_start.ru_utime)
+            cpu_system = cpu_system + (self_stop.ru_stime - self_start.ru_stime)
+        # (the ru_maxrss of the child processes is not used, since a forked
+        # child is charged with the memory of this process until it execs)
+        peak_rss = self._peak_rss
+        with self._lock:
+            for pid in self._last.keys():
+                if pid in self._added_tree:
+                    cpu_user = cpu_user + (self._last[pid][1] - self._first[pid][1]) / _CLOCK_TICKS
+                    cpu_system = cpu_system + (self._last[pid][2] - self._first[pid][2]) / _CLOCK_TICKS
+            _, read_bytes, write_bytes = self._totals()
+            timeline = [list(sample) for sample in self._timeline]
+        return dict(
+            peak_rss_bytes=peak_rss,
+            cpu_user_sec=cpu_user,
+            cpu_system_sec=cpu_system,
+            read_bytes=read_bytes,
+            write_bytes=write_bytes,
+            resource_timeline=dict(columns=TIMELINE_COLUMNS, samples=timeline)
+        )
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self._sample()
+
+    def _sample(self, baseline: bool=False) -> None:
+        # With baseline, the processes seen for the first time were already
+        # running, and only count from now on. Otherwise they are new.
+        assert self._time_start is not None
+        with self._lock:
+            procs = _read_process_table([os.getpid()] + self._added_pids)
+            if procs is None:
+                return
+            added_tree = _descendants(procs, self._added_pids)
+            self._added_tree.update(added_tree)
+            rss_total = 0
+            for pid in _descendants(procs, [os.getpid()] + self._added_pids):
+                if (pid in self._excluded) and (pid not in self._added_tree):
+                    continue
+                info = procs[pid]
+                # (start time, utime, stime, read, write); the start time
+                # distinguishes a reused pid
+                values = (info['starttime'], info['utime'], info['stime']) + _read_io(pid)
+                if (pid not in self._first) or (self._first[pid][0] != values[0]):
+                    if baseline:
+                        self._first[pid] = values
+                    else:
+                        self._first[pid] = (values[0], 0, 0, 0, 0)
+                self._last[pid] = values
+                rss_total = rss_total + info['rss_bytes']
+            self._peak_rss = max(self._peak_rss, rss_total)
+            cpu_sec, read_bytes, write_bytes = self._totals()
+            self._timeline.append([round(time.time() - self._time_start, 3), rss_total, round(cpu_sec, 3), read_bytes, write_bytes])
+            if len(self._timeline) > self._max_num_samples:
+                self._timeline = self._timeline[::2]
+                self._interval = self._interval * 2
+
+    def _totals(self) -> Tuple[float, int, int]:
+        # sampled totals since the start, including the processes that
+        # have exited since they were last seen
+        cpu = 0
+        read_bytes = 0
+        write_bytes = 0
+        for pid, last in self._last.items():
+            first = self._first[pid]
+            cpu = cpu + (last[1] - first[1]) + (last[2] - first[2])
+            read_bytes = read_bytes + max(last[3] - first[3], 0)
+            write_bytes = write_bytes + max(last[4] - first[4], 0)
+        return cpu / _CLOCK_TICKS, read_bytes, write_bytes
+
+
+def _read_process_table(root_pids: List[int]) -> Optional[Dict[int, dict]]:
+    # the processes in the trees of the root processes (by pid). The
+    # children are found from /proc/<pid>/task/<tid>/children when the
+    # kernel provides it, so that only the tracked processes are read
+    # rather than the whole process table.
+    if not os.path.isdir('/proc'):
+        return None
+    if not _children_files_available():
+        procs = dict()
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                info = _read_stat(int(name))
+                if info is not None:
+                    procs[int(name)] = info
+        return {pid: procs[pid] for pid in _descendants(procs, root_pids)}
+    ret: Dict[int, dict] = dict()
+    stack = list(root_pids)
+    while stack:
+        pid = stack.pop()
+        if pid in ret:
+            continue
+        info = _read_stat(pid)
+        if info is None:
+            continue
+        ret[pid] = info
+        stack.extend(_read_children(pid))
+    return ret
+
+
+_children_files_available_cache: Optional[bool] = None
+
+
+def _children_files_available() -> bool:
+    global _children_files_available_cache
+    if _children_files_available_cache is None:
+        _children_files_available_cache = os.path.exists('/proc/{}/task/{}/children'.format(os.getpid(), os.getpid()))
+    return _children_files_available_cache
+
+
+def _read_stat(pid: int) -> Optional[dict]:
+    try:
+        with open('/proc/{}/stat'.format(pid), 'r') as f:
+            txt = f.read()
+    except OSError:
+        return None
+    # the command name (in parentheses) may contain spaces
+    fields = txt[txt.rfind(')') + 2:].split()
+    return dict(
+        ppid=int(fields[1]),
+        utime=int(fields[11]),
+        stime=int(fields[12]),
+        starttime=int(fields[19]),
+        rss_bytes=int(fields[21]) * _PAGE_SIZE
+    )
+
+
+def _read_children(pid: int) -> List[int]:
+    # the children of all the threads of the process
+    ret: List[int] = []
+    try:
+        tids = os.listdir('/proc/{}/task'.format(pid))
+    except OSError:
+        return ret
+    for tid in tids:
+        try:
+            with open('/proc/{}/task/{}/children'.format(pid, tid), 'r') as f:
+                ret.extend([int(child) for child in f.read().split()])
+        except OSError:
+            continue
+    return ret
+
+
+def _descendants(procs: Dict[int, dict], root_pids: List[int]) -> List[int]:
+    children: Dict[int, List[int]] = dict()
+    for pid, info in procs.items():
+        children.setdefault(info['ppid'], []).append(pid)
+    ret = []
+    stack = [pid for pid in root_pids if pid in procs]
+    while stack:
+        pid = stack.pop()
+        if pid in ret:
+            continue
+        ret.append(pid)
+        stack.extend(children.get(pid, []))
+    return ret
+
+
+def _read_io(pid: int) -> Tuple[int, int]:
+    # bytes read and written by the process (rchar and wchar, which include
+    # reads from the page cache and from sockets)
+    try:
+        with open('/proc/{}/io'.format(pid), 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return (0, 0)
+    vals = dict()
+    for line in lines:
+        key, _, val = line.partition(':')
+        vals[key] = int(val.strip() or 0)
+    return (vals.get('rchar', 0), vals.get('wchar', 0))
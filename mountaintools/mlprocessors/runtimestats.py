@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import traceback
+from typing import Optional, List
+from mountainclient import MountainClient
+
+local_client = MountainClient()
+
+# The number of most recent runs used for a prediction
+_MAX_NUM_RUNS = 100
+
+
+class RuntimeStats():
+    def __init__(self, path: Optional[str]=None):
+        """Statistics of the runs of jobs (duration, peak memory), indexed by
+        processor name/version, parameters, and the total size of the input
+        files, for predicting the resources of new jobs.
+
+        Parameters
+        ----------
+        path : Optional[str], optional
+            The SQLite file, by default from the MLPROCESSORS_RUNTIME_STATS_DB
+            environment variable, or runtime_stats.sqlite in the mountain
+            directory (MOUNTAIN_DIR or ~/.mountain)
+        """
+        if path is None:
+            path = os.environ.get('MLPROCESSORS_RUNTIME_STATS_DB', None) or _default_path()
+        self._path = path
+        self._local = threading.local()
+        self._initialized = False
+
+    def path(self) -> str:
+        return self._path
+
+    def record(self, job_object: dict, runtime_info: dict, *, input_size: Optional[int]=None) -> None:
+        """Record a run of the job
+
+        Parameters
+        ----------
+        job_object : dict
+            The job object
+        runtime_info : dict
+            The runtime info of the run (elapsed_sec, retcode, timed_out, and
+            peak_rss_bytes if available)
+        input_size : Optional[int], optional
+            The total size of the input files in bytes (see
+            compute_job_input_size)
+        """
+        elapsed_sec = runtime_info.get('elapsed_sec', None)
+        if elapsed_sec is None:
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'INSERT INTO runs (processor_name, processor_version, parameters_hash, input_size, elapsed_sec, peak_rss_bytes, retcode, timed_out, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    job_object['processor_name'], job_object['processor_version'], _parameters_hash(job_object),
+                    input_size, elapsed_sec, runtime_info.get('peak_rss_bytes', None),
+                    runtime_info.get('retcode', None), 1 if runtime_info.get('timed_out', False) else 0,
+                    time.time()
+                )
+            )
+
+    def predict(self, job_object: dict, *, input_size: Optional[int]=None) -> Optional[dict]:
+        """Predict the duration and peak memory of a job from the successful
+        runs of the same processor with the same parameters (or, if there
+        are none, with any parameters). When the input size is known, the
+        predictions are scaled by it.
+
+        Returns
+        -------
+        Optional[dict]
+            None if there are no runs, otherwise a dict with elapsed_sec (the
+            typical duration), elapsed_sec_max (the longest), peak_rss_bytes
+            (or None), num_runs, and basis ('parameters' or 'processor')
+        """
+        if not os.path.exists(self._path):
+            return None
+        conn = self._conn()
+        query = 'SELECT input_size, elapsed_sec, peak_rss_bytes FROM runs WHERE processor_name=? AND processor_version=? {} AND retcode=0 AND timed_out=0 ORDER BY timestamp DESC LIMIT ?'
+        basis = 'parameters'
+        rows = conn.execute(query.format('AND parameters_hash=?'), (job_object['processor_name'], job_object['processor_version'], _parameters_hash(job_object), _MAX_NUM_RUNS)).fetchall()
+        if not rows:
+            basis = 'processor'
+            rows = conn.execute(query.format(''), (job_object['processor_name'], job_object['processor_version'], _MAX_NUM_RUNS)).fetchall()
+        if not rows:
+            return None
+        elapsed = _scaled_values([(row[0], row[1]) for row in rows], input_size)
+        peak_rss = _scaled_values([(row[0], row[2]) for row in rows if row[2] is not None], input_size)
+        return dict(
+            elapsed_sec=_median(elapsed),
+            elapsed_sec_max=max(elapsed),
+            peak_rss_bytes=_median(peak_rss) if peak_rss else None,
+            num_runs=len(rows),
+            basis=basis
+        )
+
+    def suggestTimeout(self, job_object: dict, *, max_timeout: float, input_size: Optional[int]=None, factor: float=3, min_timeout: float=60) -> float:
+        """A timeout for the job: factor times the longest predicted
+        duration, between min_timeout and max_timeout (max_timeout if there
+        is no prediction)"""
+        prediction = self.predict(job_object, input_size=input_size)
+        if prediction is None:
+            return max_timeout
+        return min(max_timeout, max(min_timeout, factor * prediction['elapsed_sec_max']))
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per thread and per process, as for the local database
+        conn = getattr(self._local, 'conn', None)
+        if (conn is not None) and (getattr(self._local, 'pid', None) == os.getpid()):
+            return conn
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        conn = sqlite3.connect(self._path, timeout=60, isolation_level='DEFERRED')
+        if not self._initialized:
+            # not WAL, which does not work on network file systems (the
+            # mountain directory is often in a shared home directory)
+            conn.execute('PRAGMA journal_mode=DELETE')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS runs (processor_name TEXT NOT NULL, processor_version TEXT NOT NULL, parameters_hash TEXT NOT NULL, input_size INTEGER, elapsed_sec REAL NOT NULL, peak_rss_bytes INTEGER, retcode INTEGER, timed_out INTEGER NOT NULL, timestamp REAL NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS runs_processor ON runs (processor_name, processor_version, parameters_hash, timestamp)')
+            self._initialized = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+
+_runtime_stats: Optional[RuntimeStats] = None
+
+
+def runtime_stats() -> RuntimeStats:
+    """The runtime statistics store shared in this process"""
+    global _runtime_stats
+    if _runtime_stats is None:
+        _runtime_stats = RuntimeStats()
+    return _runtime_stats
+
+
+def runtime_stats_enabled() -> bool:
+    """Whether the runs of jobs are recorded and used for predictions (the
+    MLPROCESSORS_RUNTIME_STATS environment variable, FALSE by default)"""
+    return (os.environ.get('MLPROCESSORS_RUNTIME_STATS', 'FALSE') == 'TRUE')
+
+
+def predict_job_duration(job_object: dict) -> Optional[float]:
+    """The duration of the job in seconds predicted from the runtime stats, or None"""
+    if not runtime_stats_enabled():
+        return None
+    try:
+        prediction = runtime_stats().predict(job_object, input_size=compute_job_input_size(job_object))
+    except:
+        traceback.print_exc()
+        print('WARNING: problem predicting the duration of job.')
+        return None
+    if prediction is None:
+        return None
+    return prediction['elapsed_sec']
+
+
+def compute_job_input_size(job_object: dict) -> Optional[int]:
+    """The total size in bytes of the input files of the job (including the
+    additional files to realize, e.g., the raw data of a recording
+    directory), or None if some of them are not available locally"""
+    paths = []
+    for input0 in job_object['inputs'].values():
+        for a in (input0 if type(input0) == list else [input0]):
+            if (not a.get('directory', False)) and a.get('path', None):
+                paths.append(a['path'])
+    paths.extend(job_object.get('additional_files_to_realize', []))
+    if not paths:
+        return None
+    total = 0
+    for path in paths:
+        fname = local_client.findFile(path)
+        if (fname is None) or (not os.path.isfile(fname)):
+            return None
+        total = total + os.path.getsize(fname)
+    return total
+
+
+def _default_path() -> str:
+    dirname = os.environ.get('MOUNTAIN_DIR', os.environ.get('CAIRIO_DIR', str(pathlib.Path.home()) + '/.mountain'))
+    return os.path.join(dirname, 'runtime_stats.sqlite')
+
+
+def _parameters_hash(job_object: dict) -> str:
+    txt = json.dumps(job_object.get('parameters_to_hash', job_object.get('parameters', {})), sort_keys=True)
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+
+def _scaled_values(rows: List[tuple], input_size: Optional[int]) -> List[float]:
+    # rows are (input_size, value). When the input size of the new job is
+    # known, the values of the runs with known input sizes are scaled
+    # proportionally to it.
+    if input_size:
+        sized = [(size, value) for size, value in rows if size]
+        if sized:
+            return [value * input_size / size for size, value in sized]
+    return [value for _, value in rows]
+
+
+def _median(values: List[float]) -> float:
+    values = sorted(values)
+    n = len(values)
+    if n % 2 == 1:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2
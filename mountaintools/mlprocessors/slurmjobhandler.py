@@ -2,20 +2,31 @@ import multiprocessing
 import os
 import time
 import random
+import select
 import signal
 import shutil
+import secrets
+import socket
+import threading
 import traceback
 import mlprocessors as mlpr
 from .jobhandler import JobHandler
 from .mountainjobresult import MountainJobResult
+from .mountainjob import local_client
+from .runtimestats import predict_job_duration
 from .shellscript import ShellScript
 from mountainclient import FileLock
 from mountainclient import client as mt
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple, Any
 import json
 
 DEFAULT_JOB_TIMEOUT = 1200
 
+# Workers connected through the control channel send a heartbeat at this
+# interval, and are considered lost after HEARTBEAT_TIMEOUT seconds of silence
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 90
+
 
 class SlurmJobHandler(JobHandler):
     def __init__(self, working_dir: str):
@@ -36,6 +47,8 @@ class SlurmJobHandler(JobHandler):
         self._last_batch_id: int = 0
         self._working_dir: str = working_dir
         self._unassigned_jobs: List[mlpr.MountainJob] = []
+        # estimated durations of the unassigned jobs (by id of the job), for ordering
+        self._estimated_durations: Dict[int, Optional[float]] = dict()
 
     def addBatchType(self, *,
                      name: str,
@@ -44,7 +57,8 @@ class SlurmJobHandler(JobHandler):
                      use_slurm: bool,
                      time_limit_per_batch: Optional[float]=None,  # number of seconds or None
                      max_simultaneous_batches: Optional[int]=None,
-                     additional_srun_opts: List[str]=[]
+                     additional_srun_opts: List[str]=[],
+                     ram_gb_per_job: Optional[float]=None
                      ) -> None:
         """Add a batch type to the slurm job handler.
 
@@ -62,6 +76,9 @@ class SlurmJobHandler(JobHandler):
             If a number, the maximum duration of a batch in seconds, by default None
         additional_srun_opts : List[str], optional
             A list of additional string options to send to srun (only applies of use_slurm is True), by default []
+        ram_gb_per_job : Optional[float], optional
+            The memory available to each worker task in GB, if known (used to
+            choose the batch type for jobs that declare ram_gb), by default None
 
         Returns
         -------
@@ -75,7 +92,8 @@ class SlurmJobHandler(JobHandler):
             use_slurm=use_slurm,
             time_limit_per_batch=time_limit_per_batch,
             max_simultaneous_batches=max_simultaneous_batches,
-            additional_srun_opts=additional_srun_opts
+            additional_srun_opts=additional_srun_opts,
+            ram_gb_per_job=ram_gb_per_job
         )
 
     def executeJob(self, job: mlpr.MountainJob) -> MountainJobResult:
@@ -84,8 +102,10 @@ class SlurmJobHandler(JobHandler):
         Parameters
         ----------
         job : mlpr.MountainJob
-            The job to run. The job can specify the batch type in its compute requirements.
-            The default batch type is "default".
+            The job to run. The job can specify the batch type in its compute requirements,
+            or the resources it needs (num_cores, ram_gb), in which case the smallest
+            batch type that provides them is used. The default batch type is "default".
+            An expected_duration_sec in the compute requirements is used to order the jobs.
 
         Returns
         -------
@@ -95,14 +115,12 @@ class SlurmJobHandler(JobHandler):
         job_timeout = job.getObject().get('timeout', None)
         if job_timeout is None:
             job_timeout = DEFAULT_JOB_TIMEOUT
-        compute_requirements = job.getObject().get('compute_requirements', {})
-        batch_type_name = compute_requirements.get('batch_type', 'default')
-        if batch_type_name not in self._batch_types:
-            raise Exception('No batch type: {}'.format(batch_type_name))
+        batch_type_name = self._get_batch_type_name_for_job(job)
         batch_type = self._batch_types[batch_type_name]
         if batch_type['time_limit_per_batch'] is not None:
             if job_timeout > batch_type['time_limit_per_batch']:
                 raise Exception('Cannot execute job. Job timeout exceeds time limit: {} > {}'.format(job_timeout, batch_type['time_limit_per_batch']))
+        self._estimated_durations[id(job)] = _estimate_job_duration(job)
         self._unassigned_jobs.append(job)
         return job.result
 
@@ -122,14 +140,35 @@ class SlurmJobHandler(JobHandler):
         if self._halted:
             return
 
-        # Handle the unassigned jobs
+        # Handle the unassigned jobs, longest first (so that a long job does
+        # not start last and hold a batch open after the others are done).
+        # Jobs with no estimate are treated as long.
+        def sort_key(job):
+            duration = self._estimated_durations.get(id(job), None)
+            return -duration if duration is not None else -float('inf')
         unassigned_jobs_after = []
-        for job in self._unassigned_jobs:
+        for job in sorted(self._unassigned_jobs, key=sort_key):
             if not self._handle_unassigned_job(job):
                 # Unable to assign the job, so we'll try next iteration
                 unassigned_jobs_after.append(job)
+            else:
+                del self._estimated_durations[id(job)]
         self._unassigned_jobs = unassigned_jobs_after
 
+    def waitForEvents(self, timeout: float) -> None:
+        """Wait until a message arrives on the control channel of some batch
+        (e.g., a job result), or the timeout elapses. Workers that use the
+        file protocol are polled by iterate() as before.
+        """
+        socks = []
+        for b in self._batches.values():
+            if not b.isFinished():
+                socks.extend(b.controlSockets())
+        if not socks:
+            time.sleep(timeout)
+            return
+        select.select(socks, [], [], timeout)
+
     def isFinished(self) -> bool:
         """Whether all queued jobs have finished
 
@@ -172,20 +211,50 @@ class SlurmJobHandler(JobHandler):
         """
         _rmdir_with_retries(self._working_dir, num_retries=10)
 
+    def _get_batch_type_name_for_job(self, job: mlpr.MountainJob) -> str:
+        compute_requirements = job.getObject(copy=False).get('compute_requirements', {})
+        num_cores = compute_requirements.get('num_cores', None)
+        ram_gb = compute_requirements.get('ram_gb', None)
+
+        def provides(batch_type: dict) -> bool:
+            if (num_cores is not None) and ((batch_type['num_cores_per_job'] or 1) < num_cores):
+                return False
+            if (ram_gb is not None) and ((batch_type['ram_gb_per_job'] is None) or (batch_type['ram_gb_per_job'] < ram_gb)):
+                return False
+            return True
+
+        if ('batch_type' in compute_requirements) or ((num_cores is None) and (ram_gb is None)):
+            batch_type_name = compute_requirements.get('batch_type', 'default')
+            if batch_type_name not in self._batch_types:
+                raise Exception('No such batch type in slurm job handler: {}'.format(batch_type_name))
+            if not provides(self._batch_types[batch_type_name]):
+                raise Exception('Batch type {} does not provide the resources required by job: num_cores={}, ram_gb={}'.format(batch_type_name, num_cores, ram_gb))
+            return batch_type_name
+
+        # the smallest batch type that provides the resources
+        candidates = [
+            name for name, batch_type in self._batch_types.items()
+            if provides(batch_type)
+        ]
+        if not candidates:
+            raise Exception('No batch type provides the resources required by job: num_cores={}, ram_gb={}'.format(num_cores, ram_gb))
+        return min(candidates, key=lambda name: (self._batch_types[name]['num_cores_per_job'] or 1, self._batch_types[name]['ram_gb_per_job'] or 0))
+
     def _handle_unassigned_job(self, job: mlpr.MountainJob):
-        compute_requirements = job.getObject().get('compute_requirements', {})
-        batch_type_name = compute_requirements.get('batch_type', 'default')
-        if batch_type_name not in self._batch_types:
-            raise Exception('No such batch type in slurm job handler: {}'.format(batch_type_name))
+        batch_type_name = self._get_batch_type_name_for_job(job)
         batch_type = self._batch_types[batch_type_name]
 
-        # See if we can add a job to an existing batch that has a vacancy
-        for _, b in self._batches.items():
-            if b.batchTypeName() == batch_type_name:
-                if b.isRunning():
-                    if b.canAddJob(job):
-                        b.addJob(job)
-                        return True
+        # See if we can add a job to an existing batch that has a vacancy.
+        # We pack the jobs into the busiest batch, so that the others
+        # can drain and end.
+        candidate_batches = [
+            b for b in self._batches.values()
+            if (b.batchTypeName() == batch_type_name) and (b.isRunning()) and (b.canAddJob(job))
+        ]
+        if candidate_batches:
+            b = min(candidate_batches, key=lambda b: b.numAvailableWorkers())
+            b.addJob(job)
+            return True
 
         # See if there is anything waiting to start and count up the number of running batches
         num_running_batches_of_type = 0
@@ -254,13 +323,26 @@ class _Batch():
         for i in range(self._num_workers):
             self._workers.append(_Worker(base_path=self._working_dir + '/worker_{}'.format(i)))
 
+        # The workers connect to the control server to receive their jobs
+        # and send back results and heartbeats. The files in the working
+        # directory are used as a fallback if they are unable to connect.
+        self._control_server: Optional[_ControlServer] = None
+        if os.environ.get('MLPROCESSORS_SLURM_CONTROL_CHANNEL', 'TRUE') == 'TRUE':
+            try:
+                self._control_server = _ControlServer(num_workers=self._num_workers)
+            except OSError:
+                traceback.print_exc()
+                print('WARNING: Unable to start control server. Using files.')
+
         self._slurm_process = _SlurmProcess(
             working_dir=self._working_dir,
             num_workers=self._num_workers,
             num_cores_per_job=self._num_cores_per_job,
             additional_srun_opts=self._additional_srun_opts,
             use_slurm=self._use_slurm,
-            time_limit=self._time_limit
+            time_limit=self._time_limit,
+            control_address=self._control_server.address() if self._control_server else None,
+            control_token=self._control_server.token() if self._control_server else None
         )
 
     def batchTypeName(self) -> str:
@@ -289,6 +371,22 @@ class _Batch():
             return 0
         return time.time() - self._time_started
 
+    def controlSockets(self) -> List[socket.socket]:
+        """The sockets of the control channel (to wait on for messages)"""
+        if self._control_server is None:
+            return []
+        return self._control_server.sockets()
+
+    def _handle_control_messages(self) -> None:
+        if self._control_server is None:
+            return
+        for connection, msg in self._control_server.poll():
+            if msg['type'] == 'hello':
+                # (authenticated and checked by the control server)
+                self._workers[connection.worker_num].setConnection(connection)
+            elif connection.worker_num is not None:
+                self._workers[connection.worker_num].handleControlMessage(msg)
+
     def iterate(self) -> None:
         """Periodically take care of business
 
@@ -300,6 +398,7 @@ class _Batch():
         if self.isPending():
             pass
         elif self.isWaitingToStart():
+            self._handle_control_messages()
             # first iterate all the workers so they can do what they need to do
             for w in self._workers:
                 w.iterate()
@@ -321,6 +420,7 @@ class _Batch():
                 if len(x) == 0:
                     assert('Unexpected problem. We should at least have a running.txt and a *.py file here.')
         elif self.isRunning():
+            self._handle_control_messages()
             # first iterate all the workers so they can do what they need to do
             for w in self._workers:
                 w.iterate()
@@ -373,11 +473,16 @@ class _Batch():
                 return False
         # If some worker has a vacancy then we can add the job
         for w in self._workers:
-            if not w.hasJob():
+            if w.isAvailable():
                 return True
         # Otherwise, we have no vacancy for a new job
         return False
 
+    def numAvailableWorkers(self) -> int:
+        """The number of workers that can take a job
+        """
+        return len([w for w in self._workers if w.isAvailable()])
+
     def hasJob(self) -> bool:
         """Return True if some worker has a job
         """
@@ -416,7 +521,7 @@ class _Batch():
 
         # Add the job to a vacant worker
         for w in self._workers:
-            if not w.hasJob():
+            if w.isAvailable():
                 w.setJob(job)
                 return
 
@@ -452,6 +557,9 @@ class _Batch():
         if os.path.exists(running_fname):
             with FileLock(running_fname + '.lock', exclusive=True):
                 os.remove(self._working_dir + '/running.txt')
+        # The workers connected through the control channel are told directly
+        for w in self._workers:
+            w.stop()
         self._status = 'finished'
         # wait a bit for it to resolve on its own (because we removed the running.txt)
         if not self._slurm_process.wait(5):
@@ -459,6 +567,8 @@ class _Batch():
             self._slurm_process.wait(5)
         # now force the halt
         self._slurm_process.halt()
+        if self._control_server is not None:
+            self._control_server.close()
 
 
 class _Worker():
@@ -477,6 +587,8 @@ class _Worker():
         self._job: Optional[mlpr.MountainJob] = None
         self._job_finish_timestamp: Optional[float] = None
         self._base_path: str = base_path
+        self._connection: Optional[_ControlConnection] = None
+        self._lost: bool = False
 
     def hasJob(self) -> bool:
         """Whether this worker has a job
@@ -485,6 +597,11 @@ class _Worker():
             return True
         return False
 
+    def isAvailable(self) -> bool:
+        """Whether a job can be given to this worker
+        """
+        return (self._job is None) and (not self._lost)
+
     def everHadJob(self) -> bool:
         """Whether this worker ever had a job
         """
@@ -518,6 +635,10 @@ class _Worker():
         """
         self._job = job
         job_object = self._job.getObject()
+        if self._connection is not None:
+            # push the job to the worker
+            self._connection.send(dict(type='job', job=job_object))
+            return
         job_fname = self._base_path + '_job.json'
         num_tries = 3
         for try_count in range(1, num_tries + 1):
@@ -537,14 +658,52 @@ class _Worker():
     def hasStarted(self) -> bool:
         """Returns whether the worker (not the job) has started
         """
+        if self._connection is not None:
+            return True
         return os.path.exists(self._base_path + '_claimed.txt')
 
+    def setConnection(self, connection: '_ControlConnection') -> None:
+        """Use the control channel (rather than the files) to communicate with the worker
+        """
+        self._connection = connection
+        if self._job is not None:
+            # the job was written to the file before the worker connected
+            job_fname = self._base_path + '_job.json'
+            with FileLock(job_fname + '.lock', exclusive=True):
+                if os.path.exists(job_fname):
+                    os.remove(job_fname)
+            self._connection.send(dict(type='job', job=self._job.getObject()))
+
+    def handleControlMessage(self, msg: dict) -> None:
+        """Handle a message from the worker on the control channel (heartbeats are handled by the connection)
+        """
+        if msg['type'] == 'result':
+            if self._job is not None:
+                self._set_result(msg['result'])
+        elif msg['type'] == 'error':
+            # Same as the _result.json.error file of the file protocol
+            print(msg['traceback'])
+            raise Exception('Unexpected error processing job in batch.')
+        elif msg['type'] == 'closed':
+            self._set_lost('Lost connection to worker')
+
+    def stop(self) -> None:
+        """Tell the worker to stop (if it is connected through the control channel)
+        """
+        if self._connection is not None:
+            self._connection.send(dict(type='stop'))
+
     def iterate(self) -> None:
         """Take care of business of the worker
         """
         if not self._job:
             # If we don't have a job, then we don't need to take care of any business.
             return
+        if self._connection is not None:
+            # The result arrives on the control channel
+            if time.time() - self._connection.lastMessageTime() > HEARTBEAT_TIMEOUT:
+                self._set_lost('No heartbeat from worker for {} sec'.format(HEARTBEAT_TIMEOUT))
+            return
         job_fname = self._base_path + '_job.json'
         result_fname = self._base_path + '_result.json'
         result_obj: Optional[dict] = None
@@ -578,15 +737,225 @@ class _Worker():
 
         if result_obj:
             # Here's the result that we read above
-            self._job.result.fromObject(result_obj)
-            self._job.result._status = 'finished'
-            # We no longer have a job, and we should set the finished timestamp
-            self._job = None
-            self._job_finish_timestamp = time.time()
+            self._set_result(result_obj)
+
+    def _set_result(self, result_obj: dict) -> None:
+        assert self._job is not None
+        self._job.result.fromObject(result_obj)
+        self._job.result._status = 'finished'
+        # We no longer have a job, and we should set the finished timestamp
+        self._job = None
+        self._job_finish_timestamp = time.time()
+
+    def _set_lost(self, reason: str) -> None:
+        # The worker is not used again, and its job (if any) fails
+        print('WARNING: {}: {}'.format(reason, self._base_path))
+        self._lost = True
+        if self._connection is not None:
+            self._connection.close()
+        if self._job is not None:
+            self._set_result(dict(retcode=-1, timed_out=False, console_out=None, runtime_info=None, outputs=None))
+
+
+class _ControlServer():
+    def __init__(self, num_workers: int):
+        """The server end of the control channel of a batch. Messages are
+        json objects, one per line.
+
+        worker -> handler: hello (with worker_num and token), heartbeat, result, error
+        handler -> worker: job, stop
+
+        The token is random for each batch, and is only written to
+        execute_batch_srun.py (readable by the user only). Connections
+        that do not start with a hello with the token and a valid
+        worker_num are closed.
+
+        Parameters
+        ----------
+        num_workers : int
+            Number of workers in the batch
+        """
+        self._num_workers = num_workers
+        self._token = secrets.token_hex(32)
+        self._host = os.environ.get('MLPROCESSORS_SLURM_CONTROL_HOST', socket.gethostname())
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # only on the interface of the advertised host
+        self._listener.bind((self._host, 0))
+        self._listener.listen(128)
+        self._listener.setblocking(False)
+        self._connections: Dict[socket.socket, _ControlConnection] = dict()
+
+    def address(self) -> Tuple[str, int]:
+        return (self._host, self._listener.getsockname()[1])
+
+    def token(self) -> str:
+        return self._token
+
+    def sockets(self) -> List[socket.socket]:
+        return [self._listener] + list(self._connections.keys())
+
+    def poll(self) -> List[Tuple['_ControlConnection', dict]]:
+        """Accept new connections and return the messages that have
+        arrived, without blocking. A closed connection gives a 'closed' message.
+        """
+        ret: List[Tuple[_ControlConnection, dict]] = []
+        readable, _, _ = select.select(self.sockets(), [], [], 0)
+        for sock in readable:
+            if sock is self._listener:
+                try:
+                    conn, _ = self._listener.accept()
+                except OSError:
+                    continue
+                conn.setblocking(True)
+                self._connections[conn] = _ControlConnection(conn)
+            else:
+                connection = self._connections[sock]
+                msgs = connection.receive()
+                if msgs is None:
+                    del self._connections[sock]
+                    connection.close()
+                    ret.append((connection, dict(type='closed')))
+                else:
+                    for msg in msgs:
+                        if connection.worker_num is None:
+                            if not self._authenticate(connection, msg):
+                                print('WARNING: closing unauthenticated connection on control channel.')
+                                del self._connections[sock]
+                                connection.close()
+                                break
+                        ret.append((connection, msg))
+        return ret
+
+    def _authenticate(self, connection: '_ControlConnection', msg: dict) -> bool:
+        # the first message of a connection must be a valid hello
+        if not isinstance(msg, dict) or msg.get('type') != 'hello':
+            return False
+        token = msg.get('token')
+        if not isinstance(token, str) or not secrets.compare_digest(token, self._token):
+            return False
+        worker_num = msg.get('worker_num')
+        if type(worker_num) != int or worker_num not in range(self._num_workers):
+            return False
+        connection.worker_num = worker_num
+        return True
+
+    def close(self) -> None:
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = dict()
+        self._listener.close()
+
+
+class _ControlConnection():
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._buf = b''
+        self._last_message_time = time.time()
+        self._closed = False
+        self.worker_num: Optional[int] = None
+
+    def lastMessageTime(self) -> float:
+        return self._last_message_time
+
+    def send(self, msg: dict) -> None:
+        if self._closed:
+            return
+        try:
+            self._sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+        except OSError:
+            print('WARNING: unable to send message to worker on control channel.')
+
+    def receive(self) -> Optional[List[dict]]:
+        # called when the socket is readable; None means closed
+        try:
+            data = self._sock.recv(1024 * 1024)
+        except OSError:
+            data = b''
+        if not data:
+            return None
+        self._last_message_time = time.time()
+        self._buf = self._buf + data
+        lines = self._buf.split(b'\n')
+        self._buf = lines[-1]
+        try:
+            return [json.loads(line.decode('utf-8')) for line in lines[:-1] if line]
+        except ValueError:
+            print('WARNING: invalid message on control channel.')
+            return None
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._sock.close()
+
+
+def _run_worker_with_control_channel(control_address: Tuple[str, int], control_token: str, worker_num: int) -> bool:
+    """Run in the worker process (see execute_batch_srun.py). Returns False
+    if unable to connect, in which case the file protocol is used."""
+    try:
+        sock = socket.create_connection(tuple(control_address), timeout=10)
+    except OSError:
+        traceback.print_exc()
+        print('WARNING: Unable to connect to control channel. Using files.')
+        return False
+    sock.settimeout(None)
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(msg: dict) -> None:
+        with send_lock:
+            sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+
+    def send_heartbeats() -> None:
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                send(dict(type='heartbeat'))
+            except OSError:
+                return
+
+    send(dict(type='hello', worker_num=worker_num, token=control_token))
+    # heartbeats continue while a job is running
+    threading.Thread(target=send_heartbeats, daemon=True).start()
+    buf = b''
+    try:
+        while True:
+            data = sock.recv(1024 * 1024)
+            if not data:
+                print('Control channel closed. Stopping worker.')
+                break
+            buf = buf + data
+            lines = buf.split(b'\n')
+            buf = lines[-1]
+            stop = False
+            for line in lines[:-1]:
+                if not line:
+                    continue
+                msg = json.loads(line.decode('utf-8'))
+                if msg['type'] == 'stop':
+                    print('Stopping worker.')
+                    stop = True
+                    break
+                elif msg['type'] == 'job':
+                    job = mlpr.MountainJob(job_object=msg['job'])
+                    result = job._execute(print_console_out=False)
+                    send(dict(type='result', result=result.getObject()))
+            if stop:
+                break
+    except:
+        # report the exception back to the parent process
+        try:
+            send(dict(type='error', traceback=traceback.format_exc()))
+        except OSError:
+            traceback.print_exc()
+    finally:
+        stopped.set()
+        sock.close()
+    return True
 
 
 class _SlurmProcess():
-    def __init__(self, working_dir: str, num_workers: int, additional_srun_opts: List[str], use_slurm: bool, time_limit: Optional[float], num_cores_per_job: int):
+    def __init__(self, working_dir: str, num_workers: int, additional_srun_opts: List[str], use_slurm: bool, time_limit: Optional[float], num_cores_per_job: int, control_address: Optional[Tuple[str, int]]=None, control_token: Optional[str]=None):
         """Constructor for a slurm process (corresponding to a batch)
 
         Parameters
@@ -603,8 +972,14 @@ class _SlurmProcess():
             The time limit in seconds for this slurm batch
         num_cores_per_job : int
             Number of cpu cores devoted to each job / worker
+        control_address : Optional[Tuple[str, int]]
+            The (host, port) of the control channel of the batch, or None to only use files
+        control_token : Optional[str]
+            The token that the workers send to the control channel
         """
         self._working_dir = working_dir
+        self._control_address = control_address
+        self._control_token = control_token
         self._num_workers = num_workers
         self._additional_srun_opts = additional_srun_opts
         self._use_slurm = use_slurm
@@ -632,6 +1007,8 @@ class _SlurmProcess():
                 working_dir = '{working_dir}'
                 num_workers = {num_workers}
                 running_fname = '{running_fname}'
+                control_address = {control_address}
+                control_token = {control_token}
 
                 # Let's claim a place and determine which worker number we are
                 worker_num = None
@@ -652,10 +1029,17 @@ class _SlurmProcess():
                 job_fname = working_dir + '/worker_{}_job.json'.format(worker_num)
                 result_fname = working_dir + '/worker_{}_result.json'.format(worker_num)
 
+                # Use the control channel if we can connect to it, otherwise the files
+                use_files = True
+                if control_address is not None:
+                    from mlprocessors.slurmjobhandler import _run_worker_with_control_channel
+                    if _run_worker_with_control_channel(control_address, control_token, worker_num):
+                        use_files = False
+
                 try:  # We are going to catch any exceptions and report them back to the parent process
                     num_found = 0
                     num_exceptions = 0
-                    while True:
+                    while use_files:
                         # Check whether running file exists
                         try:
                             with FileLock(running_fname + '.lock', exclusive=False):
@@ -705,7 +1089,11 @@ class _SlurmProcess():
         srun_py_script.substitute('{working_dir}', self._working_dir)
         srun_py_script.substitute('{num_workers}', self._num_workers)
         srun_py_script.substitute('{running_fname}', self._working_dir + '/running.txt')
+        srun_py_script.substitute('{control_address}', repr(self._control_address))
+        srun_py_script.substitute('{control_token}', repr(self._control_token))
         srun_py_script.write()
+        # the script contains the token of the control channel
+        os.chmod(srun_py_script.scriptPath(), 0o700)
 
         srun_opts = []
         srun_opts.extend(self._additional_srun_opts)
@@ -803,6 +1191,27 @@ class _SlurmProcess():
                     print('Warning: unable to stop slurm script.')
 
 
+def _estimate_job_duration(job: mlpr.MountainJob) -> Optional[float]:
+    """The expected duration of the job in seconds (from its compute
+    requirements, from a previous run of the same job, or predicted from
+    the runs of similar jobs), or None"""
+    job_object = job.getObject(copy=False)
+    expected_duration = job_object.get('compute_requirements', {}).get('expected_duration_sec', None)
+    if expected_duration is not None:
+        return float(expected_duration)
+    # The job may have run before (e.g., it failed, or it is forced to run)
+    try:
+        runtime_info_path = local_client.getValue(key=job.runtimeInfoSignature(), check_alt=True)
+        if runtime_info_path:
+            runtime_info = local_client.loadObject(path=runtime_info_path)
+            if runtime_info and (runtime_info.get('elapsed_sec', None) is not None):
+                return float(runtime_info['elapsed_sec'])
+    except:
+        traceback.print_exc()
+        print('WARNING: problem loading the runtime info of a previous run of job.')
+    return predict_job_duration(job_object)
+
+
 def _rmdir_with_retries(dirname, num_retries, delay_between_tries=1):
     for retry_num in range(1, num_retries + 1):
         if not os.path.exists(dirname):
@@ -0,0 +1,452 @@
+import fcntl
+import hashlib
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from typing import Optional, List, Dict, Tuple, Any
+from .shellscript import ShellScript
+
+# Warm workers: instead of starting a container (and a cold python) for
+# every job, a long-lived python process is started in the container, and
+# the jobs for that container are sent to it over a unix socket and run
+# in-process. The workers for a container (and environment) share a
+# directory, <warm workers dir>/<key>, with one slot per worker:
+#     w<i>.lock - held (flock) by the client using the worker
+#     w<i>.sock - the socket the worker listens on
+#     w<i>.sh, w<i>.log - the worker script and its log
+# The slots are shared by all processes on the machine (e.g., the job
+# processes of the ParallelJobHandler), and a worker exits after it has
+# been idle for a while.
+
+_WORKER_START_TIMEOUT = 300
+
+
+def warm_workers_enabled() -> bool:
+    """Whether containerized jobs run in warm workers (the
+    MLPROCESSORS_WARM_WORKERS environment variable)"""
+    return (os.environ.get('MLPROCESSORS_WARM_WORKERS', 'FALSE') == 'TRUE')
+
+
+def paths_are_visible_in_container(paths: List[str], singularity_opts: List[str]) -> bool:
+    binds = _get_binds(singularity_opts)
+    return all([_container_path(path, binds) is not None for path in paths])
+
+
+class WarmWorkerJob():
+    def __init__(self, *, container: str, singularity_opts: List[str], env_vars: List[str], code_dir: str, processor_class_name: str, attributes: dict, path_map: Dict[str, str], console_out_fname: str):
+        """A job run by a warm worker for the container, with the interface
+        of the ShellScript used to run the job in the container otherwise
+        (start, wait, isRunning, stop, returnCode,
+        elapsedTimeSinceStart).
+
+        Parameters
+        ----------
+        container : str
+            The path of the (realized) container image
+        singularity_opts : List[str]
+            The singularity options, without the job-specific binds
+        env_vars : List[str]
+            The environment variables for the worker (NAME=value)
+        code_dir : str
+            The directory containing the processor_source of the job
+        processor_class_name : str
+            The name of the processor class in processor_source
+        attributes : dict
+            The attributes to set on the processor
+        path_map : Dict[str, str]
+            The host paths of the paths that the attributes refer to
+            (e.g., /processor_outputs -> the temporary output directory).
+            They are translated to their paths in the worker container.
+        console_out_fname : str
+            The file for the console output of the job
+        """
+        self._container = container
+        self._singularity_opts = singularity_opts
+        self._env_vars = env_vars
+        self._code_dir = code_dir
+        self._processor_class_name = processor_class_name
+        self._attributes = attributes
+        self._path_map = path_map
+        self._console_out_fname = console_out_fname
+        self._key = _compute_worker_key(container, singularity_opts, env_vars)
+        self._worker_dir = os.path.join(_warm_workers_dir(), self._key)
+        self._slot: Optional[int] = None
+        self._lock_fd: Optional[int] = None
+        self._sock: Optional[socket.socket] = None
+        self._buf = b''
+        self._worker_pid: Optional[int] = None
+        self._retcode: Optional[int] = None
+        self._start_time: Optional[float] = None
+
+    def __del__(self):
+        self._release()
+
+    def start(self) -> None:
+        # raises if the job could not be sent to a worker, so that the
+        # caller can run the job in the usual way instead
+        request = self._create_request()
+        try:
+            self._acquire_slot()
+            self._sock, ack = self._send_request(request)
+        except:
+            self._release()
+            raise
+        self._worker_pid = ack['pid']
+        self._start_time = time.time()
+
+    def wait(self, timeout: Optional[float]=None) -> Optional[int]:
+        if self._retcode is not None:
+            return self._retcode
+        assert self._sock is not None, "Unexpected: self._sock is None even though the job is running."
+        timer = time.time()
+        while True:
+            remaining = None if timeout is None else max(timeout - (time.time() - timer), 0)
+            readable, _, _ = select.select([self._sock], [], [], remaining)
+            if not readable:
+                return None
+            data = self._sock.recv(4096)
+            if not data:
+                print('Warm worker exited while running job. See: {}'.format(self._log_path()))
+                self._retcode = -1
+                self._release()
+                return self._retcode
+            self._buf = self._buf + data
+            if b'\n' in self._buf:
+                response = json.loads(self._buf.split(b'\n')[0].decode('utf-8'))
+                self._retcode = response['retcode']
+                self._release()
+                return self._retcode
+
+    def isRunning(self) -> bool:
+        if self._start_time is None:
+            return False
+        return (self.wait(0) is None)
+
+    def stop(self) -> None:
+        if not self.isRunning():
+            return
+        # the worker is in the middle of the job, so it is killed (and a new
+        # one is started for the next job)
+        if self._worker_pid is not None:
+            try:
+                os.kill(self._worker_pid, signal.SIGKILL)
+            except:
+                print('Warning: unable to kill warm worker process {}'.format(self._worker_pid))
+        self._retcode = -1
+        self._release()
+
+    def returnCode(self) -> Optional[int]:
+        return self._retcode
+
+    def workerPid(self) -> Optional[int]:
+        return self._worker_pid
+
+    def elapsedTimeSinceStart(self) -> Optional[float]:
+        if self._start_time is None:
+            return None
+        return time.time() - self._start_time
+
+    def _create_request(self) -> dict:
+        binds = _get_binds(self._singularity_opts)
+        container_paths = dict()
+        for path0, host_path in self._path_map.items():
+            cpath = _container_path(host_path, binds)
+            if cpath is None:
+                raise Exception('Path is not visible in warm worker container: {}'.format(host_path))
+            container_paths[path0] = cpath
+        code_dir = _container_path(self._code_dir, binds)
+        console_out_fname = _container_path(self._console_out_fname, binds)
+        if (code_dir is None) or (console_out_fname is None):
+            raise Exception('Temporary directories are not visible in the warm worker container.')
+        return dict(
+            code_dir=code_dir,
+            processor_class_name=self._processor_class_name,
+            attributes=_map_paths(self._attributes, container_paths),
+            console_out_fname=console_out_fname
+        )
+
+    def _acquire_slot(self) -> None:
+        os.makedirs(self._worker_dir, exist_ok=True)
+        num_slots = int(os.environ.get('MLPROCESSORS_WARM_WORKERS_PER_IMAGE', os.cpu_count() or 1))
+        while True:
+            for slot in range(num_slots):
+                fd = _try_lock(self._slot_path(slot, '.lock'))
+                if fd is not None:
+                    self._slot = slot
+                    self._lock_fd = fd
+                    return
+            time.sleep(0.1)
+
+    def _send_request(self, request: dict) -> Tuple[socket.socket, dict]:
+        for _ in range(2):
+            sock = _try_connect(self._slot_path(self._slot, '.sock'))
+            if sock is None:
+                sock = self._start_worker()
+            try:
+                _send_json_line(sock, request)
+                ack = _recv_json_line(sock)
+            except OSError:
+                ack = None
+            if ack is not None:
+                return sock, ack
+            # the worker exited before taking the job (e.g., it was idle
+            # for too long)
+            sock.close()
+            _remove_file(self._slot_path(self._slot, '.sock'))
+        raise Exception('Unable to send job to warm worker.')
+
+    def _start_worker(self) -> socket.socket:
+        socket_path = self._slot_path(self._slot, '.sock')
+        lock_path = self._slot_path(self._slot, '.lock')
+        _remove_file(socket_path)
+        singularity_opts = list(self._singularity_opts)
+        if _container_path(self._worker_dir, _get_binds(singularity_opts)) != self._worker_dir:
+            singularity_opts.append('-B {}:{}'.format(self._worker_dir, self._worker_dir))
+        idle_timeout = float(os.environ.get('MLPROCESSORS_WARM_WORKER_IDLE_TIMEOUT', 600))
+        max_jobs = int(os.environ.get('MLPROCESSORS_WARM_WORKER_MAX_JOBS', 100))
+        worker_sh_script = ShellScript("""
+            #!/bin/bash
+            set -e
+
+            {env_vars}
+
+            exec python3 -m mlprocessors.warmworkers {socket_path} {lock_path} {idle_timeout} {max_jobs}
+        """, script_path=self._slot_path(self._slot, '.sh'))
+        worker_sh_script.substitute('{env_vars}', '\n'.join(['export ' + env_var for env_var in self._env_vars]))
+        worker_sh_script.substitute('{socket_path}', socket_path)
+        worker_sh_script.substitute('{lock_path}', lock_path)
+        worker_sh_script.substitute('{idle_timeout}', idle_timeout)
+        worker_sh_script.substitute('{max_jobs}', max_jobs)
+        worker_sh_script.write()
+        cmd = 'singularity exec {} {} bash {}'.format(' '.join(singularity_opts), self._container, self._slot_path(self._slot, '.sh'))
+        print('Starting warm worker: {}'.format(cmd))
+        with open(self._log_path(), 'a') as log_file:
+            # in its own session, so that it outlives the process of this job
+            process = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+        timer = time.time()
+        while True:
+            sock = _try_connect(socket_path)
+            if sock is not None:
+                return sock
+            if process.poll() is not None:
+                raise Exception('Warm worker exited with code {}. See: {}'.format(process.returncode, self._log_path()))
+            if time.time() - timer > _WORKER_START_TIMEOUT:
+                process.kill()
+                raise Exception('Timeout while starting warm worker. See: {}'.format(self._log_path()))
+            time.sleep(0.1)
+
+    def _release(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _slot_path(self, slot: Optional[int], ext: str) -> str:
+        assert slot is not None
+        return os.path.join(self._worker_dir, 'w{}{}'.format(slot, ext))
+
+    def _log_path(self) -> str:
+        return self._slot_path(self._slot, '.log')
+
+
+def _warm_workers_dir() -> str:
+    dirname = os.environ.get('MLPROCESSORS_WARM_WORKERS_DIR', None)
+    if dirname:
+        return dirname
+    # short, because of the limit on the length of socket paths
+    return os.path.join(tempfile.gettempdir(), 'mlpr_warm_{}'.format(os.getuid()))
+
+
+def _compute_worker_key(container: str, singularity_opts: List[str], env_vars: List[str]) -> str:
+    txt = json.dumps(dict(container=container, singularity_opts=singularity_opts, env_vars=env_vars), sort_keys=True)
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()[:12]
+
+
+def _get_binds(singularity_opts: List[str]) -> List[Tuple[str, str]]:
+    # [(host path, container path), ...] from the -B options
+    binds = []
+    for opt in singularity_opts:
+        if opt.startswith('-B '):
+            vals = opt[3:].strip().split(':')
+            if len(vals) >= 2:
+                binds.append((os.path.abspath(vals[0]), vals[1]))
+    return binds
+
+
+def _container_path(host_path: str, binds: List[Tuple[str, str]]) -> Optional[str]:
+    host_path = os.path.abspath(host_path)
+    best: Optional[Tuple[str, str]] = None
+    for hp, cp in binds:
+        if (host_path == hp) or host_path.startswith(hp.rstrip('/') + '/'):
+            if (best is None) or (len(hp) > len(best[0])):
+                best = (hp, cp)
+    if best is None:
+        return None
+    return best[1] + host_path[len(best[0]):]
+
+
+def _map_paths(val: Any, paths: Dict[str, str]) -> Any:
+    if type(val) == str:
+        for path0, path1 in paths.items():
+            if val == path0:
+                return path1
+            if val.startswith(path0 + '/'):
+                return path1 + val[len(path0):]
+        return val
+    elif type(val) == list:
+        return [_map_paths(v, paths) for v in val]
+    elif type(val) == dict:
+        return {k: _map_paths(v, paths) for k, v in val.items()}
+    else:
+        return val
+
+
+def _try_lock(path: str) -> Optional[int]:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _try_connect(socket_path: str) -> Optional[socket.socket]:
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _send_json_line(sock: socket.socket, obj: dict) -> None:
+    sock.sendall((json.dumps(obj) + '\n').encode('utf-8'))
+
+
+def _recv_json_line(sock: socket.socket) -> Optional[dict]:
+    buf = b''
+    while b'\n' not in buf:
+        data = sock.recv(4096)
+        if not data:
+            return None
+        buf = buf + data
+    return json.loads(buf.split(b'\n')[0].decode('utf-8'))
+
+
+# The following runs in the container
+
+
+def _run_worker(socket_path: str, lock_path: str, idle_timeout: float, max_jobs: int) -> None:
+    _remove_file(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    server.settimeout(idle_timeout)
+    print('Warm worker {} listening on {}'.format(os.getpid(), socket_path))
+    num_jobs = 0
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            # only exit if no client holds the slot (it may be about to connect)
+            if _try_lock(lock_path) is not None:
+                print('Warm worker {} exiting after being idle for {} sec'.format(os.getpid(), idle_timeout))
+                _remove_file(socket_path)
+                return
+            continue
+        with conn:
+            conn.settimeout(None)
+            request = _recv_json_line(conn)
+            if request is None:
+                continue
+            _send_json_line(conn, dict(pid=os.getpid()))
+            retcode = _run_job_in_worker(request)
+            num_jobs = num_jobs + 1
+            if num_jobs >= max_jobs:
+                # stop taking jobs before responding, so that the next job
+                # goes to a new worker
+                _remove_file(socket_path)
+                server.close()
+            try:
+                _send_json_line(conn, dict(retcode=retcode))
+            except OSError:
+                pass
+        if num_jobs >= max_jobs:
+            print('Warm worker {} exiting after {} jobs'.format(os.getpid(), num_jobs))
+            return
+
+
+def _run_job_in_worker(request: dict) -> int:
+    code_dir = request['code_dir']
+    processor_class_name = request['processor_class_name']
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    saved_cwd = os.getcwd()
+    saved_sys_path = list(sys.path)
+    # the console output (of python and of any subprocesses) goes to the
+    # console out file of the job, as with "python3 run.py > ... 2>&1"
+    with open(request['console_out_fname'], 'w') as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            sys.path.insert(0, code_dir)
+            sys.path.insert(0, os.path.join(code_dir, 'processor_source', '_local_modules'))
+            importlib.invalidate_caches()
+            module = importlib.import_module('processor_source')
+            print('Running processor (class={}) ...'.format(processor_class_name))
+            X = getattr(module, processor_class_name)()
+            for attr_name, attr_val in request['attributes'].items():
+                setattr(X, attr_name, attr_val)
+            X.run()
+            retcode = 0
+        except:
+            traceback.print_exc()
+            retcode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            sys.path[:] = saved_sys_path
+            os.chdir(saved_cwd)
+            _unload_job_modules(code_dir)
+    return retcode
+
+
+def _unload_job_modules(code_dir: str) -> None:
+    # the modules of the job (the processor source and its local modules)
+    # are imported fresh for the next job, while the others (numpy, etc.)
+    # stay loaded
+    prefix = os.path.abspath(code_dir) + '/'
+    for name, module in list(sys.modules.items()):
+        fname = getattr(module, '__file__', None) or ''
+        if (name == 'processor_source') or name.startswith('processor_source.') or (fname and os.path.abspath(fname).startswith(prefix)):
+            del sys.modules[name]
+
+
+if __name__ == '__main__':
+    _run_worker(sys.argv[1], sys.argv[2], float(sys.argv[3]), int(sys.argv[4]))
@@ -0,0 +1,218 @@
+import bisect
+import hashlib
+import json
+import os
+import random
+from typing import Optional, List
+import numpy as np
+
+# Content-defined chunking: a gear hash over a window of the last 32 bytes is
+# computed at every position, and a chunk ends where the high bits of the hash
+# are zero. Boundaries depend only on the nearby content, so they line up
+# again in files that share data at different offsets (e.g., a time range of
+# a recording, or a file with a few blocks changed).
+_GEAR = np.random.RandomState(4729).randint(0, 2**32, size=256, dtype=np.uint64).astype(np.uint32)
+_WINDOW_SIZE = 32
+_READ_SIZE = 1024 * 1024 * 16
+
+
+def default_chunking() -> Optional[str]:
+    """The chunking method for files added to the SHA-1 cache: 'cdc'
+    (content-defined), 'fixed', or None (whole files), from the
+    SHA1_CACHE_CHUNKING environment variable"""
+    val = os.environ.get('SHA1_CACHE_CHUNKING', None)
+    if not val:
+        return None
+    if val not in ['cdc', 'fixed']:
+        raise Exception('Invalid SHA1_CACHE_CHUNKING: {}'.format(val))
+    return val
+
+
+def default_chunk_size() -> int:
+    return int(os.environ.get('SHA1_CACHE_CHUNK_SIZE', 1024 * 1024 * 4))
+
+
+def compute_chunk_boundaries(path: str, *, method: str='cdc', chunk_size: Optional[int]=None) -> List[int]:
+    """The end offsets of the chunks of the file (the last one is the file
+    size). For 'cdc' chunk_size is the average size, and chunks are between
+    chunk_size / 4 and chunk_size * 4 bytes."""
+    if chunk_size is None:
+        chunk_size = default_chunk_size()
+    size = os.path.getsize(path)
+    if method == 'fixed':
+        return list(range(chunk_size, size, chunk_size)) + [size]
+    if method != 'cdc':
+        raise Exception('Invalid chunking method: {}'.format(method))
+    min_size = max(chunk_size // 4, _WINDOW_SIZE)
+    max_size = chunk_size * 4
+    num_bits = max(int(round(np.log2(chunk_size))), 1)
+    mask = np.uint32(((1 << num_bits) - 1) << (32 - num_bits))
+    candidates: List[int] = []
+    with open(path, 'rb') as f:
+        offset = 0
+        prev_tail = np.zeros((0,), dtype=np.uint8)
+        while offset < size:
+            data = np.frombuffer(f.read(_READ_SIZE), dtype=np.uint8)
+            if len(data) == 0:
+                break
+            # include the tail of the previous block so that the windows span blocks
+            buf = np.concatenate((prev_tail, data))
+            # hh[i] = sum_k gear[buf[i - k]] << k for k < w, with the window w
+            # doubled at each step (5 vectorized passes for w = 32)
+            hh = _GEAR[buf]
+            w = 1
+            while w < _WINDOW_SIZE:
+                hh[w:] += hh[:-w] << np.uint32(w)
+                w = w * 2
+            inds = np.nonzero((hh[len(prev_tail):] & mask) == 0)[0]
+            # a chunk ends after the byte where the hash matches
+            candidates.extend((offset + inds + 1).tolist())
+            prev_tail = buf[-(_WINDOW_SIZE - 1):]
+            offset = offset + len(data)
+    boundaries: List[int] = []
+    last = 0
+    for c in candidates:
+        while c - last > max_size:
+            last = last + max_size
+            boundaries.append(last)
+        if (c - last >= min_size) and (c < size):
+            boundaries.append(c)
+            last = c
+    while size - last > max_size:
+        last = last + max_size
+        boundaries.append(last)
+    if (size > last) or (size == 0):
+        boundaries.append(size)
+    return boundaries
+
+
+class ChunkStore():
+    def __init__(self, sha1_cache):
+        """Chunk-level storage in a SHA-1 cache.
+
+        A file is stored as chunks (each of which is an ordinary file of the
+        cache, named by its own sha1) and a manifest,
+        <path of file>.chunks.json, listing the chunks. Chunks that are shared
+        between files are only stored once.
+        """
+        self._sha1_cache = sha1_cache
+
+    def storeFile(self, path: str, *, sha1: str, method: str='cdc', chunk_size: Optional[int]=None) -> dict:
+        """Store the file (whose sha1 is known) as chunks and return the manifest"""
+        manifest = self.loadManifest(sha1)
+        if manifest and self.manifestIsComplete(manifest):
+            return manifest
+        boundaries = compute_chunk_boundaries(path, method=method, chunk_size=chunk_size)
+        chunks = []
+        with open(path, 'rb') as f:
+            last = 0
+            for b in boundaries:
+                data = f.read(b - last)
+                chunk_sha1 = hashlib.sha1(data).hexdigest()
+                chunk_path = self._sha1_cache._get_path(chunk_sha1, create=True)
+                if not os.path.exists(chunk_path):
+                    _write_file_atomically(chunk_path, data)
+                self._sha1_cache.manager().recordAccess(chunk_sha1)
+                chunks.append([chunk_sha1, b - last])
+                last = b
+        manifest = dict(sha1=sha1, size=last, method=method, chunks=chunks)
+        _write_file_atomically(self._manifest_path(sha1, create=True), json.dumps(manifest).encode('utf-8'))
+        return manifest
+
+    def loadManifest(self, sha1: str) -> Optional[dict]:
+        path = self._manifest_path(sha1, create=False)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+        except:
+            return None
+        if manifest.get('sha1', None) != sha1:
+            return None
+        return manifest
+
+    def manifestIsComplete(self, manifest: dict) -> bool:
+        return all([self._find_chunk(chunk_sha1) is not None for chunk_sha1, _ in manifest['chunks']])
+
+    def readRange(self, sha1: str, start: int, end: int) -> Optional[bytes]:
+        """Read bytes [start, end) of a chunked file from its chunks (only
+        the chunks that overlap the range are read)"""
+        manifest = self.loadManifest(sha1)
+        if manifest is None:
+            return None
+        end = min(end, manifest['size'])
+        if start >= end:
+            return b''
+        offsets = _chunk_end_offsets(manifest)
+        ii = bisect.bisect_right(offsets, start)
+        parts = []
+        pos = start
+        while pos < end:
+            chunk_sha1, chunk_size = manifest['chunks'][ii]
+            chunk_start = offsets[ii] - chunk_size
+            chunk_path = self._find_chunk(chunk_sha1)
+            if chunk_path is None:
+                return None
+            with open(chunk_path, 'rb') as f:
+                f.seek(pos - chunk_start)
+                parts.append(f.read(min(end, offsets[ii]) - pos))
+            self._sha1_cache.manager().recordAccess(chunk_sha1)
+            pos = min(end, offsets[ii])
+            ii = ii + 1
+        return b''.join(parts)
+
+    def reassemble(self, sha1: str, target_path: str) -> Optional[str]:
+        """Write the chunked file to target_path, checking its sha1"""
+        manifest = self.loadManifest(sha1)
+        if (manifest is None) or (not self.manifestIsComplete(manifest)):
+            return None
+        tmp_path = target_path + '.copying.' + _random_string(6)
+        hh = hashlib.sha1()
+        with open(tmp_path, 'wb') as f:
+            for chunk_sha1, _ in manifest['chunks']:
+                chunk_path = self._find_chunk(chunk_sha1)
+                if chunk_path is None:
+                    f.close()
+                    os.remove(tmp_path)
+                    return None
+                with open(chunk_path, 'rb') as f2:
+                    data = f2.read()
+                hh.update(data)
+                f.write(data)
+        if hh.hexdigest() != sha1:
+            os.remove(tmp_path)
+            raise Exception('Unexpected sha1 of file reassembled from chunks: {} <> {}'.format(hh.hexdigest(), sha1))
+        os.replace(tmp_path, target_path)
+        return target_path
+
+    def _find_chunk(self, chunk_sha1: str) -> Optional[str]:
+        path, alternate_paths = self._sha1_cache._get_path_ext(chunk_sha1, create=False, return_alternates=True)
+        for path0 in [path] + alternate_paths:
+            if os.path.exists(path0):
+                return path0
+        return None
+
+    def _manifest_path(self, sha1: str, *, create: bool) -> str:
+        return self._sha1_cache._get_path(sha1, create=create) + '.chunks.json'
+
+
+def _chunk_end_offsets(manifest: dict) -> List[int]:
+    ret = []
+    offset = 0
+    for _, size in manifest['chunks']:
+        offset = offset + size
+        ret.append(offset)
+    return ret
+
+
+def _write_file_atomically(path: str, data: bytes) -> None:
+    tmp_path = path + '.copying.' + _random_string(6)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _random_string(num_chars: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(random.choice(chars) for _ in range(num_chars))
@@ -0,0 +1,350 @@
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+from .filelock import FileLock
+from .aux import _read_text_file, _write_text_file
+
+
+class LocalDatabaseFiles():
+    def __init__(self, path: str):
+        """The original local database layout: one .txt file (plus a .lock
+        file) per key, and one directory per key for the subkeys.
+
+        Parameters
+        ----------
+        path : str
+            The database directory
+        """
+        self._path = path
+
+    def path(self) -> str:
+        return self._path
+
+    def getValue(self, keyhash: str, subkey: Optional[str]=None, _disable_lock: bool=False) -> Optional[str]:
+        if subkey is not None:
+            subkey_db_path = self._subkey_dir(keyhash, _create=False)
+            fname0 = os.path.join(subkey_db_path, subkey + '.txt')
+            if not os.path.exists(fname0):
+                return None
+            with FileLock(subkey_db_path + '.lock', _disable_lock=_disable_lock, exclusive=False):
+                return _read_text_file(fname0)
+        else:
+            fname0 = self._file_path(keyhash, _create=False)
+            if not os.path.exists(fname0):
+                return None
+            with FileLock(fname0 + '.lock', _disable_lock=_disable_lock, exclusive=False):
+                return _read_text_file(fname0)
+
+    def getValues(self, keyhashes: List[str], _disable_lock: bool=False) -> Dict[str, str]:
+        ret = dict()
+        for keyhash in keyhashes:
+            val = self.getValue(keyhash, _disable_lock=_disable_lock)
+            if val is not None:
+                ret[keyhash] = val
+        return ret
+
+    def setValue(self, keyhash: str, subkey: Optional[str], value: Optional[str], overwrite: bool) -> bool:
+        if subkey is not None:
+            subkey_db_path = self._subkey_dir(keyhash, _create=True)
+            fname0 = os.path.join(subkey_db_path, subkey + '.txt')
+            if os.path.exists(fname0):
+                if not overwrite:
+                    return False
+            with FileLock(subkey_db_path + '.lock', exclusive=True):
+                if os.path.exists(fname0):
+                    if not overwrite:
+                        return False
+                if value is None:
+                    os.unlink(fname0)
+                else:
+                    # _write_text_file_safe(fname0, value)
+                    _write_text_file(fname0, value)
+        else:
+            fname0 = self._file_path(keyhash, _create=True)
+            if os.path.exists(fname0):
+                if not overwrite:
+                    return False
+            with FileLock(fname0 + '.lock', exclusive=True):
+                if os.path.exists(fname0):
+                    if not overwrite:
+                        return False
+                if value is None:
+                    if os.path.exists(fname0):
+                        os.unlink(fname0)
+                else:
+                    _write_text_file(fname0, value)
+        return True
+
+    def setValues(self, items: List[Tuple[str, Optional[str]]], overwrite: bool) -> List[bool]:
+        return [self.setValue(keyhash, None, value, overwrite) for keyhash, value in items]
+
+    def deleteSubKeys(self, keyhash: str) -> None:
+        subkey_db_path = self._subkey_dir(keyhash, _create=True)
+        with FileLock(subkey_db_path + '.lock', exclusive=True):
+            shutil.rmtree(subkey_db_path)
+
+    def getSubKeys(self, keyhash: str) -> Optional[List[str]]:
+        subkey_db_path = self._subkey_dir(keyhash, _create=False)
+        if not os.path.exists(subkey_db_path):
+            return []
+        ret = []
+        with FileLock(subkey_db_path + '.lock', exclusive=False):
+            list0 = _safe_list_dir(subkey_db_path)
+            if list0 is None:
+                return None
+            for name0 in list0:
+                if name0.endswith('.txt'):
+                    ret.append(name0[0:-4])
+        return ret
+
+    def getAllSubKeyValues(self, keyhash: str) -> Optional[Dict[str, str]]:
+        subkeys = self.getSubKeys(keyhash)
+        if subkeys is None:
+            return None
+        ret = dict()
+        for subkey in subkeys:
+            val = self.getValue(keyhash, subkey)
+            if val is not None:
+                ret[subkey] = val
+        return ret
+
+    def iterateItems(self):
+        """Yield (keyhash, subkey, value) for all entries (subkey is None for
+        values that are not subkeys). Used for migration and by the cleanup
+        of the SHA-1 cache."""
+        for name1 in sorted(_safe_list_dir(self._path) or []):
+            path1 = os.path.join(self._path, name1)
+            for name2 in sorted(_safe_list_dir(path1) or []):
+                path2 = os.path.join(path1, name2)
+                for name3 in sorted(_safe_list_dir(path2) or []):
+                    path3 = os.path.join(path2, name3)
+                    if name3.endswith('.lock'):
+                        continue
+                    if name3.endswith('.dir'):
+                        keyhash = name3[0:-4]
+                        for name4 in sorted(_safe_list_dir(path3) or []):
+                            if name4.endswith('.txt'):
+                                val = self.getValue(keyhash, name4[0:-4])
+                                if val is not None:
+                                    yield (keyhash, name4[0:-4], val)
+                    elif os.path.isfile(path3):
+                        val = self.getValue(name3)
+                        if val is not None:
+                            yield (name3, None, val)
+
+    def _file_path(self, keyhash: str, *, _create: bool) -> str:
+        path = os.path.join(self._path, keyhash[0:2], keyhash[2:4])
+        if _create:
+            _make_dirs(path)
+        return os.path.join(path, keyhash)
+
+    def _subkey_dir(self, keyhash: str, *, _create: bool) -> str:
+        path = os.path.join(self._path, keyhash[0:2], keyhash[2:4], keyhash + '.dir')
+        if _create:
+            _make_dirs(path)
+        return path
+
+
+class LocalDatabaseSqlite():
+    def __init__(self, path: str):
+        """Local database in a single SQLite file, so that there are no
+        per-key files and lock files. The rollback journal (not WAL) is used,
+        since the mountain directory is often on a network file system.
+
+        Parameters
+        ----------
+        path : str
+            The database directory. The SQLite file is <path>.sqlite
+        """
+        self._path = path
+        self._fname = path + '.sqlite'
+        self._local = threading.local()
+        self._initialized = False
+
+    def path(self) -> str:
+        return self._path
+
+    @staticmethod
+    def existsFor(path: str) -> bool:
+        return os.path.exists(path + '.sqlite')
+
+    def getValue(self, keyhash: str, subkey: Optional[str]=None, _disable_lock: bool=False) -> Optional[str]:
+        conn = self._conn()
+        if subkey is not None:
+            row = conn.execute('SELECT value FROM subkey_values WHERE keyhash=? AND subkey=?', (keyhash, subkey)).fetchone()
+        else:
+            row = conn.execute('SELECT value FROM key_values WHERE keyhash=?', (keyhash,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def getValues(self, keyhashes: List[str], _disable_lock: bool=False) -> Dict[str, str]:
+        conn = self._conn()
+        ret = dict()
+        batch_size = 500  # stay well below the max number of sql variables
+        for ii in range(0, len(keyhashes), batch_size):
+            batch = keyhashes[ii:ii + batch_size]
+            rows = conn.execute(
+                'SELECT keyhash, value FROM key_values WHERE keyhash IN ({})'.format(','.join(['?'] * len(batch))),
+                batch
+            ).fetchall()
+            for keyhash, value in rows:
+                ret[keyhash] = value
+        return ret
+
+    def setValue(self, keyhash: str, subkey: Optional[str], value: Optional[str], overwrite: bool) -> bool:
+        conn = self._conn()
+        with conn:
+            return self._set_value(conn, keyhash, subkey, value, overwrite)
+
+    def setValues(self, items: List[Tuple[str, Optional[str]]], overwrite: bool) -> List[bool]:
+        # all in a single transaction
+        conn = self._conn()
+        with conn:
+            return [self._set_value(conn, keyhash, None, value, overwrite) for keyhash, value in items]
+
+    def deleteSubKeys(self, keyhash: str) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM subkey_values WHERE keyhash=?', (keyhash,))
+
+    def getSubKeys(self, keyhash: str) -> Optional[List[str]]:
+        conn = self._conn()
+        rows = conn.execute('SELECT subkey FROM subkey_values WHERE keyhash=?', (keyhash,)).fetchall()
+        return [row[0] for row in rows]
+
+    def getAllSubKeyValues(self, keyhash: str) -> Optional[Dict[str, str]]:
+        conn = self._conn()
+        rows = conn.execute('SELECT subkey, value FROM subkey_values WHERE keyhash=?', (keyhash,)).fetchall()
+        return dict([(row[0], row[1]) for row in rows])
+
+    def iterateItems(self):
+        """Yield (keyhash, subkey, value) for all entries (subkey is None for
+        values that are not subkeys)"""
+        conn = self._conn()
+        for keyhash, value in conn.execute('SELECT keyhash, value FROM key_values'):
+            yield (keyhash, None, value)
+        for keyhash, subkey, value in conn.execute('SELECT keyhash, subkey, value FROM subkey_values'):
+            yield (keyhash, subkey, value)
+
+    def importItems(self, items, overwrite: bool=False) -> int:
+        """Insert (keyhash, subkey, value) items (e.g., from
+        LocalDatabaseFiles.iterateItems()). Returns the number of items."""
+        conn = self._conn()
+        num = 0
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= 1000:
+                num = num + self._import_batch(conn, batch, overwrite)
+                batch = []
+        num = num + self._import_batch(conn, batch, overwrite)
+        return num
+
+    def _import_batch(self, conn, batch, overwrite: bool) -> int:
+        with conn:
+            for keyhash, subkey, value in batch:
+                self._set_value(conn, keyhash, subkey, value, overwrite)
+        return len(batch)
+
+    def _set_value(self, conn, keyhash: str, subkey: Optional[str], value: Optional[str], overwrite: bool) -> bool:
+        if subkey is not None:
+            table, where, params = 'subkey_values', 'keyhash=? AND subkey=?', (keyhash, subkey)
+        else:
+            table, where, params = 'key_values', 'keyhash=?', (keyhash,)
+        if value is None:
+            if not overwrite:
+                if conn.execute('SELECT 1 FROM {} WHERE {}'.format(table, where), params).fetchone() is not None:
+                    return False
+            conn.execute('DELETE FROM {} WHERE {}'.format(table, where), params)
+            return True
+        columns = 'keyhash, subkey, value' if subkey is not None else 'keyhash, value'
+        placeholders = '?, ?, ?' if subkey is not None else '?, ?'
+        if overwrite:
+            conn.execute('INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(table, columns, placeholders), params + (value,))
+            return True
+        cursor = conn.execute('INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(table, columns, placeholders), params + (value,))
+        return cursor.rowcount == 1
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per thread and per process (connections must not be shared across a fork)
+        conn = getattr(self._local, 'conn', None)
+        if (conn is not None) and (getattr(self._local, 'pid', None) == os.getpid()):
+            return conn
+        _make_dirs(os.path.dirname(os.path.abspath(self._fname)))
+        conn = sqlite3.connect(self._fname, timeout=60, isolation_level='DEFERRED')
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=DELETE')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS key_values (keyhash TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+                conn.execute('CREATE TABLE IF NOT EXISTS subkey_values (keyhash TEXT NOT NULL, subkey TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (keyhash, subkey)) WITHOUT ROWID')
+            self._initialized = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+
+_local_database_backends = dict(
+    files=LocalDatabaseFiles,
+    sqlite=LocalDatabaseSqlite
+)
+
+
+def open_local_database(path: str, backend: Optional[str]=None):
+    """Open the local database at path.
+
+    Parameters
+    ----------
+    path : str
+        The database directory (e.g., ~/.mountain/database)
+    backend : Optional[str], optional
+        'files' or 'sqlite'. By default, sqlite is used if <path>.sqlite
+        exists and files otherwise.
+    """
+    if backend is None:
+        if LocalDatabaseSqlite.existsFor(path):
+            backend = 'sqlite'
+        else:
+            backend = 'files'
+    if backend not in _local_database_backends:
+        raise Exception('Unknown local database backend: {}'.format(backend))
+    return _local_database_backends[backend](path)
+
+
+def migrate_local_database(*, path: str, verbose: bool=False) -> int:
+    """Copy all values of the directory (files) database at path into the
+    SQLite database at <path>.sqlite, which is then used by default. Values
+    that are already in the SQLite database are kept, and the directory
+    database is left in place.
+
+    Returns the number of values copied.
+    """
+    src = LocalDatabaseFiles(path)
+    dest = LocalDatabaseSqlite(path)
+
+    def items():
+        for ii, item in enumerate(src.iterateItems()):
+            if verbose and (ii % 10000 == 0) and (ii > 0):
+                print('Migrated {} values...'.format(ii))
+            yield item
+    return dest.importItems(items())
+
+
+def _make_dirs(path: str) -> None:
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except:
+            if not os.path.exists(path):
+                raise Exception(
+                    'Unexpected problem. Unable to create directory: ' + path)
+
+
+def _safe_list_dir(path: str) -> Optional[List[str]]:
+    try:
+        ret = os.listdir(path)
+        return ret
+    except:
+        return None
@@ -4,15 +4,17 @@ import os
 import sys
 import requests
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from .mountainremoteclient import MountainRemoteClient
-from .mountainremoteclient import _http_get_json
+from .mountainremoteclient import _http_get_json, _http_post_json, _servers_without_batch_support, _MAX_BATCH_SIZE
 import time
 import mtlogging
 from .aux import _read_text_file, _sha1_of_object, _create_temporary_fname
 from .aux import deprecated
-from typing import Union, List, Any, Optional, Tuple
+from typing import Union, List, Any, Optional, Tuple, Dict
 from .mttyping import StrOrStrList, StrOrDict
 from .mountainclientlocal import MountainClientLocal
+from .steady_download_and_compute_sha1 import ByteRateLimiter
 
 env_path = os.path.join(os.environ.get('HOME', ''), '.mountaintools', '.env')
 if os.path.exists(env_path):
@@ -158,6 +160,7 @@ class MountainClient():
         self._values_by_alias = dict()
         self._config_download_from = []
         self._local_db = MountainClientLocal(parent=self)
+        self._remote_urls_by_sha1: Dict[str, str] = dict()  # for readFileBytes
 
         self._initialize_kacheries()
         self._read_pairio_tokens()
@@ -272,6 +275,53 @@ class MountainClient():
         """
         return self._set_value(key=key, subkey=subkey, value=value, overwrite=overwrite, collection=collection)
 
+    @mtlogging.log(name='MountainClient:getValues')
+    def getValues(self, *, keys: List[StrOrDict], collection: Optional[str]=None, check_alt: bool=False) -> List[Optional[str]]:
+        """
+        Batch version of getValue() (without subkeys). For the local database
+        with the sqlite backend, this is a single query. For a remote
+        collection, the keys are retrieved in batched requests.
+
+        Parameters
+        ----------
+        keys : list of str or dict
+            The keys used to look up the values
+        collection : str, optional
+            The name of the remote collection to retrieve the values from. The
+            default is None, which means that the local database is used.
+        check_alt : bool, optional
+            Whether to check alternate locations [may be deprecated soon]
+
+        Returns
+        -------
+        list of (str or None)
+            The values, in the order of the keys (None for keys not found)
+        """
+        if collection:
+            return self._remote_client.getValues(keys=[(key, None) for key in keys], collection=collection, url=self._pairio_url)
+        return self._local_db.getValues(keys=keys, check_alt=check_alt)
+
+    @mtlogging.log(name='MountainClient:setValues')
+    def setValues(self, *, items: List[Tuple[StrOrDict, Union[str, None]]], overwrite: bool=True) -> List[bool]:
+        """
+        Batch version of setValue() for the local key/value database (without
+        subkeys). With the sqlite backend, all values are set in a single
+        transaction.
+
+        Parameters
+        ----------
+        items : list of (key, value) tuples
+            The keys and the values to store (value=None removes the key)
+        overwrite : bool, optional
+            Whether to overwrite existing entries (the default is True)
+
+        Returns
+        -------
+        list of bool
+            Whether each value was set
+        """
+        return self._local_db.setValues(items=items, overwrite=overwrite)
+
     @mtlogging.log(name='MountainClient:getSubKeys')
     def getSubKeys(self, key: StrOrDict, collection: str=None) -> Optional[List[str]]:
         """
@@ -588,6 +638,51 @@ class MountainClient():
         else:
             raise Exception('Missing key or path in realizeFile().')
 
+    @mtlogging.log(name='MountainClient:realizeFiles')
+    def realizeFiles(self, paths: List[str], *,
+                     show_progress: bool=False,
+                     download_from: Optional[StrOrStrList]=None,
+                     local_only: bool=False,
+                     remote_only: bool=False,
+                     max_concurrency: int=8,
+                     max_bytes_per_sec: Optional[float]=None) -> List[Optional[str]]:
+        """
+        Batch version of realizeFile(). Return local paths to the specified
+        files, downloading files from the remote servers to the local SHA-1
+        cache as needed.
+
+        Files with the same SHA-1 hash are only looked up and downloaded once.
+        The files that are not in the local SHA-1 cache are looked up on all
+        the kacheries concurrently, and are then downloaded in parallel.
+
+        Parameters
+        ----------
+        paths : list of str
+            The paths of the files to realize, as described in the docs for
+            realizeFile()
+        show_progress : bool, optonal
+            If True, displays information about the files being copied
+        download_from : str, optional
+            If present, points to the kachery server to download the files
+            from. If not present, the configured kacheries will be used.
+        local_only : bool, optional
+            If True, only search for the files locally (default False)
+        remote_only : bool, optional
+            If True, only search for the files remotely (default False)
+        max_concurrency : int, optional
+            The maximum number of concurrent requests and downloads (default 8)
+        max_bytes_per_sec : float, optional
+            If present, the total download rate is limited to this budget
+
+        Returns
+        -------
+        list of (str or None)
+            The local file paths, in the order of the input paths (None for
+            files that were not found)
+        """
+        return self._realize_files(paths=paths, show_progress=show_progress, download_from=download_from, local_only=local_only,
+                                   remote_only=remote_only, max_concurrency=max_concurrency, max_bytes_per_sec=max_bytes_per_sec)
+
     @mtlogging.log(name='MountainClient:saveFile')
     def saveFile(self, path: Optional[str]=None, *,
                  key: Optional[StrOrDict]=None,
@@ -952,6 +1047,60 @@ class MountainClient():
         ret = _sha1_of_object(dd)
         return ret
 
+    def readFileBytes(self, path: str, *, start: int, end: int, local_only: bool=False) -> Optional[bytes]:
+        """Read a range of bytes of a local or remote file.
+
+        Files in the local SHA-1 cache that are stored as chunks (see the
+        SHA1_CACHE_CHUNKING environment variable) are read from the chunks
+        that overlap the range, without being reassembled.
+
+        Remote files (on a kachery, or http:// and https:// urls) are not
+        downloaded in full. The blocks that contain the range (plus some
+        readahead for sequential reads) are downloaded with range requests
+        and kept in a sparse file in the local cache, so they are only
+        transferred once. A sha1:// file is moved to the SHA-1 cache when
+        all of its blocks have been read. See the MOUNTAIN_RANGE_BLOCK_SIZE
+        and MOUNTAIN_RANGE_READAHEAD environment variables.
+
+        Parameters
+        ----------
+        path : str
+            The path to a local file or a sha1:// or sha1dir:// URI.
+        start : int
+            The offset of the first byte
+        end : int
+            The offset after the last byte
+        local_only : bool, optional
+            If True, only read the file if it is available locally (default
+            False)
+
+        Returns
+        -------
+        Optional[bytes]
+            The bytes (fewer than end - start at the end of the file), or None
+            if the file was not found.
+        """
+        path = self._maybe_resolve(path)
+        if path.startswith('http://') or path.startswith('https://'):
+            if local_only:
+                return None
+            return self._local_db.readFileBytesFromUrl(url=path, start=start, end=end)
+        ret = self._local_db.readFileBytes(path=path, start=start, end=end)
+        if (ret is not None) or local_only:
+            return ret
+        if not (path.startswith('sha1://') or path.startswith('sha1dir://')):
+            return None
+        sha1 = self.computeFileSha1(path=path)
+        if not sha1:
+            return None
+        url = self._remote_urls_by_sha1.get(sha1, None)
+        if url is None:
+            url = self.findFile(path='sha1://' + sha1, remote_only=True)
+            if not url:
+                return None
+            self._remote_urls_by_sha1[sha1] = url
+        return self._local_db.readFileBytesFromUrl(url=url, start=start, end=end, sha1=sha1)
+
     @mtlogging.log(name='MountainClient:computeFileSha1')
     def computeFileSha1(self, path: str) -> Optional[str]:
         """Return the SHA-1 hash of a local or remote file.
@@ -1141,6 +1290,40 @@ class MountainClient():
         """
         return self._local_db.alternateLocalCacheDirs()
 
+    def cleanupLocalCache(self, *, max_bytes: Optional[int]=None, policy: str='lru', max_temp_age_hours: float=24, dry_run: bool=False, verbose: bool=False) -> dict:
+        """Clean up the local SHA-1 cache directory.
+
+        Orphaned .record.json and .hints.json files and stale temporary files
+        (e.g., from interrupted downloads) are removed. If a byte budget is
+        given (or set by the SHA1_CACHE_MAX_BYTES environment variable), the
+        least recently (or least frequently) used files are evicted until the
+        cache fits within the budget. Files referenced by values in the local
+        database (e.g., cached job results) are never evicted.
+
+        Parameters
+        ----------
+        max_bytes : Optional[int], optional
+            The byte budget for the cache, by default None
+        policy : str, optional
+            The eviction policy, 'lru' or 'lfu', by default 'lru'
+        max_temp_age_hours : float, optional
+            Temporary files older than this are removed, by default 24
+        dry_run : bool, optional
+            If True, only report what would be removed, by default False
+        verbose : bool, optional
+            If True, print the files that are removed, by default False
+
+        Returns
+        -------
+        dict
+            A report with the number of files and bytes removed
+        """
+        if max_bytes is None:
+            val = os.environ.get('SHA1_CACHE_MAX_BYTES', None)
+            if val:
+                max_bytes = int(val)
+        return self._local_db.cleanupLocalCache(max_bytes=max_bytes, policy=policy, max_temp_age=max_temp_age_hours * 3600, dry_run=dry_run, verbose=verbose)
+
     @mtlogging.log(name='MountainClient:getSha1Url')
     def getSha1Url(self, path: str, *, basename: Optional[str]=None) -> Optional[str]:
         """Return a sha1:// URI representing the file.
@@ -1310,16 +1493,7 @@ class MountainClient():
                 return None
             path = 'sha1://' + sha1
             # the proceed
-        download_froms: List[str] = []
-        if download_from is not None:
-            if type(download_from) == str:
-                download_froms.append(str(download_from))
-            else:
-                download_froms.extend(download_from)
-        else:
-            # behovior changed on 6/15/19... if download_from is explicitly given then don't use configured kacheries
-            for kname in self._config_download_from:
-                download_froms.append(kname)
+        download_froms = self._get_download_froms(download_from)
         if path.startswith('sha1://'):
             list0 = path.split('/')
             sha1 = list0[2]
@@ -1332,6 +1506,102 @@ class MountainClient():
                         return url
         return None
 
+    def _get_download_froms(self, download_from: Optional[StrOrStrList]) -> List[str]:
+        download_froms: List[str] = []
+        if download_from is not None:
+            if type(download_from) == str:
+                download_froms.append(str(download_from))
+            else:
+                download_froms.extend(download_from)
+        else:
+            # behovior changed on 6/15/19... if download_from is explicitly given then don't use configured kacheries
+            for kname in self._config_download_from:
+                download_froms.append(kname)
+        return download_froms
+
+    def _realize_files(self, *,
+                       paths: List[str],
+                       show_progress: bool,
+                       download_from: Optional[StrOrStrList],
+                       local_only: bool,
+                       remote_only: bool,
+                       max_concurrency: int,
+                       max_bytes_per_sec: Optional[float]
+                       ) -> List[Optional[str]]:
+        realized_paths: Dict[str, Optional[str]] = dict()
+        sha1s_to_find: List[str] = []
+        paths_by_sha1: Dict[str, List[str]] = dict()
+        other_paths: List[str] = []
+        for path in paths:
+            if path in realized_paths:
+                continue
+            realized_paths[path] = None
+            if path.startswith('sha1://'):
+                sha1 = path.split('/')[2]
+                if sha1 not in paths_by_sha1:
+                    paths_by_sha1[sha1] = []
+                    if not remote_only:
+                        realized_paths[path] = self._local_db.realizeFile(path=path)
+                    if realized_paths[path] is None:
+                        sha1s_to_find.append(sha1)
+                paths_by_sha1[sha1].append(path)
+            else:
+                # local paths, sha1dir:// and key:// paths are handled one at a time
+                other_paths.append(path)
+
+        with ThreadPoolExecutor(max_workers=max(max_concurrency, 1)) as executor:
+            for path, ret in zip(other_paths, executor.map(
+                lambda path: self.realizeFile(path=path, show_progress=show_progress, download_from=download_from, local_only=local_only, remote_only=remote_only),
+                other_paths
+            )):
+                realized_paths[path] = ret
+
+            if sha1s_to_find and (not local_only):
+                # check all the kacheries for all the missing files at once
+                download_froms = self._get_download_froms(download_from)
+                found = dict()
+                # one request per kachery (for servers that support it)
+                for df0, found0 in zip(download_froms, executor.map(
+                    lambda df0: self._find_on_kachery_batch(download_from=df0, sha1s=sha1s_to_find),
+                    download_froms
+                )):
+                    if found0 is not None:
+                        for sha1 in sha1s_to_find:
+                            found[(sha1, df0)] = found0[sha1]
+                # otherwise, one request per file
+                checks = [(sha1, df0) for sha1 in sha1s_to_find for df0 in download_froms if (sha1, df0) not in found]
+                found.update(zip(checks, executor.map(
+                    lambda check: self._find_on_kachery(download_from=check[1], sha1=check[0]),
+                    checks
+                )))
+                urls_to_download = []
+                for sha1 in sha1s_to_find:
+                    # use the first kachery (in order) that has the file
+                    for df0 in download_froms:
+                        url, size = found[(sha1, df0)]
+                        if url and (size is not None):
+                            urls_to_download.append((sha1, url, size))
+                            break
+
+                rate_limiter = ByteRateLimiter(max_bytes_per_sec) if max_bytes_per_sec else None
+
+                def download(item):
+                    sha1, url, size = item
+                    try:
+                        return self._local_db.realizeFileFromUrl(url=url, sha1=sha1, size=size, show_progress=show_progress, rate_limiter=rate_limiter)
+                    except:
+                        traceback.print_exc()
+                        print('WARNING: failed to download file: {}'.format(url))
+                        return None
+                for item, ret in zip(urls_to_download, executor.map(download, urls_to_download)):
+                    realized_paths[paths_by_sha1[item[0]][0]] = ret
+
+        # files with the same sha1 share the same realized path
+        for sha1, paths0 in paths_by_sha1.items():
+            for path in paths0[1:]:
+                realized_paths[path] = realized_paths[paths0[0]]
+        return [realized_paths[path] for path in paths]
+
     @mtlogging.log()
     def _save_file(self, *,
                    path: str,
@@ -1432,22 +1702,84 @@ class MountainClient():
                 return (None, None)
             if not obj['found']:
                 return (None, None)
-            url0 = kachery_url + '/get/sha1/' + sha1
-            if download_from in self._kachery_download_tokens:
-                download_token0 = self._kachery_download_tokens[download_from]
-                url_path0 = '/get/sha1/' + sha1
-                signature0 = _sha1_of_object(
-                    {'path': url_path0, 'token': download_token0})
-                url0 = url0 + '?signature=' + signature0
-            return (url0, obj['size'])
+            return (self._kachery_download_url(download_from=download_from, kachery_url=kachery_url, sha1=sha1), obj['size'])
 
         return (None, None)
 
+    def _find_on_kachery_batch(self, *,
+                               download_from: str,
+                               sha1s: List[str]
+                               ) -> Optional[Dict[str, Tuple[Optional[str], Optional[int]]]]:
+        # Check for many files in one request (POST:/check/sha1). Returns None
+        # if the kachery does not support this, and then _find_on_kachery()
+        # should be used for each file.
+        kachery_url = self._resolve_kachery_url(download_from)
+        ret: Dict[str, Tuple[Optional[str], Optional[int]]] = dict()
+        if not kachery_url:
+            for sha1 in sha1s:
+                ret[sha1] = (None, None)
+            return ret
+        if kachery_url in _servers_without_batch_support:
+            return None
+        check_url = kachery_url + '/check/sha1'
+        for ii in range(0, len(sha1s), _MAX_BATCH_SIZE):
+            sha1s0 = sha1s[ii:ii + _MAX_BATCH_SIZE]
+            try:
+                obj = _http_post_json(check_url, dict(sha1s=sha1s0), verbose=self._verbose)
+            except:
+                traceback.print_exc()
+                print('WARNING: failed in check to kachery {}: {}'.format(
+                    download_from, check_url))
+                obj = dict(success=False)
+            if obj is None:
+                _servers_without_batch_support.add(kachery_url)
+                return None
+            if (not obj.get('success', False)) or (len(obj.get('results', [])) != len(sha1s0)):
+                print('WARNING: problem checking kachery {}: {}'.format(
+                    download_from, check_url))
+                for sha1 in sha1s0:
+                    ret[sha1] = (None, None)
+                continue
+            for sha1, result in zip(sha1s0, obj['results']):
+                if result.get('found', False):
+                    ret[sha1] = (self._kachery_download_url(download_from=download_from, kachery_url=kachery_url, sha1=sha1), result['size'])
+                else:
+                    ret[sha1] = (None, None)
+        return ret
+
+    def _kachery_download_url(self, *, download_from: str, kachery_url: str, sha1: str) -> str:
+        url0 = kachery_url + '/get/sha1/' + sha1
+        if download_from in self._kachery_download_tokens:
+            download_token0 = self._kachery_download_tokens[download_from]
+            url_path0 = '/get/sha1/' + sha1
+            signature0 = _sha1_of_object(
+                {'path': url_path0, 'token': download_token0})
+            url0 = url0 + '?signature=' + signature0
+        return url0
+
     def _read_file_system_dir(self, *,
                               path: str,
                               recursive: bool,
                               include_sha1: bool
                               ) -> Optional[dict]:
+        files: List[Tuple[dict, str]] = []
+        ret = self._read_file_system_dir_helper(path=path, recursive=recursive, relpath='', files=files)
+        if ret is None:
+            return None
+        if include_sha1 and files:
+            # hash all the files at once (in parallel, and only looking up
+            # the files that changed since the directory was last read)
+            sha1s = self._local_db.computeFileSha1sInDir(path, [relpath0 for _, relpath0 in files])
+            for (dd0, relpath0), sha1 in zip(files, sha1s):
+                dd0['files'][os.path.basename(relpath0)]['sha1'] = sha1
+        return ret
+
+    def _read_file_system_dir_helper(self, *,
+                                     path: str,
+                                     recursive: bool,
+                                     relpath: str,
+                                     files: List[Tuple[dict, str]]
+                                     ) -> Optional[dict]:
         ret: dict = dict(
             files={},
             dirs={}
@@ -1457,17 +1789,17 @@ class MountainClient():
             return None
         for name0 in list0:
             path0 = path + '/' + name0
+            relpath0 = relpath + name0
             if os.path.isfile(path0):
                 ret['files'][name0] = dict(
                     size=os.path.getsize(path0)
                 )
-                if include_sha1:
-                    ret['files'][name0]['sha1'] = self.computeFileSha1(path0)
+                files.append((ret, relpath0))
             elif os.path.isdir(path0):
                 ret['dirs'][name0] = {}
                 if recursive:
-                    ret['dirs'][name0] = self._read_file_system_dir(
-                        path=path0, recursive=recursive, include_sha1=include_sha1)
+                    ret['dirs'][name0] = self._read_file_system_dir_helper(
+                        path=path0, recursive=recursive, relpath=relpath0 + '/', files=files)
         return ret
 
     def _parse_key_path(self, key_path: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str], Optional[str]]:
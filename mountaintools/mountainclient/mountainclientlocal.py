@@ -4,8 +4,11 @@ import shutil
 import mtlogging
 import pathlib
 from .sha1cache import Sha1Cache
-from .filelock import FileLock
-from typing import Union, List, Optional
+from .sha1cachemanager import find_referenced_sha1s
+from .steady_download_and_compute_sha1 import ByteRateLimiter
+from .rangecache import get_range_cache
+from .localdatabase import open_local_database
+from typing import Union, List, Optional, Tuple
 from .mttyping import StrOrDict
 from .aux import _read_text_file, _write_text_file, _sha1_of_string
 
@@ -18,25 +21,14 @@ class MountainClientLocal():
             'KBUCKET_URL', 'https://kbucket.flatironinstitute.org')
         self._nodeinfo_cache = dict()
         self._verbose = None
+        self._databases = dict()
 
     def configVerbose(self, value: bool) -> None:
         self._verbose = value
 
     def getSubKeys(self, *, key: Union[str, dict]) -> Optional[List[str]]:
         keyhash = _hash_of_key(key)
-        subkey_db_path = self._get_subkey_file_path_for_keyhash(
-            keyhash, _create=False)
-        if not os.path.exists(subkey_db_path):
-            return []
-        ret = []
-        with FileLock(subkey_db_path + '.lock', exclusive=False):
-            list0 = _safe_list_dir(subkey_db_path)
-            if list0 is None:
-                return None
-            for name0 in list0:
-                if name0.endswith('.txt'):
-                    ret.append(name0[0:-4])
-        return ret
+        return self._database().getSubKeys(keyhash)
 
     def getValue(self, *, key: StrOrDict, subkey: Optional[str]=None, check_alt=False, _db_path: Optional[str]=None, _disable_lock: bool=False) -> Optional[str]:
         keyhash = _hash_of_key(key)
@@ -44,30 +36,16 @@ class MountainClientLocal():
             if check_alt:
                 raise Exception('Cannot use check_alt together with subkey.')
             if subkey == '-':
-                subkeys = self.getSubKeys(key=key)
-                if subkeys is None:
+                obj = self._database(_db_path).getAllSubKeyValues(keyhash)
+                if obj is None:
                     return '{}'
-                obj = dict()
-                for subkey in subkeys:
-                    val = self.getValue(key=key, subkey=subkey)
-                    if val is not None:
-                        obj[subkey] = val
                 return json.dumps(obj)
             else:
-                subkey_db_path = self._get_subkey_file_path_for_keyhash(
-                    keyhash, _db_path=_db_path, _create=False)
-                fname0 = os.path.join(subkey_db_path, subkey + '.txt')
-                if not os.path.exists(fname0):
-                    return None
-                with FileLock(subkey_db_path + '.lock', _disable_lock=_disable_lock, exclusive=False):
-                    txt = _read_text_file(fname0)
-                    return txt
+                return self._database(_db_path).getValue(keyhash, subkey, _disable_lock=_disable_lock)
         else:
             # not a subkey
-            db_path = self._get_file_path_for_keyhash(
-                keyhash, _db_path=_db_path, _create=False)
-            fname0 = db_path
-            if not os.path.exists(fname0):
+            val = self._database(_db_path).getValue(keyhash, _disable_lock=_disable_lock)
+            if val is None:
                 if check_alt:
                     alternate_db_paths = self.alternateLocalDatabasePaths()
                     for db_path in alternate_db_paths:
@@ -76,9 +54,23 @@ class MountainClientLocal():
                         if val:
                             return val
                 return None
-            with FileLock(fname0 + '.lock', _disable_lock=_disable_lock, exclusive=False):
-                txt = _read_text_file(fname0)
-                return txt
+            return val
+
+    def getValues(self, *, keys: List[StrOrDict], check_alt=False) -> List[Optional[str]]:
+        """Batch version of getValue (without subkeys): the values for the
+        keys, in the same order (None for keys that are not found)"""
+        keyhashes = [_hash_of_key(key) for key in keys]
+        vals = self._database().getValues(keyhashes)
+        if check_alt:
+            for db_path in self.alternateLocalDatabasePaths():
+                missing = [keyhash for keyhash in keyhashes if not vals.get(keyhash, None)]
+                if len(missing) == 0:
+                    break
+                vals_alt = self._database(db_path).getValues(missing, _disable_lock=True)
+                for keyhash, val in vals_alt.items():
+                    if val:
+                        vals[keyhash] = val
+        return [vals.get(keyhash, None) for keyhash in keyhashes]
 
     def setValue(self, *, key: StrOrDict, subkey: Optional[str], value: Union[str, None], overwrite: bool) -> bool:
         keyhash = _hash_of_key(key)
@@ -87,43 +79,18 @@ class MountainClientLocal():
                 if value is not None:
                     raise Exception(
                         'Cannot set all subkeys with value that is not None')
-                subkey_db_path = self._get_subkey_file_path_for_keyhash(
-                    keyhash, _create=True)
-                with FileLock(subkey_db_path + '.lock', exclusive=True):
-                    shutil.rmtree(subkey_db_path)
+                self._database().deleteSubKeys(keyhash)
+                return True
             else:
-                subkey_db_path = self._get_subkey_file_path_for_keyhash(
-                    keyhash, _create=True)
-                fname0 = os.path.join(subkey_db_path, subkey + '.txt')
-                if os.path.exists(fname0):
-                    if not overwrite:
-                        return False
-                with FileLock(subkey_db_path + '.lock', exclusive=True):
-                    if os.path.exists(fname0):
-                        if not overwrite:
-                            return False
-                    if value is None:
-                        os.unlink(fname0)
-                    else:
-                        # _write_text_file_safe(fname0, value)
-                        _write_text_file(fname0, value)
+                return self._database().setValue(keyhash, subkey, value, overwrite)
         else:
             # not a subkey
-            db_path = self._get_file_path_for_keyhash(keyhash, _create=True)
-            fname0 = db_path
-            if os.path.exists(fname0):
-                if not overwrite:
-                    return False
-            with FileLock(fname0 + '.lock', exclusive=True):
-                if os.path.exists(fname0):
-                    if not overwrite:
-                        return False
-                if value is None:
-                    if os.path.exists(fname0):
-                        os.unlink(fname0)
-                else:
-                    _write_text_file(fname0, value)
-        return True
+            return self._database().setValue(keyhash, None, value, overwrite)
+
+    def setValues(self, *, items: List[Tuple[StrOrDict, Union[str, None]]], overwrite: bool) -> List[bool]:
+        """Batch version of setValue (without subkeys). items is a list of
+        (key, value) pairs. Returns whether each value was set."""
+        return self._database().setValues([(_hash_of_key(key), value) for key, value in items], overwrite)
 
     def realizeFile(self, *, path: str, local_only: bool=False, resolve_locally: bool=True, dest_path: Optional[str]=None, show_progress: bool=False) -> Optional[str]:
         if path.startswith('sha1://'):
@@ -147,8 +114,36 @@ class MountainClientLocal():
 
         return None
 
-    def realizeFileFromUrl(self, *, url: str, sha1: str, size: int, dest_path: Optional[str]=None, show_progress=False) -> Optional[str]:
-        return self._sha1_cache.downloadFile(url=url, sha1=sha1, size=size, target_path=dest_path, show_progress=show_progress)
+    def readFileBytes(self, *, path: str, start: int, end: int) -> Optional[bytes]:
+        """Read bytes [start, end) of a local file or of a file in the local
+        SHA-1 cache (possibly stored as chunks), or None if it is not found
+        locally"""
+        if path.startswith('sha1://') or path.startswith('sha1dir://'):
+            sha1 = self.computeFileSha1(path=path)
+            if not sha1:
+                return None
+            return self._sha1_cache.readFileRange(sha1, start, end)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(max(end - start, 0))
+
+    def readFileBytesFromUrl(self, *, url: str, start: int, end: int, sha1: Optional[str]=None) -> bytes:
+        """Read bytes [start, end) of a remote file, by blocks that are kept
+        in a sparse file in the local cache (see RemoteFileRangeCache)"""
+        if sha1:
+            final_path = self._sha1_cache._get_path(sha1, create=True)
+            cache_path = final_path + '.sparse'
+        else:
+            final_path = None
+            hash0 = _sha1_of_string(url)
+            cache_path = os.path.join(self.localCacheDir(), 'range_cache', hash0[0], hash0[1:3], hash0 + '.sparse')
+        rc = get_range_cache(url, cache_path=cache_path, sha1=sha1, final_path=final_path)
+        return rc.read(start, end)
+
+    def realizeFileFromUrl(self, *, url: str, sha1: str, size: int, dest_path: Optional[str]=None, show_progress=False, rate_limiter: Optional[ByteRateLimiter]=None) -> Optional[str]:
+        return self._sha1_cache.downloadFile(url=url, sha1=sha1, size=size, target_path=dest_path, show_progress=show_progress, rate_limiter=rate_limiter)
 
     @mtlogging.log()
     def saveFile(self, *, path: str, basename: Optional[str], return_sha1_url: bool=True) -> Optional[str]:
@@ -161,7 +156,8 @@ class MountainClientLocal():
             raise Exception('Unable to realize file in saveFile: ' + path0)
         path = str(path_realized)
 
-        local_path, sha1 = self._sha1_cache.copyFileToCache(path)
+        # (the path in the cache is only needed when it is returned)
+        local_path, sha1 = self._sha1_cache.copyFileToCache(path, return_path=(not return_sha1_url))
 
         if sha1 is None:
             raise Exception(
@@ -213,6 +209,17 @@ class MountainClientLocal():
         else:
             return self._sha1_cache.computeFileSha1(path=path, _cache_only=_cache_only)
 
+    def computeFileSha1sInDir(self, dirpath: str, relpaths: List[str]) -> List[Optional[str]]:
+        return self._sha1_cache.computeFileSha1sInDir(dirpath, relpaths)
+
+    def cleanupLocalCache(self, *, max_bytes: Optional[int]=None, policy: str='lru', max_temp_age: float=24 * 3600, dry_run: bool=False, verbose: bool=False) -> dict:
+        pinned_sha1s = None
+        if max_bytes is not None:
+            # pin the files referenced by the local database (e.g., job results)
+            values = (value for _, _, value in self._database().iterateItems())
+            pinned_sha1s = find_referenced_sha1s(values, load_object=self._load_cached_object)
+        return self._sha1_cache.cleanup(max_bytes=max_bytes, policy=policy, pinned_sha1s=pinned_sha1s, max_temp_age=max_temp_age, dry_run=dry_run, verbose=verbose)
+
     def localCacheDir(self) -> str:
         return self._sha1_cache.directory()
 
@@ -225,38 +232,26 @@ class MountainClientLocal():
     def alternateLocalDatabasePaths(self) -> List[str]:
         return _get_default_alternate_local_db_paths()
 
-    def _get_file_path_for_keyhash(self, keyhash: str, *, _create: bool, _db_path: Optional[str]=None) -> str:
-        if _db_path:
-            database_path = _db_path
-        else:
-            database_path = self.localDatabasePath()
-        path = os.path.join(database_path, keyhash[0:2], keyhash[2:4])
-        if _create:
-            if not os.path.exists(path):
-                try:
-                    os.makedirs(path)
-                except:
-                    if not os.path.exists(path):
-                        raise Exception(
-                            'Unexpected problem. Unable to create directory: ' + path)
-        return os.path.join(path, keyhash)
-
-    def _get_subkey_file_path_for_keyhash(self, keyhash: str, *, _create: bool, _db_path: Optional[str]=None) -> str:
-        if _db_path:
-            database_path = _db_path
+    def _database(self, db_path: Optional[str]=None):
+        if not db_path:
+            db_path = self.localDatabasePath()
+            backend = os.environ.get('MOUNTAIN_DB_BACKEND', None) or None
         else:
-            database_path = self.localDatabasePath()
-        path = os.path.join(
-            database_path, keyhash[0:2], keyhash[2:4], keyhash + '.dir')
-        if _create:
-            if not os.path.exists(path):
-                try:
-                    os.makedirs(path)
-                except:
-                    if not os.path.exists(path):
-                        raise Exception(
-                            'Unexpected problem. Unable to create directory: ' + path)
-        return path
+            # alternate databases: use whichever exists
+            backend = None
+        key = (db_path, backend)
+        if key not in self._databases:
+            self._databases[key] = open_local_database(db_path, backend=backend)
+        return self._databases[key]
+
+    def _load_cached_object(self, sha1: str) -> Optional[dict]:
+        fname = self._sha1_cache.findFile(sha1)
+        if fname is None:
+            return None
+        try:
+            return json.loads(_read_text_file(fname))
+        except:
+            return None
 
     def _realize_file_from_sha1(self, *, sha1: str, dest_path: Optional[str]=None, show_progress: bool=False) -> Optional[str]:
         # try to find the file in cache
@@ -320,10 +315,3 @@ def _hash_of_key(key: StrOrDict) -> str:
         else:
             return _sha1_of_string(str(key))
 
-
-def _safe_list_dir(path: str) -> Optional[List[str]]:
-    try:
-        ret = os.listdir(path)
-        return ret
-    except:
-        return None
@@ -1,12 +1,14 @@
 import hashlib
 import json
-import urllib.request as request
 import base64
 import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import time
 import mtlogging
-from typing import Union, Dict, List, Optional, Any
+from typing import Union, Dict, List, Optional, Any, Set, Tuple
 from .mttyping import StrOrDict
 
 
@@ -46,6 +48,28 @@ class MountainRemoteClient():
             return None
         return obj['value']
 
+    def getValues(self, *, collection: str, keys: List[Tuple[StrOrDict, Optional[str]]], url: str) -> List[Optional[str]]:
+        """Batch version of getValue. keys is a list of (key, subkey) pairs.
+        Uses the POST:/get/[collection] endpoint, or one request per key for
+        servers that do not support it."""
+        if not url:
+            print('Missing url for remote mountain server.')
+            raise ValueError('Missing url for remote mountain server.')
+        items = [dict(key=_hash_of_key(key), subkey=subkey) for key, subkey in keys]
+        ret: List[Optional[str]] = []
+        for ii in range(0, len(items), _MAX_BATCH_SIZE):
+            items0 = items[ii:ii + _MAX_BATCH_SIZE]
+            obj = None
+            if url not in _servers_without_batch_support:
+                obj = _http_post_json(url + '/get/{}'.format(collection), dict(keys=items0))
+                if obj is None:
+                    _servers_without_batch_support.add(url)
+            if (obj is not None) and obj.get('success') and (len(obj.get('results', [])) == len(items0)):
+                ret.extend([r['value'] if r.get('success') else None for r in obj['results']])
+            else:
+                ret.extend([self.getValue(collection=collection, key=key, subkey=subkey, url=url) for key, subkey in keys[ii:ii + _MAX_BATCH_SIZE]])
+        return ret
+
     def setValue(self, *, collection: str, key: StrOrDict, subkey: Optional[str], overwrite: bool=True, value: Optional[str], url: str, token: str) -> bool:
         value_b64: Optional[str] = None
         if value:
@@ -119,27 +143,79 @@ def _sha1_of_object(obj: Union[List, Dict]) -> str:
 
 @mtlogging.log()
 def _http_get_json(url: str, verbose: Optional[bool]=None, retry_delays: Optional[List[float]]=None) -> Optional[str]:
+    return _http_request_json('GET', url, verbose=verbose, retry_delays=retry_delays)
+
+
+@mtlogging.log()
+def _http_post_json(url: str, obj: Any, verbose: Optional[bool]=None, retry_delays: Optional[List[float]]=None) -> Optional[dict]:
+    """Post obj as JSON and return the JSON response. Returns None if the
+    server does not have this endpoint (e.g., an older server)."""
+    try:
+        return _http_request_json('POST', url, obj=obj, verbose=verbose, retry_delays=retry_delays)
+    except _EndpointNotFound:
+        return None
+
+
+class _EndpointNotFound(Exception):
+    pass
+
+
+def _http_request_json(method: str, url: str, *, obj: Any=None, verbose: Optional[bool]=None, retry_delays: Optional[List[float]]=None) -> Any:
     timer = time.time()
     if retry_delays is None:
-        retry_delays = [0.2, 0.5]
+        # exponential backoff
+        retry_delays = [0.2, 0.5, 1.5, 4]
     if verbose is None:
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
-        print('_http_get_json::: ' + url)
-    try:
-        req = request.urlopen(url)
-    except:
-        if len(retry_delays) > 0:
-            print('Retrying http request in {} sec: {}'.format(
-                retry_delays[0], url))
-            time.sleep(retry_delays[0])
-            return _http_get_json(url, verbose=verbose, retry_delays=retry_delays[1:])
+        print('_http_request_json::: {} {}'.format(method, url))
+    for try_num in range(len(retry_delays) + 1):
+        try:
+            req = _get_http_session().request(method, url, json=obj)
+        except:
+            req = None
+        if req is not None:
+            if (method == 'POST') and (req.status_code in [404, 405]):
+                raise _EndpointNotFound()
+            if req.status_code == 200:
+                break
+            if (400 <= req.status_code < 500) and (req.status_code != 429):
+                # retrying would not help
+                raise Exception('Unable to open url: {} ({})'.format(url, req.status_code))
+        if try_num < len(retry_delays):
+            # add jitter so that many clients do not retry in lockstep
+            delay = retry_delays[try_num] * random.uniform(1, 1.5)
+            print('Retrying http request in {:.2f} sec: {}'.format(delay, url))
+            time.sleep(delay)
         else:
             raise Exception('Unable to open url: ' + url)
     try:
-        ret = json.load(req)
+        ret = req.json()
     except:
         raise Exception('Unable to load json from url: ' + url)
     if verbose:
-        print('Elapsed time for _http_get_json: {} {}'.format(time.time() - timer, url))
+        print('Elapsed time for _http_request_json: {} {}'.format(time.time() - timer, url))
     return ret
+
+# Max. number of items in a batch request
+_MAX_BATCH_SIZE = 500
+
+# urls of servers that have responded that they do not support the batch endpoints
+_servers_without_batch_support: Set[str] = set()
+
+_http_sessions: Dict[int, requests.Session] = dict()
+_http_sessions_lock = threading.Lock()
+
+
+def _get_http_session() -> requests.Session:
+    # A session per process, so that connections to the servers are reused
+    # (including by concurrent requests, see MountainClient.realizeFiles)
+    pid = os.getpid()
+    with _http_sessions_lock:
+        if pid not in _http_sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_sessions[pid] = session
+        return _http_sessions[pid]
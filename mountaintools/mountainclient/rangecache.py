@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+from .steady_download_and_compute_sha1 import _get_session
+from .filelock import FileLock
+
+
+def default_block_size() -> int:
+    return int(os.environ.get('MOUNTAIN_RANGE_BLOCK_SIZE', 1024 * 1024))
+
+
+def default_readahead() -> int:
+    return int(os.environ.get('MOUNTAIN_RANGE_READAHEAD', 4))
+
+
+class RemoteFileRangeCache():
+    def __init__(self, url: str, *, cache_path: str, block_size: Optional[int]=None, readahead: Optional[int]=None, sha1: Optional[str]=None):
+        """Reads byte ranges of a remote file with http range requests,
+        keeping the downloaded blocks in a sparse file (cache_path) so that
+        they are only transferred once, even across processes.
+
+        The blocks that are present are listed in <cache_path>.blocks.json.
+        Missing blocks are fetched in runs of consecutive blocks, together
+        with the next readahead blocks when the reads are sequential. When
+        the sha1 of the file is known and all the blocks are present, the
+        file is checked and moved to final_path (see setFinalPath).
+
+        Parameters
+        ----------
+        url : str
+            The url of the file (the server must support range requests)
+        cache_path : str
+            The local sparse file
+        block_size : int, optional
+            By default from the MOUNTAIN_RANGE_BLOCK_SIZE environment variable,
+            or 1 MB
+        readahead : int, optional
+            The number of blocks to read ahead, by default from the
+            MOUNTAIN_RANGE_READAHEAD environment variable, or 4
+        sha1 : str, optional
+            The sha1 of the file, if known
+        """
+        self._url = url
+        self._cache_path = cache_path
+        self._block_size = block_size or default_block_size()
+        self._readahead = readahead if readahead is not None else default_readahead()
+        self._sha1 = sha1
+        self._final_path: Optional[str] = None
+        self._size: Optional[int] = None
+        self._present: Optional[set] = None
+        self._last_end: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def setFinalPath(self, path: str) -> None:
+        self._final_path = path
+
+    def finalPath(self) -> Optional[str]:
+        if self._final_path and os.path.exists(self._final_path):
+            return self._final_path
+        return None
+
+    def size(self) -> int:
+        with self._lock:
+            self._initialize()
+            assert self._size is not None
+            return self._size
+
+    def read(self, start: int, end: int) -> bytes:
+        """Read bytes [start, end) (fewer at the end of the file)"""
+        return self._read(start, end, retry=True)
+
+    def _read(self, start: int, end: int, *, retry: bool) -> bytes:
+        with self._lock:
+            final_path = self.finalPath()
+            if final_path:
+                return _read_file_range(final_path, start, end)
+            self._initialize()
+            assert self._size is not None
+            assert self._present is not None
+            end = min(end, self._size)
+            if start >= end:
+                return b''
+            b1 = start // self._block_size
+            b2 = (end - 1) // self._block_size + 1
+            if self._last_end == start:
+                # sequential reads
+                b2_fetch = min(b2 + self._readahead, self._num_blocks())
+            else:
+                b2_fetch = b2
+            self._last_end = end
+            missing = [b for b in range(b1, b2_fetch) if b not in self._present]
+            if missing:
+                # download without holding the file lock, then write the
+                # blocks under it, since another process may finalize or
+                # evict the sparse file in the meantime
+                fetched = [(run, self._fetch_blocks(run[0], run[1])) for run in _consecutive_runs(missing)]
+                with FileLock(self._cache_path + '.lock', exclusive=True):
+                    final_path = self.finalPath()
+                    if final_path:
+                        return _read_file_range(final_path, start, end)
+                    if not os.path.exists(self._cache_path):
+                        self._size = None
+                        self._initialize_helper()
+                    for run, data in fetched:
+                        self._write_blocks(run[0], run[1], data)
+                    self._save_present()
+                    self._maybe_finalize()
+            try:
+                return _read_file_range(self._cache_path, start, end)
+            except FileNotFoundError:
+                # finalized (possibly by another process)
+                final_path = self.finalPath()
+                if final_path:
+                    return _read_file_range(final_path, start, end)
+                if not retry:
+                    raise
+                # evicted -- start over, once
+                self._size = None
+                self._present = None
+        return self._read(start, end, retry=False)
+
+    def _num_blocks(self) -> int:
+        assert self._size is not None
+        return (self._size + self._block_size - 1) // self._block_size
+
+    def _initialize(self) -> None:
+        if self._size is not None:
+            return
+        os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+        with FileLock(self._cache_path + '.lock', exclusive=True):
+            self._initialize_helper()
+
+    def _initialize_helper(self) -> None:
+        blocks_path = self._cache_path + '.blocks.json'
+        obj = self._load_blocks_file()
+        if obj and (obj.get('url', None) == self._url) and (obj.get('block_size', None) == self._block_size) and (os.path.getsize(self._cache_path) == obj.get('size', None)):
+            self._size = obj['size']
+            self._present = set(obj['blocks'])
+            return
+        session, connection_slots = _get_session()
+        with connection_slots:
+            response = session.head(self._url, allow_redirects=True)
+        response.raise_for_status()
+        self._size = int(response.headers['content-length'])
+        self._present = set()
+        _safe_remove_file(blocks_path)
+        # a sparse file of the full size; the blocks are written in place
+        with open(self._cache_path, 'wb') as f:
+            f.truncate(self._size)
+        self._save_present()
+
+    def _fetch_blocks(self, b1: int, b2: int) -> bytes:
+        assert self._size is not None
+        i1 = b1 * self._block_size
+        i2 = min(b2 * self._block_size, self._size)
+        session, connection_slots = _get_session()
+        with connection_slots:
+            response = session.get(self._url, headers={'Range': 'bytes={}-{}'.format(i1, i2 - 1)}, timeout=60)
+            response.raise_for_status()
+            data = response.content
+        if len(data) != i2 - i1:
+            raise Exception('Unexpected size of range {}-{} of {}: {}'.format(i1, i2 - 1, self._url, len(data)))
+        return data
+
+    def _write_blocks(self, b1: int, b2: int, data: bytes) -> None:
+        # (with the file lock)
+        assert self._present is not None
+        with open(self._cache_path, 'r+b') as f:
+            f.seek(b1 * self._block_size)
+            f.write(data)
+        self._present.update(range(b1, b2))
+
+    def _load_blocks_file(self) -> Optional[dict]:
+        blocks_path = self._cache_path + '.blocks.json'
+        if (not os.path.exists(blocks_path)) or (not os.path.exists(self._cache_path)):
+            return None
+        try:
+            with open(blocks_path, 'r') as f:
+                return json.load(f)
+        except:
+            return None
+
+    def _save_present(self) -> None:
+        assert self._present is not None
+        # include the blocks downloaded by other processes in the meantime
+        obj = self._load_blocks_file()
+        if obj and (obj.get('url', None) == self._url) and (obj.get('block_size', None) == self._block_size) and (obj.get('size', None) == self._size):
+            self._present.update(obj['blocks'])
+        blocks_path = self._cache_path + '.blocks.json'
+        tmp_path = blocks_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(url=self._url, size=self._size, block_size=self._block_size, blocks=sorted(self._present)), f)
+        os.replace(tmp_path, blocks_path)
+
+    def _maybe_finalize(self) -> None:
+        assert self._present is not None
+        if (not self._sha1) or (not self._final_path) or (len(self._present) < self._num_blocks()):
+            return
+        sha1 = _compute_file_sha1(self._cache_path)
+        if sha1 == self._sha1:
+            if not os.path.exists(self._final_path):
+                os.replace(self._cache_path, self._final_path)
+        else:
+            print('Warning: unexpected sha1 of file downloaded by ranges: {} <> {}'.format(sha1, self._sha1))
+        _safe_remove_file(self._cache_path)
+        _safe_remove_file(self._cache_path + '.blocks.json')
+        self._present = set()
+        self._size = None
+
+
+_range_caches: OrderedDict = OrderedDict()
+_range_caches_lock = threading.Lock()
+_max_num_range_caches = 64
+
+
+def get_range_cache(url: str, *, cache_path: str, sha1: Optional[str]=None, final_path: Optional[str]=None) -> RemoteFileRangeCache:
+    """The RemoteFileRangeCache for the url, shared by the readers in this
+    process (so that the size and block list are only loaded once)"""
+    with _range_caches_lock:
+        rc = _range_caches.get(url, None)
+        if rc is None:
+            rc = RemoteFileRangeCache(url, cache_path=cache_path, sha1=sha1)
+            if final_path:
+                rc.setFinalPath(final_path)
+            _range_caches[url] = rc
+            while len(_range_caches) > _max_num_range_caches:
+                _range_caches.popitem(last=False)
+        else:
+            _range_caches.move_to_end(url)
+        return rc
+
+
+def _consecutive_runs(inds: List[int]) -> List[Tuple[int, int]]:
+    # [1, 2, 3, 7, 8] -> [(1, 4), (7, 9)]
+    ret: List[Tuple[int, int]] = []
+    for ind in inds:
+        if ret and (ret[-1][1] == ind):
+            ret[-1] = (ret[-1][0], ind + 1)
+        else:
+            ret.append((ind, ind + 1))
+    return ret
+
+
+def _read_file_range(path: str, start: int, end: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(max(end - start, 0))
+
+
+def _compute_file_sha1(path: str) -> str:
+    hh = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024 * 16)
+            if not data:
+                break
+            hh.update(data)
+    return hh.hexdigest()
+
+
+def _safe_remove_file(fname: str) -> None:
+    try:
+        if os.path.exists(fname):
+            os.remove(fname)
+    except:
+        print('Warning: unable to remove file that we thought existed: ' + fname)
@@ -1,19 +1,21 @@
+import atexit
 import json
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import hashlib
 from shutil import copyfile
-from .steady_download_and_compute_sha1 import steady_download_and_compute_sha1
+from .steady_download_and_compute_sha1 import steady_download_and_compute_sha1, remove_partial_download, ByteRateLimiter
 import random
 import time
 from .filelock import FileLock
+from .sha1cachemanager import Sha1CacheManager
+from .chunkstore import ChunkStore, default_chunking
 import mtlogging
 from typing import Optional, List, Any, Dict, Tuple, Union
 
-# TODO: implement cleanup() for Sha1Cache
-# removing .record.json and .hints.json files that are no longer relevant
-
-
 class Sha1Cache():
     def __init__(self):
         self._directory = None
@@ -35,6 +37,9 @@ class Sha1Cache():
             else:
                 return []
 
+    def manager(self) -> Sha1CacheManager:
+        return Sha1CacheManager(self.directory())
+
     def setDirectory(self, directory: str) -> None:
         self._directory = directory
 
@@ -42,16 +47,48 @@ class Sha1Cache():
         self._alternate_directories = directories
 
     def findFile(self, sha1: str) -> Optional[str]:
+        path = self._find_file(sha1)
+        if path is not None:
+            return path
+        # if the file was stored as chunks, reassemble it in the cache
+        try:
+            path = self.chunkStore().reassemble(sha1, self._get_path(sha1, create=False))
+        except Exception as e:
+            print('Warning: problem reassembling file from chunks: {}'.format(e))
+            return None
+        if path is not None:
+            self.manager().recordAccess(sha1)
+        return path
+
+    def readFileRange(self, sha1: str, start: int, end: int) -> Optional[bytes]:
+        """Read bytes [start, end) of a file in the cache, or None if the
+        file is not in the cache. Files stored as chunks are read from the
+        chunks that overlap the range, without reassembling them."""
+        path = self._find_file(sha1)
+        if path is not None:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                return f.read(max(end - start, 0))
+        return self.chunkStore().readRange(sha1, start, end)
+
+    def chunkStore(self) -> ChunkStore:
+        return ChunkStore(self)
+
+    def _find_file(self, sha1: str) -> Optional[str]:
         path, alternate_paths = self._get_path_ext(
             sha1, create=False, return_alternates=True)
         # if file is available return it
         if os.path.exists(path):
+            self.manager().recordAccess(sha1)
             return path
         # return first alternate path that exists
         for altpath in alternate_paths:
             if os.path.exists(altpath):
                 return altpath
         hints_fname = path + '.hints.json'
+        if _pending_records.hasHints(hints_fname):
+            # added in this process and not yet written
+            _pending_records.flush()
         # if path.hints.json exists then read it
         if os.path.exists(hints_fname):
             hints = _read_json_file(hints_fname, delete_on_error=True)
@@ -80,43 +117,45 @@ class Sha1Cache():
                 _safe_remove_file(hints_fname)
         return None
 
-    def downloadFile(self, url: str, sha1: str, target_path: Optional[str]=None, size: Optional[int]=None, verbose: bool=False, show_progress: bool=False) -> Optional[str]:
+    def downloadFile(self, url: str, sha1: str, target_path: Optional[str]=None, size: Optional[int]=None, verbose: bool=False, show_progress: bool=False, rate_limiter: Optional[ByteRateLimiter]=None) -> Optional[str]:
         alternate_target_path = False
         if target_path is None:
             target_path = self._get_path(sha1, create=True)
         else:
             alternate_target_path = True
 
-        path_tmp = target_path + '.downloading.' + _random_string(6)
-        if (verbose) or (show_progress) or ((size is not None) and (size > 10000)):
-            print(
-                'Downloading file --- ({}): {} -> {}'.format(_format_file_size(size), url, target_path))
-
-        timer = time.time()
-        sha1b = steady_download_and_compute_sha1(url=url, target_path=path_tmp)
-        elapsed = time.time() - timer
-
-        if (verbose) or (show_progress) or ((size is not None) and size > 10000):
-            print('Downloaded file ({}) in {} sec.'.format(_format_file_size(size), elapsed))
-
-        if not sha1b:
-            if os.path.exists(path_tmp):
-                _safe_remove_file(path_tmp)
-        if sha1 != sha1b:
-            if os.path.exists(path_tmp):
-                _safe_remove_file(path_tmp)
-            raise Exception(
-                'sha1 of downloaded file does not match expected {} {} <> {}'.format(url, sha1, sha1b))
-        if alternate_target_path:
-            if os.path.exists(target_path):
-                _safe_remove_file(target_path)
-            _rename_file(path_tmp, target_path, remove_if_exists=True)
-            self.reportFileSha1(target_path, sha1)
-        else:
-            if not os.path.exists(target_path):
-                _rename_file(path_tmp, target_path, remove_if_exists=False)
+        # a fixed temporary path, so that an interrupted download can be resumed
+        path_tmp = target_path + '.downloading.partial'
+        with FileLock(path_tmp + '.lock', exclusive=True):
+            if (not alternate_target_path) and os.path.exists(target_path):
+                # downloaded by another process while we were waiting for the lock
+                return target_path
+            if (verbose) or (show_progress) or ((size is not None) and (size > 10000)):
+                print(
+                    'Downloading file --- ({}): {} -> {}'.format(_format_file_size(size), url, target_path))
+
+            timer = time.time()
+            sha1b = steady_download_and_compute_sha1(url=url, target_path=path_tmp, rate_limiter=rate_limiter)
+            elapsed = time.time() - timer
+
+            if (verbose) or (show_progress) or ((size is not None) and size > 10000):
+                print('Downloaded file ({}) in {} sec.'.format(_format_file_size(size), elapsed))
+
+            if sha1 != sha1b:
+                remove_partial_download(path_tmp)
+                raise Exception(
+                    'sha1 of downloaded file does not match expected {} {} <> {}'.format(url, sha1, sha1b))
+            if alternate_target_path:
+                if os.path.exists(target_path):
+                    _safe_remove_file(target_path)
+                _rename_file(path_tmp, target_path, remove_if_exists=True)
+                self.reportFileSha1(target_path, sha1)
             else:
-                _safe_remove_file(path_tmp)
+                if not os.path.exists(target_path):
+                    _rename_file(path_tmp, target_path, remove_if_exists=False)
+                else:
+                    _safe_remove_file(path_tmp)
+                self.manager().recordAccess(sha1)
         return target_path
 
     def moveFileToCache(self, path: str) -> str:
@@ -129,17 +168,30 @@ class Sha1Cache():
             tmp_fname = path0 + '.copying.' + _random_string(6)
             _rename_or_copy(path, tmp_fname)
             _rename_file(tmp_fname, path0, remove_if_exists=False)
-
+        self.manager().recordAccess(sha1)
         return path0
 
     @mtlogging.log()
-    def copyFileToCache(self, path: str) -> Tuple[str, str]:
+    def copyFileToCache(self, path: str, *, return_path: bool=True) -> Tuple[Optional[str], str]:
+        """Store the file in the cache and return (path in the cache, sha1).
+
+        When chunking is enabled (see default_chunking) and return_path is
+        False, the content is stored as (deduplicated) chunks instead of a
+        copy and the returned path is None. The file is then reassembled in
+        the cache by findFile() when it is needed.
+        """
         sha1 = self.computeFileSha1(path)
         path0 = self._get_path(sha1, create=True)
+        chunking = default_chunking()
+        if chunking and (not return_path) and (not os.path.exists(path0)):
+            self.chunkStore().storeFile(path, sha1=sha1, method=chunking)
+            self.manager().recordAccess(sha1)
+            return None, sha1
         if not os.path.exists(path0):
             tmp_path = path0 + '.copying.' + _random_string(6)
             copyfile(path, tmp_path)
             _rename_file(tmp_path, path0, remove_if_exists=False)
+        self.manager().recordAccess(sha1)
         return path0, sha1
 
     @mtlogging.log()
@@ -148,11 +200,24 @@ class Sha1Cache():
         basename = os.path.basename(path)
         if len(basename) == 40:
             # suspect it is itself a file in the cache
-            if self._get_path(sha1=basename) == path:
+            if self._get_path(sha1=basename, create=False) == path:
                 # in that case we don't need to compute
                 return basename
 
-        aa = _get_stat_object(path)
+        try:
+            stat0 = os.stat(path)
+        except:
+            stat0 = None
+        if stat0 is not None:
+            # first check the in-process memo (no disk access)
+            memo_key = _sha1_memo_key(path, stat0)
+            sha1_memo = _sha1_memo.get(memo_key)
+            if sha1_memo is not None:
+                if (_known_sha1 is None) or (_known_sha1 == sha1_memo):
+                    _pending_records.flushIfDue()
+                    return sha1_memo
+
+        aa = _get_stat_object(path, stat0=stat0)
         aa_hash = _compute_string_sha1(json.dumps(aa, sort_keys=True))
 
         path0 = self._get_path(aa_hash, create=True) + '.record.json'
@@ -163,6 +228,8 @@ class Sha1Cache():
                     bb = obj['stat']
                     if _stat_objects_match(aa, bb):
                         if obj.get('sha1', None):
+                            if stat0 is not None:
+                                _sha1_memo.set(memo_key, obj['sha1'])
                             return obj['sha1']
 
         if _known_sha1 is None:
@@ -175,30 +242,110 @@ class Sha1Cache():
         if not sha1:
             return None
 
+        if stat0 is not None:
+            _sha1_memo.set(memo_key, sha1)
+
         obj = dict(
             sha1=sha1,
             stat=aa
         )
-        try:
-            _write_json_file(obj, path0)
-        except:
-            print('Warning: problem writing .record.json file: ' + path0)
+        # The .record.json and .hints.json files are written in batches (see
+        # _PendingRecords)
+        _pending_records.add(path0, obj)
 
         path1 = self._get_path(sha1, create=True, directory=self.directory()) + '.hints.json'
-        if os.path.exists(path1):
-            hints = _read_json_file(path1, delete_on_error=True)
-        else:
-            hints = None
-        if not hints:
-            hints = {'files': []}
-        hints['files'].append(obj)
-        try:
-            _write_json_file(hints, path1)
-        except:
-            print('Warning: problem writing .hints.json file: ' + path1)
+        _pending_records.addHint(path1, obj)
         # todo: use hints for findFile
         return sha1
 
+    def flush(self) -> None:
+        """Write the pending .record.json and .hints.json files to disk"""
+        _pending_records.flush()
+
+    def cleanup(self, *, max_bytes: Optional[int]=None, policy: str='lru', pinned_sha1s: Optional[set]=None, max_temp_age: float=24 * 3600, dry_run: bool=False, verbose: bool=False) -> dict:
+        """Remove the orphaned .record.json/.hints.json files and stale
+        temporary files and, if max_bytes is given, evict files (except the
+        pinned ones) until the cache is within max_bytes. Only the primary
+        directory is cleaned up. See Sha1CacheManager."""
+        self.flush()
+        manager = self.manager()
+        if pinned_sha1s:
+            # for the files that are stored as chunks, pin the chunks instead
+            chunk_store = self.chunkStore()
+            pinned_sha1s = set(pinned_sha1s)
+            for sha1 in list(pinned_sha1s):
+                manifest = chunk_store.loadManifest(sha1)
+                if manifest and chunk_store.manifestIsComplete(manifest):
+                    pinned_sha1s.remove(sha1)
+                    pinned_sha1s.update([chunk_sha1 for chunk_sha1, _ in manifest['chunks']])
+        ret = dict(sweep=manager.sweep(max_temp_age=max_temp_age, dry_run=dry_run, verbose=verbose))
+        if max_bytes is not None:
+            ret['evict'] = manager.evict(max_bytes=max_bytes, policy=policy, pinned_sha1s=pinned_sha1s, dry_run=dry_run, verbose=verbose)
+        return ret
+
+    def computeFileSha1s(self, paths: List[str], *, num_threads: Optional[int]=None) -> List[Optional[str]]:
+        """computeFileSha1 for many files, using a pool of threads (hashlib
+        releases the GIL, so large files are hashed in parallel)"""
+        if num_threads is None:
+            num_threads = _default_num_hash_threads()
+        if (num_threads <= 1) or (len(paths) <= 1):
+            return [self.computeFileSha1(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            return list(executor.map(self.computeFileSha1, paths))
+
+    def computeFileSha1sInDir(self, dirpath: str, relpaths: List[str], *, num_threads: Optional[int]=None) -> List[Optional[str]]:
+        """Compute the sha1 of files in a directory (relpaths are relative to
+        dirpath), as computeFileSha1s. The stats and hashes of the files are
+        kept in an index for the directory, so that the next time only the
+        files whose stat changed are looked up or re-hashed."""
+        dirpath = os.path.abspath(dirpath)
+        index_path = self._get_dir_index_path(dirpath)
+        index = None
+        if os.path.exists(index_path):
+            index = _read_json_file(index_path, delete_on_error=True)
+        if (not index) or (index.get('path', None) != dirpath):
+            index = dict(path=dirpath, files=dict())
+        ret: List[Optional[str]] = [None for _ in relpaths]
+        new_files = dict()
+        inds_to_compute = []
+        for ii, relpath in enumerate(relpaths):
+            path0 = os.path.join(dirpath, relpath)
+            try:
+                stat0 = os.stat(path0)
+            except:
+                continue
+            stat_list = [stat0.st_ino, stat0.st_size, stat0.st_mtime_ns]
+            prev = index['files'].get(relpath, None)
+            if prev and (prev['stat'] == stat_list) and prev.get('sha1', None):
+                ret[ii] = prev['sha1']
+                _sha1_memo.set(_sha1_memo_key(path0, stat0), prev['sha1'])
+                new_files[relpath] = prev
+            else:
+                inds_to_compute.append((ii, stat_list))
+        sha1s = self.computeFileSha1s([os.path.join(dirpath, relpaths[ii]) for ii, _ in inds_to_compute], num_threads=num_threads)
+        for (ii, stat_list), sha1 in zip(inds_to_compute, sha1s):
+            ret[ii] = sha1
+            if sha1:
+                new_files[relpaths[ii]] = dict(stat=stat_list, sha1=sha1)
+        if (len(inds_to_compute) > 0) or (len(new_files) != len(index['files'])):
+            index['files'] = new_files
+            try:
+                _write_json_file(index, index_path)
+            except:
+                print('Warning: problem writing directory index file: ' + index_path)
+        return ret
+
+    def _get_dir_index_path(self, dirpath: str) -> str:
+        hash0 = _compute_string_sha1(dirpath)
+        dirname = os.path.join(self.directory(), 'dir_indexes', hash0[0], hash0[1:3])
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except:
+                if not os.path.exists(dirname):
+                    raise Exception('Unable to make directory: ' + dirname)
+        return os.path.join(dirname, hash0 + '.dir_index.json')
+
     def reportFileSha1(self, path: str, sha1: str) -> None:
         self.computeFileSha1(path, _known_sha1=sha1)
 
@@ -231,21 +378,32 @@ class Sha1Cache():
 def _compute_file_sha1(path: str) -> Optional[str]:
     if not os.path.exists(path):
         return None
-    if (os.path.getsize(path) > 1024 * 1024 * 100):
+    size = os.path.getsize(path)
+    if (size > 1024 * 1024 * 100):
         print('Computing sha1 of {}'.format(path))
-    BLOCKSIZE = 65536
+    # large reads into a reusable buffer (hashlib releases the GIL for large
+    # updates, so several files can be hashed in parallel threads)
+    BLOCKSIZE = min(1024 * 1024 * 16, max(size, 1))
     sha = hashlib.sha1()
-    with open(path, 'rb') as file:
-        buf = file.read(BLOCKSIZE)
-        while len(buf) > 0:
-            sha.update(buf)
-            buf = file.read(BLOCKSIZE)
+    buf = bytearray(BLOCKSIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            num = file.readinto(buf)
+            if not num:
+                break
+            sha.update(view[:num])
     return sha.hexdigest()
 
 
-def _get_stat_object(fname: str) -> Optional[Dict]:
+def _default_num_hash_threads() -> int:
+    return int(os.environ.get('MOUNTAIN_HASH_THREADS', min(os.cpu_count() or 1, 8)))
+
+
+def _get_stat_object(fname: str, stat0: Optional[os.stat_result]=None) -> Optional[Dict]:
     try:
-        stat0 = os.stat(fname)
+        if stat0 is None:
+            stat0 = os.stat(fname)
         obj = dict(
             path=fname,
             size=stat0.st_size,
@@ -258,6 +416,149 @@ def _get_stat_object(fname: str) -> Optional[Dict]:
         return None
 
 
+def _sha1_memo_key(path: str, stat0: os.stat_result) -> tuple:
+    return (path, stat0.st_ino, stat0.st_size, stat0.st_mtime_ns)
+
+
+class _Sha1Memo():
+    def __init__(self, max_size: int):
+        """Process-level LRU of file SHA-1 hashes, keyed by
+        (path, inode, size, mtime_ns), in front of the .record.json files"""
+        self._max_size = max_size
+        self._sha1s: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            sha1 = self._sha1s.get(key, None)
+            if sha1 is not None:
+                self._sha1s.move_to_end(key)
+            return sha1
+
+    def set(self, key: tuple, sha1: str) -> None:
+        with self._lock:
+            self._sha1s[key] = sha1
+            self._sha1s.move_to_end(key)
+            while len(self._sha1s) > self._max_size:
+                self._sha1s.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sha1s.clear()
+
+
+class _PendingRecords():
+    def __init__(self, *, max_num: int, max_age: float):
+        """The .record.json files waiting to be written, and the entries
+        waiting to be added to .hints.json files. They are written when
+        there are max_num of them, when the oldest is older than max_age
+        seconds (by a timer, since the hints are needed by findFile in other
+        processes), or at exit. Each .hints.json file is read and rewritten
+        once per flush, however many entries were added to it."""
+        self._max_num = max_num
+        self._max_age = max_age
+        self._records: Dict[str, dict] = dict()
+        # hints path -> file path -> entry
+        self._hints: Dict[str, Dict[str, dict]] = dict()
+        self._oldest_timestamp: Optional[float] = None
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+        if hasattr(os, 'register_at_fork'):
+            # the timer thread does not exist in a forked child
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def add(self, path: str, obj: dict) -> None:
+        with self._lock:
+            self._records[path] = obj
+            self._added()
+        self.flushIfDue()
+
+    def addHint(self, path: str, obj: dict) -> None:
+        with self._lock:
+            self._hints.setdefault(path, dict())[obj['stat']['path']] = obj
+            self._added()
+        self.flushIfDue()
+
+    def hasHints(self, path: str) -> bool:
+        return path in self._hints
+
+    def flushIfDue(self) -> None:
+        if self._oldest_timestamp is None:
+            return
+        if (len(self._records) + len(self._hints) >= self._max_num) or (time.time() - self._oldest_timestamp >= self._max_age):
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            records = self._records
+            hints = self._hints
+            self._records = dict()
+            self._hints = dict()
+            self._oldest_timestamp = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for path, obj in records.items():
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _write_json_file(obj, path)
+            except:
+                print('Warning: problem writing .record.json file: ' + path)
+        for path, objs in hints.items():
+            _add_to_hints_file(path, list(objs.values()))
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._timer = None
+        if self._oldest_timestamp is not None:
+            self._added()
+
+    def _added(self) -> None:
+        # (called with the lock held)
+        if self._oldest_timestamp is None:
+            self._oldest_timestamp = time.time()
+        if self._timer is None:
+            self._timer = threading.Timer(self._max_age, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+
+_sha1_memo = _Sha1Memo(max_size=100000)
+_pending_records = _PendingRecords(max_num=100, max_age=2)
+
+# Max. number of files listed in a .hints.json file
+_MAX_NUM_HINTS = 20
+
+
+def _add_to_hints_file(path: str, objs: List[dict]) -> None:
+    # Add (or replace) the entries for the files in the .hints.json file,
+    # dropping entries for files that have changed or no longer exist, so
+    # that the file does not grow without bound.
+    if os.path.exists(path):
+        hints = _read_json_file(path, delete_on_error=True)
+    else:
+        hints = None
+    if not hints:
+        hints = {'files': []}
+    # most recent first
+    files = list(reversed(objs))
+    new_paths = set([obj['stat']['path'] for obj in objs])
+    for file in hints['files']:
+        path0 = file['stat']['path']
+        if path0 in new_paths:
+            continue
+        stat_obj0 = _get_stat_object(path0)
+        if (stat_obj0 is None) or (not _stat_objects_match(stat_obj0, file['stat'])):
+            continue
+        files.append(file)
+    hints['files'] = files[0:_MAX_NUM_HINTS]
+    try:
+        _write_json_file(hints, path)
+    except:
+        print('Warning: problem writing .hints.json file: ' + path)
+
+
 def _stat_objects_match(aa: object, bb: object) -> bool:
     str1 = json.dumps(aa, sort_keys=True)
     str2 = json.dumps(bb, sort_keys=True)
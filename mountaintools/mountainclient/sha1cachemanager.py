@@ -0,0 +1,375 @@
+import atexit
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional, List, Dict, Set, Iterable, Any
+
+_SHA1_PATTERN = re.compile('^[0-9a-f]{40}$')
+_SHA1_URL_PATTERN = re.compile('sha1(?:dir)?://([0-9a-f]{40})')
+
+# suffixes of the temporary files written to the cache (see Sha1Cache,
+# steady_download_and_compute_sha1 and kachery uploads)
+_TEMP_FILE_PATTERN = re.compile(r'\.(downloading|copying|uploading|tmp)\.')
+
+
+class Sha1CacheManager():
+    def __init__(self, directory: str):
+        """Keeps the size of a SHA-1 cache directory under control.
+
+        - Records accesses to the cached files (in
+          <directory>/access_records.sqlite), if enabled with the
+          MOUNTAIN_RECORD_CACHE_ACCESSES environment variable. This is off by
+          default, since the cache directory may be shared over NFS by many
+          hosts. Without the records, the modification times of the files
+          are used.
+        - Evicts the least recently (lru) or least frequently (lfu) used files
+          when the cache exceeds a byte budget, except for pinned files
+        - Sweeps orphaned .record.json/.hints.json/lock files, stale
+          temporary files and directory indexes
+
+        Parameters
+        ----------
+        directory : str
+            The SHA-1 cache directory
+        """
+        self._directory = directory
+
+    def directory(self) -> str:
+        return self._directory
+
+    def recordAccess(self, sha1: str) -> None:
+        if not _access_recording_enabled():
+            return
+        _access_recorder.record(self._directory, sha1)
+
+    def cacheSize(self) -> Dict[str, int]:
+        """The number and total size of the cached files"""
+        num_files = 0
+        num_bytes = 0
+        for _, _, stat0 in self._iterate_cached_files():
+            num_files = num_files + 1
+            num_bytes = num_bytes + stat0.st_size
+        return dict(num_files=num_files, num_bytes=num_bytes)
+
+    def evict(self, *, max_bytes: int, policy: str='lru', pinned_sha1s: Optional[Set[str]]=None, dry_run: bool=False, verbose: bool=False) -> Dict[str, Any]:
+        """Remove cached files until the total size is at most max_bytes.
+        The partial (.sparse) files of remote range reads count towards the
+        total (by their allocated size) and are evicted by modification time.
+
+        Parameters
+        ----------
+        max_bytes : int
+            The byte budget
+        policy : str, optional
+            'lru' (least recently used first) or 'lfu' (least frequently used
+            first, then least recently used), by default 'lru'
+        pinned_sha1s : set of str, optional
+            Files that are never evicted
+        dry_run : bool, optional
+            If True, only report what would be removed
+        """
+        if policy not in ['lru', 'lfu']:
+            raise Exception('Invalid eviction policy: {}'.format(policy))
+        if pinned_sha1s is None:
+            pinned_sha1s = set()
+        _access_recorder.flush()
+        access_records = _read_access_records(self._directory)
+        files = []
+        total_bytes = 0
+        for sha1, path, stat0 in self._iterate_cached_files():
+            total_bytes = total_bytes + stat0.st_size
+            if sha1 in pinned_sha1s:
+                continue
+            # files without access records were last used when they were added
+            last_access, num_accesses = access_records.get(sha1, (stat0.st_mtime, 0))
+            files.append((sha1, path, stat0.st_size, last_access, num_accesses))
+        for sha1, path, stat0 in self._iterate_partial_files():
+            # only the blocks that were downloaded take space
+            size = min(stat0.st_size, stat0.st_blocks * 512)
+            total_bytes = total_bytes + size
+            if sha1 in pinned_sha1s:
+                continue
+            files.append((sha1, path, size, stat0.st_mtime, 0))
+        if policy == 'lru':
+            files.sort(key=lambda f: f[3])
+        else:
+            files.sort(key=lambda f: (f[4], f[3]))
+        ret: Dict[str, Any] = dict(total_bytes=total_bytes, removed_files=0, removed_bytes=0)
+        removed_sha1s = []
+        for sha1, path, size, _, _ in files:
+            if total_bytes - ret['removed_bytes'] <= max_bytes:
+                break
+            if verbose:
+                print('Evicting {} ({} bytes)'.format(path, size))
+            if (not dry_run) and (not _safe_remove_file(path)):
+                continue
+            ret['removed_files'] = ret['removed_files'] + 1
+            ret['removed_bytes'] = ret['removed_bytes'] + size
+            if path.endswith('.sparse'):
+                if not dry_run:
+                    _safe_remove_file(path + '.blocks.json')
+            else:
+                removed_sha1s.append(sha1)
+        if not dry_run:
+            _delete_access_records(self._directory, removed_sha1s)
+        return ret
+
+    def sweep(self, *, max_temp_age: float=24 * 3600, dry_run: bool=False, verbose: bool=False) -> Dict[str, Any]:
+        """Remove orphaned metadata and stale temporary files.
+
+        - .record.json files of files that have changed or no longer exist
+        - .hints.json files that no longer list any valid file
+        - temporary (.downloading.*, .copying.*, ...) and partial (.sparse)
+          files older than max_temp_age seconds, and their
+          .progress.json/.blocks.json/.lock files
+        - .lock files without the locked file, older than max_temp_age
+        - directory indexes of directories that no longer exist
+        - manifests of chunked files (see ChunkStore) whose chunks are missing
+        """
+        from .sha1cache import _get_stat_object, _stat_objects_match
+
+        ret: Dict[str, Any] = dict(removed_files=0, removed_bytes=0)
+        now = time.time()
+
+        def remove(path: str, reason: str) -> None:
+            try:
+                size = os.path.getsize(path)
+            except:
+                return
+            if verbose:
+                print('Removing {} ({})'.format(path, reason))
+            if dry_run or _safe_remove_file(path):
+                ret['removed_files'] = ret['removed_files'] + 1
+                ret['removed_bytes'] = ret['removed_bytes'] + size
+
+        for dirpath, _, fnames in os.walk(self._directory):
+            fnames_set = set(fnames)
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                if fname.endswith('.record.json'):
+                    obj = _read_json(path)
+                    if (not obj) or ('stat' not in obj):
+                        remove(path, 'invalid record')
+                        continue
+                    stat_obj0 = _get_stat_object(obj['stat'].get('path', ''))
+                    if (stat_obj0 is None) or (not _stat_objects_match(stat_obj0, obj['stat'])):
+                        remove(path, 'orphaned record')
+                elif fname.endswith('.hints.json'):
+                    obj = _read_json(path)
+                    files = (obj or dict()).get('files', [])
+                    if not any([_stat_objects_match(_get_stat_object(f['stat']['path']), f['stat']) for f in files]):
+                        remove(path, 'orphaned hints')
+                elif fname.endswith('.chunks.json'):
+                    obj = _read_json(path)
+                    if (not obj) or (not all([os.path.exists(self._path_of(chunk_sha1)) for chunk_sha1, _ in obj.get('chunks', [])])):
+                        remove(path, 'incomplete chunk manifest')
+                elif fname.endswith('.dir_index.json'):
+                    obj = _read_json(path)
+                    if (not obj) or (not os.path.isdir(obj.get('path', ''))):
+                        remove(path, 'orphaned directory index')
+                elif _TEMP_FILE_PATTERN.search(fname) or _has_temp_suffix(fname):
+                    if _file_age(path, now) > max_temp_age:
+                        remove(path, 'stale temporary file')
+                elif fname.endswith('.lock'):
+                    if (fname[:-5] not in fnames_set) and (_file_age(path, now) > max_temp_age):
+                        remove(path, 'orphaned lock file')
+        return ret
+
+    def _path_of(self, sha1: str) -> str:
+        return os.path.join(self._directory, sha1[0], sha1[1:3], sha1)
+
+    def _iterate_cached_files(self):
+        # The cached files are <directory>/a/bc/abc... (see Sha1Cache._get_path)
+        for name1 in _safe_list_dir(self._directory):
+            if len(name1) != 1:
+                continue
+            path1 = os.path.join(self._directory, name1)
+            for name2 in _safe_list_dir(path1):
+                path2 = os.path.join(path1, name2)
+                for name3 in _safe_list_dir(path2):
+                    if not _SHA1_PATTERN.match(name3):
+                        continue
+                    path3 = os.path.join(path2, name3)
+                    try:
+                        stat0 = os.stat(path3)
+                    except:
+                        continue
+                    yield name3, path3, stat0
+
+    def _iterate_partial_files(self):
+        # The sparse files of RemoteFileRangeCache (see
+        # MountainClientLocal.readFileBytesFromUrl): <directory>/a/bc/<sha1>.sparse
+        # and <directory>/range_cache/a/bc/<hash of url>.sparse
+        for base in [self._directory, os.path.join(self._directory, 'range_cache')]:
+            for name1 in _safe_list_dir(base):
+                if len(name1) != 1:
+                    continue
+                path1 = os.path.join(base, name1)
+                for name2 in _safe_list_dir(path1):
+                    path2 = os.path.join(path1, name2)
+                    for name3 in _safe_list_dir(path2):
+                        if not name3.endswith('.sparse'):
+                            continue
+                        path3 = os.path.join(path2, name3)
+                        try:
+                            stat0 = os.stat(path3)
+                        except:
+                            continue
+                        yield name3[:-len('.sparse')], path3, stat0
+
+
+def find_referenced_sha1s(values: Iterable[str], load_object=None) -> Set[str]:
+    """The sha1 hashes referenced (as sha1:// or sha1dir:// urls) by values,
+    e.g., the values of the local database (job results). If load_object is
+    given, the directory indexes of sha1dir:// urls are loaded with
+    load_object(sha1) and the files in the directories are included."""
+    ret: Set[str] = set()
+    dir_sha1s: Set[str] = set()
+    for value in values:
+        if not value:
+            continue
+        for m in _SHA1_URL_PATTERN.finditer(value):
+            ret.add(m.group(1))
+            if m.group(0).startswith('sha1dir://'):
+                dir_sha1s.add(m.group(1))
+    if load_object is not None:
+        for sha1 in dir_sha1s:
+            dd = load_object(sha1)
+            if dd:
+                _add_dir_sha1s(dd, ret)
+    return ret
+
+
+def _add_dir_sha1s(dd: dict, ret: Set[str]) -> None:
+    for file0 in dd.get('files', {}).values():
+        if file0.get('sha1', None):
+            ret.add(file0['sha1'])
+    for dd0 in dd.get('dirs', {}).values():
+        _add_dir_sha1s(dd0, ret)
+
+
+class _AccessRecorder():
+    def __init__(self, *, max_num: int, max_age: float):
+        # Accesses are collected in memory and written in batches
+        self._max_num = max_num
+        self._max_age = max_age
+        self._accesses: Dict[str, Dict[str, List]] = dict()  # by directory, by sha1: [last access, num accesses]
+        self._num = 0
+        self._oldest_timestamp: Optional[float] = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def record(self, directory: str, sha1: str) -> None:
+        now = time.time()
+        with self._lock:
+            if directory not in self._accesses:
+                self._accesses[directory] = dict()
+            aa = self._accesses[directory]
+            if sha1 in aa:
+                aa[sha1][0] = now
+                aa[sha1][1] = aa[sha1][1] + 1
+            else:
+                aa[sha1] = [now, 1]
+                self._num = self._num + 1
+            if self._oldest_timestamp is None:
+                self._oldest_timestamp = now
+            due = (self._num >= self._max_num) or (now - self._oldest_timestamp >= self._max_age)
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            accesses = self._accesses
+            self._accesses = dict()
+            self._num = 0
+            self._oldest_timestamp = None
+        for directory, aa in accesses.items():
+            try:
+                conn = _connect_access_records(directory)
+                with conn:
+                    conn.executemany(
+                        'INSERT INTO access_records (sha1, last_access, num_accesses) VALUES (?, ?, ?) '
+                        'ON CONFLICT(sha1) DO UPDATE SET last_access=MAX(last_access, excluded.last_access), num_accesses=num_accesses+excluded.num_accesses',
+                        [(sha1, v[0], v[1]) for sha1, v in aa.items()]
+                    )
+                conn.close()
+            except Exception as e:
+                print('Warning: problem writing access records for {}: {}'.format(directory, e))
+
+
+_access_recorder = _AccessRecorder(max_num=1000, max_age=30)
+
+
+def _access_recording_enabled() -> bool:
+    return (os.environ.get('MOUNTAIN_RECORD_CACHE_ACCESSES', 'FALSE') == 'TRUE')
+
+
+def _connect_access_records(directory: str) -> sqlite3.Connection:
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(directory, 'access_records.sqlite'), timeout=60)
+    # a rollback journal rather than WAL, which requires shared memory and so
+    # does not work when the directory is shared between hosts (e.g., NFS)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS access_records (sha1 TEXT PRIMARY KEY, last_access REAL NOT NULL, num_accesses INTEGER NOT NULL) WITHOUT ROWID')
+    return conn
+
+
+def _read_access_records(directory: str) -> Dict[str, tuple]:
+    if not os.path.exists(os.path.join(directory, 'access_records.sqlite')):
+        return dict()
+    conn = _connect_access_records(directory)
+    try:
+        return dict([(row[0], (row[1], row[2])) for row in conn.execute('SELECT sha1, last_access, num_accesses FROM access_records')])
+    finally:
+        conn.close()
+
+
+def _delete_access_records(directory: str, sha1s: List[str]) -> None:
+    if (not sha1s) or (not os.path.exists(os.path.join(directory, 'access_records.sqlite'))):
+        return
+    conn = _connect_access_records(directory)
+    try:
+        with conn:
+            conn.executemany('DELETE FROM access_records WHERE sha1=?', [(sha1,) for sha1 in sha1s])
+    finally:
+        conn.close()
+
+
+def _has_temp_suffix(fname: str) -> bool:
+    # .sparse and .blocks.json are partial files of RemoteFileRangeCache
+    return any([fname.endswith(suffix) for suffix in ['.progress.json', '.tmp', '.sparse', '.sparse.blocks.json']])
+
+
+def _read_json(path: str) -> Any:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def _file_age(path: str, now: float) -> float:
+    try:
+        return now - os.path.getmtime(path)
+    except:
+        return 0
+
+
+def _safe_list_dir(path: str) -> List[str]:
+    try:
+        return os.listdir(path)
+    except:
+        return []
+
+
+def _safe_remove_file(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except:
+        print('Warning: unable to remove file: ' + path)
+        return False
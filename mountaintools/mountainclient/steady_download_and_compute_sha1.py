@@ -1,34 +1,203 @@
-import string
-import random
 import hashlib
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import requests
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, Tuple
 
 
-def steady_download_and_compute_sha1(url, target_path, chunk_size=1024 * 1024 * 10):
-    response = requests.head(url)
+def steady_download_and_compute_sha1(url, target_path, chunk_size=1024 * 1024 * 10, num_threads=None, num_tries=3, rate_limiter=None):
+    """Download the file at url into target_path using concurrent byte-range
+    requests, and return the sha1 hash of its content.
+
+    The file is preallocated and the ranges are written in place as they
+    arrive. The sha1 is computed in order as contiguous ranges complete. The
+    completed ranges are recorded in <target_path>.progress.json, so that if
+    the download is interrupted, calling this again with the same
+    target_path resumes where it left off. Therefore target_path should be a
+    temporary path that is renamed by the caller once the hash is checked.
+
+    Parameters
+    ----------
+    url : str
+        The url of the file (the server must support range requests)
+    target_path : str
+        Where to write the file
+    chunk_size : int, optional
+        The size of the byte ranges, by default 10 MB
+    num_threads : int, optional
+        The number of concurrent requests, by default from the
+        MOUNTAIN_DOWNLOAD_THREADS environment variable, or 4. The requests
+        of all the downloads in the process also share a budget of
+        connections (MOUNTAIN_DOWNLOAD_MAX_CONNECTIONS, by default 32).
+    num_tries : int, optional
+        The number of attempts for each range, by default 3
+    rate_limiter : ByteRateLimiter, optional
+        A byte-rate budget, possibly shared by several downloads
+
+    Returns
+    -------
+    str
+        The sha1 hash of the downloaded file
+    """
+    if num_threads is None:
+        num_threads = int(os.environ.get('MOUNTAIN_DOWNLOAD_THREADS', 4))
+    session, connection_slots = _get_session()
+    with connection_slots:
+        response = session.head(url)
+    response.raise_for_status()
     size_bytes = int(response.headers['content-length'])
-    str = ''.join(random.sample(string.ascii_lowercase, 8))
-    path_tmp = target_path + '.tmp.' + str
+    num_chunks = int((size_bytes + chunk_size - 1) / chunk_size)
+
+    progress_path = target_path + '.progress.json'
+    completed = _load_progress(progress_path=progress_path, target_path=target_path, size=size_bytes, chunk_size=chunk_size)
+    if completed is None:
+        completed = set()
+        with open(target_path, 'wb') as f:
+            f.truncate(size_bytes)
+        _save_progress(progress_path=progress_path, size=size_bytes, chunk_size=chunk_size, completed=completed)
+
+    def chunk_range(ind):
+        return ind * chunk_size, min((ind + 1) * chunk_size, size_bytes)
+
+    def download_chunk(ind):
+        i1, i2 = chunk_range(ind)
+        for try_num in range(1, num_tries + 1):
+            try:
+                with connection_slots:
+                    response = session.get(url, headers={'Range': 'bytes={}-{}'.format(i1, i2 - 1)}, timeout=60)
+                    response.raise_for_status()
+                    data = response.content
+                if len(data) != i2 - i1:
+                    raise Exception('Unexpected size of range {}-{} of {}: {}'.format(i1, i2 - 1, url, len(data)))
+                break
+            except Exception:
+                if try_num == num_tries:
+                    raise
+                print('Problem downloading range {}-{} of {}. Retrying...'.format(i1, i2 - 1, url))
+        if rate_limiter is not None:
+            rate_limiter.consume(len(data))
+        with open(target_path, 'r+b') as f:
+            f.seek(i1)
+            f.write(data)
+        return data
+
+    hh = hashlib.sha1()
+    next_ind_to_hash = 0
+    pending_data: Dict[int, bytes] = dict()  # downloaded ranges that cannot be hashed yet
+    inds_to_download = [ind for ind in range(num_chunks) if ind not in completed]
+    # limit the number of ranges that are held in memory waiting to be hashed
+    max_ahead = max(2 * num_threads, 2)
+    futures = dict()
+    with open(target_path, 'rb') as f_read, ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        try:
+            while next_ind_to_hash < num_chunks:
+                # hash what we can in order
+                while next_ind_to_hash < num_chunks:
+                    if next_ind_to_hash in pending_data:
+                        hh.update(pending_data.pop(next_ind_to_hash))
+                    elif next_ind_to_hash in completed:
+                        # completed in a previous (interrupted) download
+                        i1, i2 = chunk_range(next_ind_to_hash)
+                        f_read.seek(i1)
+                        hh.update(f_read.read(i2 - i1))
+                    else:
+                        break
+                    next_ind_to_hash = next_ind_to_hash + 1
+                if next_ind_to_hash >= num_chunks:
+                    break
+                # keep the workers busy
+                while inds_to_download and (len(futures) < num_threads) and (inds_to_download[0] < next_ind_to_hash + max_ahead):
+                    ind = inds_to_download.pop(0)
+                    futures[executor.submit(download_chunk, ind)] = ind
+                done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    ind = futures.pop(future)
+                    pending_data[ind] = future.result()
+                    completed.add(ind)
+                _save_progress(progress_path=progress_path, size=size_bytes, chunk_size=chunk_size, completed=completed)
+        except:
+            for future in futures.keys():
+                future.cancel()
+            raise
+    _safe_remove_file(progress_path)
+    return hh.hexdigest()
+
+
+class ByteRateLimiter():
+    def __init__(self, max_bytes_per_sec: float):
+        """A budget of bytes per second, shared by the threads that call
+        consume(). consume() blocks as needed to keep the average rate below
+        max_bytes_per_sec."""
+        self._max_bytes_per_sec = max_bytes_per_sec
+        self._next_time = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, num_bytes: int) -> None:
+        with self._lock:
+            now = time.time()
+            start = max(self._next_time, now)
+            self._next_time = start + num_bytes / self._max_bytes_per_sec
+            delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def remove_partial_download(target_path):
+    """Remove the files of a (possibly interrupted) download to target_path"""
+    _safe_remove_file(target_path)
+    _safe_remove_file(target_path + '.progress.json')
+
+
+_sessions: Dict[int, Tuple[requests.Session, threading.BoundedSemaphore]] = dict()
+_sessions_lock = threading.Lock()
+
+
+def _get_session() -> Tuple[requests.Session, threading.BoundedSemaphore]:
+    # One pooled session per process, reused across downloads, and the slots
+    # that limit the requests in flight (over all the concurrent downloads,
+    # e.g., of realizeFiles) to the size of its pool, so that connections
+    # are not discarded when the pool is full
+    key = os.getpid()
+    with _sessions_lock:
+        if key not in _sessions:
+            max_connections = max(int(os.environ.get('MOUNTAIN_DOWNLOAD_MAX_CONNECTIONS', 32)), 1)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = (session, threading.BoundedSemaphore(max_connections))
+        return _sessions[key]
+
+
+def _load_progress(*, progress_path: str, target_path: str, size: int, chunk_size: int) -> Optional[set]:
+    if not os.path.exists(progress_path) or not os.path.exists(target_path):
+        return None
+    try:
+        with open(progress_path, 'r') as f:
+            progress = json.load(f)
+    except:
+        return None
+    if (progress.get('size', None) != size) or (progress.get('chunk_size', None) != chunk_size):
+        return None
+    if os.path.getsize(target_path) != size:
+        return None
+    return set(progress.get('completed', []))
+
+
+def _save_progress(*, progress_path: str, size: int, chunk_size: int, completed: set) -> None:
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(size=size, chunk_size=chunk_size, completed=sorted(completed)), f)
+    os.replace(tmp_path, progress_path)
+
+
+def _safe_remove_file(fname: str) -> None:
     try:
-        hh = hashlib.sha1()
-        with open(path_tmp, 'wb') as f:
-            for ii in range(0, size_bytes, chunk_size):
-                jj = ii + chunk_size
-                if jj > size_bytes:
-                    jj = size_bytes
-                headers = {
-                    'Range': 'bytes={}-{}'.format(ii, jj - 1)
-                }
-                response = requests.get(url, headers=headers, stream=True)
-                for chunk in response.iter_content(chunk_size=5120):
-                    if chunk:  # filter out keep-alive new chunks
-                        hh.update(chunk)
-                        f.write(chunk)
-        os.rename(path_tmp, target_path)
-        sha1 = hh.hexdigest()
-        return sha1
+        if os.path.exists(fname):
+            os.remove(fname)
     except:
-        if os.path.exists(path_tmp):
-            os.remove(path_tmp)
-        raise
+        print('Warning: unable to remove file that we thought existed: ' + fname)
@@ -0,0 +1,330 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from typing import Optional, Dict, Tuple, Any
+from .mountainremoteclient import _sha1_of_object
+
+# Lightweight pure-Python implementations of the kachery and pairio http
+# servers (see kachery/src/kacheryserver.js and
+# pairioserver/pairioserver/pairioserver.js), for testing and benchmarking
+# the client locally. These are not meant for production use.
+#
+# Example usage:
+# ```
+# with KacheryTestServer(directory='/tmp/kachery', upload_token='test') as K:
+#     paths = mt.realizeFiles(sha1_urls, download_from=K.url())
+#     print('Number of requests:', K.numRequests())
+# ```
+
+MAX_KEY_LENGTH = 40
+MAX_VALUE_LENGTH = 10000
+MAX_BATCH_SIZE = 1000
+
+
+class _TestServer():
+    def __init__(self, *, port: int=0, batch: bool=True):
+        """Base class of the test servers.
+
+        Parameters
+        ----------
+        port : int, optional
+            The listen port, by default 0 (choose a free port)
+        batch : bool, optional
+            Whether to support the batch endpoints, by default True. Use
+            False to emulate an older server.
+        """
+        self._port = port
+        self._batch = batch
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._num_requests = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        server_obj = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server_obj._handle(self, 'GET')
+
+            def do_HEAD(self):
+                server_obj._handle(self, 'HEAD')
+
+            def do_POST(self):
+                server_obj._handle(self, 'POST')
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self._port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def url(self) -> str:
+        assert self._server is not None, 'Server is not running'
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def numRequests(self) -> int:
+        """The number of http requests (round trips) handled so far"""
+        return self._num_requests
+
+    def resetNumRequests(self) -> None:
+        self._num_requests = 0
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str) -> None:
+        with self._lock:
+            self._num_requests = self._num_requests + 1
+        parsed = urlparse(handler.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        body = None
+        if method == 'POST':
+            num_bytes = int(handler.headers.get('Content-Length', 0))
+            body = handler.rfile.read(num_bytes)
+        try:
+            self._route(handler, method, parsed.path, query, body)
+        except Exception as e:
+            _send_error(handler, 500, str(e))
+
+    def _route(self, handler: BaseHTTPRequestHandler, method: str, path: str, query: Dict[str, str], body: Optional[bytes]) -> None:
+        raise NotImplementedError()
+
+
+class KacheryTestServer(_TestServer):
+    def __init__(self, *, directory: str, upload_token: str, download_token: Optional[str]=None, port: int=0, batch: bool=True):
+        """A kachery server storing files in directory (as
+        directory/ab/cd/ef/abcdef...)"""
+        _TestServer.__init__(self, port=port, batch=batch)
+        self._directory = directory
+        self._upload_token = upload_token
+        self._download_token = download_token
+
+    def _route(self, handler, method, path, query, body):
+        if path == '/probe':
+            _send_json(handler, dict(success=True))
+            return
+        if (path == '/check/sha1') and (method == 'POST') and self._batch:
+            sha1s = json.loads(body.decode('utf-8')).get('sha1s', None)
+            if type(sha1s) != list:
+                _send_error(handler, 500, 'Missing or invalid sha1s in request body.')
+                return
+            if len(sha1s) > MAX_BATCH_SIZE:
+                _send_error(handler, 500, 'Too many sha1s: {}>{}'.format(len(sha1s), MAX_BATCH_SIZE))
+                return
+            results = []
+            for sha1 in sha1s:
+                if (type(sha1) != str) or (len(sha1) != 40):
+                    results.append(dict(found=False, size=0, error='Invalid sha1 string.'))
+                else:
+                    results.append(self._check(sha1))
+            _send_json(handler, dict(success=True, results=results))
+            return
+        m = re.match(r'^/(check|get|set)/sha1/([^/]*)$', path)
+        if not m:
+            _send_error(handler, 404, 'Cannot {} {}'.format(method, path))
+            return
+        op, sha1 = m.group(1), m.group(2)
+        if len(sha1) != 40:
+            _send_error(handler, 500, 'Invalid sha1 string.')
+            return
+        if (op == 'check') and (method == 'GET'):
+            obj = self._check(sha1)
+            obj['success'] = True
+            _send_json(handler, obj)
+        elif (op == 'get') and (method in ['GET', 'HEAD']):
+            if self._download_token:
+                if not _verify_signature('/get/sha1/' + sha1, query.get('signature', None), self._download_token):
+                    _send_error(handler, 500, 'Invalid signature')
+                    return
+            fname = self._path(sha1)
+            if not os.path.exists(fname):
+                _send_error(handler, 404, 'File not found.')
+                return
+            _send_file(handler, fname, head_only=(method == 'HEAD'))
+        elif (op == 'set') and (method == 'POST'):
+            if not _verify_signature('/set/sha1/' + sha1, query.get('signature', None), self._upload_token):
+                _send_error(handler, 500, 'Invalid signature')
+                return
+            if hashlib.sha1(body).hexdigest() != sha1:
+                _send_error(handler, 500, 'SHA-1 does not match')
+                return
+            fname = self._path(sha1)
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            tmp_fname = fname + '.uploading.{}'.format(threading.get_ident())
+            with open(tmp_fname, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_fname, fname)
+            _send_json(handler, dict(success=True, message='Uploaded {} bytes'.format(len(body))))
+        else:
+            _send_error(handler, 404, 'Cannot {} {}'.format(method, path))
+
+    def _check(self, sha1: str) -> dict:
+        fname = self._path(sha1)
+        if os.path.exists(fname):
+            return dict(found=True, size=os.path.getsize(fname))
+        return dict(found=False, size=0)
+
+    def _path(self, sha1: str) -> str:
+        return os.path.join(self._directory, sha1[0:2], sha1[2:4], sha1[4:6], sha1)
+
+
+class PairioTestServer(_TestServer):
+    def __init__(self, *, admin_token: str, port: int=0, batch: bool=True):
+        """A pairio server storing the key/value pairs in memory"""
+        _TestServer.__init__(self, port=port, batch=batch)
+        self._admin_token = admin_token
+        self._collection_tokens: Dict[str, str] = dict()
+        self._pairs: Dict[Tuple[str, str, Optional[str]], str] = dict()
+        self._pairs_lock = threading.Lock()
+
+    def addCollection(self, collection: str, token: str) -> None:
+        self._collection_tokens[collection] = token
+
+    def _route(self, handler, method, path, query, body):
+        parts = path.split('/')[1:]
+        if (method == 'POST') and (len(parts) == 2) and (parts[0] == 'get') and self._batch:
+            keys = json.loads(body.decode('utf-8')).get('keys', None)
+            if type(keys) != list:
+                _send_json(handler, dict(success=False, error='Missing or invalid keys in request body'))
+                return
+            if len(keys) > MAX_BATCH_SIZE:
+                _send_json(handler, dict(success=False, error='Too many keys'))
+                return
+            results = []
+            for item in keys:
+                item = item or dict()
+                if (type(item.get('key', None)) != str) or (len(item['key']) > MAX_KEY_LENGTH):
+                    results.append(dict(success=False, error='Invalid key'))
+                elif (item.get('subkey', None)) and (len(item['subkey']) > MAX_KEY_LENGTH):
+                    results.append(dict(success=False, error='Invalid subkey'))
+                else:
+                    results.append(self._get(parts[1], item['key'], item.get('subkey', None) or None))
+            _send_json(handler, dict(success=True, results=results))
+            return
+        if method != 'GET':
+            _send_error(handler, 404, 'Cannot {} {}'.format(method, path))
+            return
+        if (parts[0] == 'get') and (len(parts) in [3, 4]):
+            if (len(parts[2]) > MAX_KEY_LENGTH) or ((len(parts) == 4) and (len(parts[3]) > MAX_KEY_LENGTH)):
+                _send_json(handler, dict(success=False, error='Invalid key'))
+                return
+            _send_json(handler, self._get(parts[1], parts[2], parts[3] if len(parts) == 4 else None))
+        elif (parts[0] in ['set', 'remove']) and (len(parts) in [3, 4, 5]):
+            collection = parts[1]
+            token = self._collection_tokens.get(collection, None)
+            if (not token) or (not _verify_signature(path, query.get('signature', None), token)):
+                _send_json(handler, dict(success=False, error='Invalid signature'))
+                return
+            key = parts[2]
+            if parts[0] == 'set':
+                if len(parts) == 3:
+                    _send_json(handler, dict(success=False, error='Missing value'))
+                    return
+                subkey = parts[3] if len(parts) == 5 else None
+                value: Optional[str] = base64.b64decode(parts[-1]).decode('utf-8')
+            else:
+                subkey = parts[3] if len(parts) == 4 else None
+                value = None
+            if value and (len(value) > MAX_VALUE_LENGTH):
+                _send_json(handler, dict(success=False, error='Length of value is too long'))
+                return
+            _send_json(handler, self._set(collection, key, subkey, value, overwrite=(query.get('overwrite', 'true') != 'false')))
+        elif (parts[0] == 'admin') and (len(parts) == 4) and (parts[1] == 'create'):
+            if not _verify_signature(path, query.get('signature', None), self._admin_token):
+                _send_json(handler, dict(success=False, error='Invalid signature'))
+                return
+            self._collection_tokens[parts[2]] = parts[3]
+            _send_json(handler, dict(success=True, token=parts[3]))
+        else:
+            _send_error(handler, 404, 'Cannot {} {}'.format(method, path))
+
+    def _get(self, collection: str, key: str, subkey: Optional[str]) -> dict:
+        with self._pairs_lock:
+            if subkey == '-':
+                val00 = {k[2]: v for k, v in self._pairs.items() if (k[0] == collection) and (k[1] == key) and (k[2] is not None)}
+                return dict(success=True, value=json.dumps(val00))
+            value = self._pairs.get((collection, key, subkey), None)
+        if not value:
+            return dict(success=False, error='Pair not found.')
+        return dict(success=True, value=value)
+
+    def _set(self, collection: str, key: str, subkey: Optional[str], value: Optional[str], overwrite: bool) -> dict:
+        with self._pairs_lock:
+            if not value:
+                if subkey == '-':
+                    for k in [k for k in self._pairs.keys() if (k[0] == collection) and (k[1] == key) and (k[2] is not None)]:
+                        del self._pairs[k]
+                else:
+                    self._pairs.pop((collection, key, subkey), None)
+            elif subkey == '-':
+                return dict(success=False, error='Error setting collection pair: Cannot set value with subkey of "-"')
+            else:
+                if (not overwrite) and ((collection, key, subkey) in self._pairs):
+                    return dict(success=False, error='Error setting collection pair: Key exists -- cannot overwrite.')
+                self._pairs[(collection, key, subkey)] = value
+        return dict(success=True)
+
+
+def _verify_signature(path: str, signature: Optional[str], token: str) -> bool:
+    return (signature is not None) and (signature == _sha1_of_object({'path': path, 'token': token}))
+
+
+def _send_json(handler: BaseHTTPRequestHandler, obj: Any) -> None:
+    data = json.dumps(obj).encode('utf-8')
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', str(len(data)))
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+def _send_error(handler: BaseHTTPRequestHandler, code: int, message: str) -> None:
+    data = message.encode('utf-8')
+    handler.send_response(code)
+    handler.send_header('Content-Length', str(len(data)))
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+def _send_file(handler: BaseHTTPRequestHandler, fname: str, head_only: bool) -> None:
+    size = os.path.getsize(fname)
+    i1, i2 = 0, size
+    range_header = handler.headers.get('Range', None)
+    m = re.match(r'^bytes=(\d+)-(\d*)$', range_header or '')
+    if m:
+        i1 = int(m.group(1))
+        if m.group(2):
+            i2 = min(int(m.group(2)) + 1, size)
+        handler.send_response(206)
+        handler.send_header('Content-Range', 'bytes {}-{}/{}'.format(i1, i2 - 1, size))
+    else:
+        handler.send_response(200)
+    handler.send_header('Accept-Ranges', 'bytes')
+    handler.send_header('Content-Length', str(i2 - i1))
+    handler.end_headers()
+    if head_only:
+        return
+    with open(fname, 'rb') as f:
+        f.seek(i1)
+        handler.wfile.write(f.read(i2 - i1))
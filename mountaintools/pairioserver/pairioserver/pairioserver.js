@@ -21,6 +21,21 @@ GET:/get/[collection]/[key]/[subkey]
     error:[string:error]
   }
 
+POST:/get/[collection]
+
+  Get many values in one request. The body of the POST request is the JSON
+  of the following object
+  {
+    keys:[list of {key:[string:key], subkey:[string:subkey (optional)]}]
+  }
+
+  Returns the JSON of the following object
+  {
+    success:[boolean:success],
+    results:[list of {success, value, error} as for GET:/get/..., in the order of keys],
+    error:[string:error]
+  }
+
 GET:/set/[collection]/[key]/[value]?signature=[signature]
 
   Returns the JSON of the following object
@@ -111,6 +126,7 @@ const fs = require('fs');
 const MAX_KEY_LENGTH = 40;
 //const MAX_VALUE_LENGTH=40;
 const MAX_VALUE_LENGTH = 10000; // should be 80
+const MAX_BATCH_SIZE = 1000;
 
 const MONGODB_URL = process.env.MONGODB_URL || 'mongodb://localhost:27017'
 
@@ -161,6 +177,57 @@ function PairioServer(API) {
         res.json(obj);
     }
 
+    // API POST /get/:collection
+    m_app.post('/get/:collection', async function(req, res) {
+        let params = req.params;
+        let keys = (req.body || {}).keys;
+        if (!Array.isArray(keys)) {
+            res.json({
+                success: false,
+                error: 'Missing or invalid keys in request body'
+            });
+            return;
+        }
+        if (keys.length > MAX_BATCH_SIZE) {
+            res.json({
+                success: false,
+                error: 'Too many keys'
+            });
+            return;
+        }
+        let results = [];
+        for (let item of keys) {
+            item = item || {};
+            if ((typeof(item.key) != 'string') || (item.key.length > MAX_KEY_LENGTH)) {
+                results.push({
+                    success: false,
+                    error: 'Invalid key'
+                });
+                continue;
+            }
+            if ((item.subkey) && (item.subkey.length > MAX_KEY_LENGTH)) {
+                results.push({
+                    success: false,
+                    error: 'Invalid subkey'
+                });
+                continue;
+            }
+            try {
+                results.push(await API.get(params.collection, item.key, item.subkey || null));
+            } catch (err) {
+                console.error(err);
+                results.push({
+                    success: false,
+                    error: err.message
+                });
+            }
+        }
+        res.json({
+            success: true,
+            results: results
+        });
+    });
+
     // API /set/:collection/:key/:value
     m_app.get('/set/:collection/:key/:value', async function(req, res) {
         let query = req.query;
@@ -20,7 +20,9 @@ setuptools.setup(
         'bin/mt-resolve-key-path',
         'bin/mt-find',
         'bin/kachery-token',
-        'bin/mt-execute-job'
+        'bin/mt-execute-job',
+        'bin/mt-migrate-local-database',
+        'bin/mt-cleanup-cache'
     ],
     install_requires=[
         'matplotlib', 'requests', 'ipython', 'simple-crypt', 'python-dotenv', 'simplejson'
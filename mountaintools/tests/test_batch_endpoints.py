@@ -0,0 +1,65 @@
+import hashlib
+import os
+from mountainclient import MountainClient
+from mountainclient.mountainremoteclient import MountainRemoteClient
+from mountainclient.testservers import KacheryTestServer, PairioTestServer
+
+
+def _make_client(tmp_path, monkeypatch, pairio_url='http://pairio.org'):
+    monkeypatch.setenv('MOUNTAIN_DIR', str(tmp_path / 'mountain'))
+    monkeypatch.setenv('SHA1_CACHE_DIR', str(tmp_path / 'sha1-cache'))
+    monkeypatch.setenv('PAIRIO_URL', pairio_url)
+    os.makedirs(str(tmp_path / 'mountain'), exist_ok=True)
+    return MountainClient()
+
+
+def _check_realize_files(tmp_path, monkeypatch, batch):
+    with KacheryTestServer(directory=str(tmp_path / 'kachery'), upload_token='test', batch=batch) as K:
+        mt = _make_client(tmp_path, monkeypatch)
+        contents = [os.urandom(1000 + ii) for ii in range(3)]
+        for content in contents:
+            sha1 = hashlib.sha1(content).hexdigest()
+            fname = os.path.join(str(tmp_path / 'kachery'), sha1[0:2], sha1[2:4], sha1[4:6], sha1)
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(fname, 'wb') as f:
+                f.write(content)
+        missing = [hashlib.sha1(str(ii).encode()).hexdigest() for ii in range(1000)]
+        paths = ['sha1://' + hashlib.sha1(content).hexdigest() + '/file.dat' for content in contents] + ['sha1://' + sha1 for sha1 in missing]
+
+        K.resetNumRequests()
+        ret = mt.realizeFiles(paths, download_from=K.url())
+        for content, path in zip(contents, ret[:len(contents)]):
+            with open(path, 'rb') as f:
+                assert f.read() == content
+        assert ret[len(contents):] == [None] * len(missing)
+        num_downloads = 2 * len(contents)  # HEAD and GET for each file
+        return K.numRequests() - num_downloads
+
+
+def test_realize_files_batch(tmp_path, monkeypatch):
+    # 1003 lookups in 3 round trips (batches of 500)
+    assert _check_realize_files(tmp_path, monkeypatch, batch=True) == 3
+
+
+def test_realize_files_older_server(tmp_path, monkeypatch):
+    # the failed batch request, then one request per file
+    assert _check_realize_files(tmp_path, monkeypatch, batch=False) == 1 + 1003
+
+
+def test_get_values_batch(tmp_path, monkeypatch):
+    for batch in [True, False]:
+        with PairioTestServer(admin_token='admin', batch=batch) as P:
+            P.addCollection('coll1', 'token1')
+            mt = _make_client(tmp_path, monkeypatch, pairio_url=P.url())
+            remote_client = MountainRemoteClient()
+            for ii in range(10):
+                assert remote_client.setValue(collection='coll1', key=dict(name='key', index=ii), subkey=None, value='value{}'.format(ii), url=P.url(), token='token1')
+            keys = [dict(name='key', index=ii) for ii in range(1000)]
+
+            P.resetNumRequests()
+            values = mt.getValues(keys=keys, collection='coll1')
+            assert values == ['value{}'.format(ii) for ii in range(10)] + [None] * 990
+            if batch:
+                assert P.numRequests() == 2
+            else:
+                assert P.numRequests() == 1 + 1000
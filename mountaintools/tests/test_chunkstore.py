@@ -0,0 +1,142 @@
+import hashlib
+import os
+import numpy as np
+from mountainclient.sha1cache import Sha1Cache
+from mountainclient.chunkstore import compute_chunk_boundaries
+
+CHUNK_SIZE = 16 * 1024
+
+
+def _make_cache(tmp_path):
+    cache = Sha1Cache()
+    cache.setDirectory(str(tmp_path / 'sha1-cache'))
+    return cache
+
+
+def _random_bytes(num_bytes, seed):
+    return np.random.RandomState(seed).randint(0, 256, size=num_bytes, dtype=np.uint8).tobytes()
+
+
+def _write_file(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def _store(cache, path):
+    sha1 = cache.computeFileSha1(path)
+    manifest = cache.chunkStore().storeFile(path, sha1=sha1, method='cdc', chunk_size=CHUNK_SIZE)
+    return sha1, manifest
+
+
+def test_chunk_store_round_trip(tmp_path):
+    cache = _make_cache(tmp_path)
+    data = _random_bytes(1000 * 1000, seed=1)
+    path = _write_file(tmp_path / 'a.dat', data)
+
+    boundaries = compute_chunk_boundaries(path, method='cdc', chunk_size=CHUNK_SIZE)
+    assert boundaries[-1] == len(data)
+    sizes = np.diff([0] + boundaries)
+    assert np.all(sizes[:-1] >= CHUNK_SIZE // 4)
+    assert np.all(sizes <= CHUNK_SIZE * 4)
+
+    sha1, manifest = _store(cache, path)
+    assert manifest['size'] == len(data)
+    assert np.cumsum([size for _, size in manifest['chunks']]).tolist() == boundaries
+    assert cache.chunkStore().manifestIsComplete(manifest)
+
+    target = str(tmp_path / 'reassembled.dat')
+    assert cache.chunkStore().reassemble(sha1, target) == target
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+
+def test_chunk_store_read_range(tmp_path):
+    cache = _make_cache(tmp_path)
+    data = _random_bytes(300 * 1000, seed=2)
+    path = _write_file(tmp_path / 'a.dat', data)
+    sha1, manifest = _store(cache, path)
+    assert len(manifest['chunks']) > 3
+
+    chunk_store = cache.chunkStore()
+    first_boundary = manifest['chunks'][0][1]
+    ranges = [
+        (0, 10),
+        (first_boundary - 5, first_boundary + 5),  # across a chunk boundary
+        (1000, 250 * 1000),  # across many chunks
+        (len(data) - 10, len(data) + 100),  # past the end
+        (500, 500)
+    ]
+    for start, end in ranges:
+        assert chunk_store.readRange(sha1, start, end) == data[start:end]
+    assert chunk_store.readRange(hashlib.sha1(b'not stored').hexdigest(), 0, 10) is None
+
+
+def test_chunk_store_dedup_shared_prefix(tmp_path):
+    cache = _make_cache(tmp_path)
+    prefix = _random_bytes(600 * 1000, seed=3)
+    path_a = _write_file(tmp_path / 'a.dat', prefix + _random_bytes(400 * 1000, seed=4))
+    path_b = _write_file(tmp_path / 'b.dat', prefix + _random_bytes(400 * 1000, seed=5))
+    # the same content shifted by a few bytes, so fixed-size chunks would not line up
+    path_c = _write_file(tmp_path / 'c.dat', b'shifted' + prefix)
+
+    _, manifest_a = _store(cache, path_a)
+    _, manifest_b = _store(cache, path_b)
+    _, manifest_c = _store(cache, path_c)
+
+    chunks_a = set([chunk_sha1 for chunk_sha1, _ in manifest_a['chunks']])
+    prefix_chunks_a = set()
+    offset = 0
+    for chunk_sha1, size in manifest_a['chunks']:
+        offset = offset + size
+        if offset <= len(prefix):
+            prefix_chunks_a.add(chunk_sha1)
+    assert len(prefix_chunks_a) > 10
+    for manifest in [manifest_b, manifest_c]:
+        chunks = set([chunk_sha1 for chunk_sha1, _ in manifest['chunks']])
+        # all but the chunks at the ends of the shared content are shared
+        assert len(prefix_chunks_a - chunks) <= 2
+    # the shared chunks are stored once
+    all_chunks = chunks_a | set([chunk_sha1 for chunk_sha1, _ in manifest_b['chunks'] + manifest_c['chunks']])
+    stored_chunks = [chunk_sha1 for chunk_sha1 in all_chunks if cache.chunkStore()._find_chunk(chunk_sha1) is not None]
+    assert len(stored_chunks) == len(all_chunks)
+    assert len(all_chunks) < len(manifest_a['chunks']) + len(manifest_b['chunks']) + len(manifest_c['chunks'])
+
+
+def test_cleanup_pins_chunks(tmp_path, monkeypatch):
+    monkeypatch.setenv('SHA1_CACHE_CHUNKING', 'cdc')
+    monkeypatch.setenv('SHA1_CACHE_CHUNK_SIZE', str(CHUNK_SIZE))
+    cache = _make_cache(tmp_path)
+    data_pinned = _random_bytes(200 * 1000, seed=6)
+    data_other = _random_bytes(200 * 1000, seed=7)
+    _, sha1_pinned = cache.copyFileToCache(_write_file(tmp_path / 'pinned.dat', data_pinned), return_path=False)
+    _, sha1_other = cache.copyFileToCache(_write_file(tmp_path / 'other.dat', data_other), return_path=False)
+    # stored as chunks, not as whole files
+    assert cache.chunkStore().loadManifest(sha1_pinned) is not None
+    # so that the files are only available from the cache
+    os.remove(str(tmp_path / 'pinned.dat'))
+    os.remove(str(tmp_path / 'other.dat'))
+
+    ret = cache.cleanup(max_bytes=0, pinned_sha1s=set([sha1_pinned]))
+    assert ret['evict']['removed_files'] > 0
+
+    # the chunks of the pinned file were kept, so it can be reassembled
+    path = cache.findFile(sha1_pinned)
+    assert path is not None
+    with open(path, 'rb') as f:
+        assert f.read() == data_pinned
+    assert cache.findFile(sha1_other) is None
+
+
+def test_copy_file_to_cache_returns_cache_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('SHA1_CACHE_CHUNKING', 'cdc')
+    monkeypatch.setenv('SHA1_CACHE_CHUNK_SIZE', str(CHUNK_SIZE))
+    cache = _make_cache(tmp_path)
+    data = _random_bytes(100 * 1000, seed=8)
+    source_path = _write_file(tmp_path / 'source.dat', data)
+    path, sha1 = cache.copyFileToCache(source_path)
+    # a file in the cache, not the source file (which may be temporary)
+    assert path == cache._get_path(sha1, create=False)
+    os.remove(source_path)
+    with open(path, 'rb') as f:
+        assert f.read() == data
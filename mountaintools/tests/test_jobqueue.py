@@ -0,0 +1,101 @@
+import random
+import mlprocessors as mlpr
+from mountaintools import client as mt
+
+_calls = []
+
+
+class RepeatTextQ(mlpr.Processor):
+    NAME = 'RepeatTextQ'
+    VERSION = '0.1.0'
+    textfile = mlpr.Input(help="input text file")
+    textfile_out = mlpr.Output(help="output text file")
+    num_repeats = mlpr.IntegerParameter(help="Number of times to repeat the text")
+
+    def run(self):
+        _calls.append(self.num_repeats)
+        assert self.num_repeats >= 0
+        with open(self.textfile, 'r') as f:
+            txt = f.read()
+        with open(self.textfile_out, 'w') as f:
+            f.write(txt * self.num_repeats)
+
+
+def _write_random_text(tmp_path):
+    # random content, so that the jobs are not found in the cache from an earlier run
+    txt = 'text {}\n'.format(random.random())
+    path = str(tmp_path / 'input.txt')
+    with open(path, 'w') as f:
+        f.write(txt)
+    return path, txt
+
+
+def test_jobqueue_chain(tmp_path):
+    path, txt = _write_random_text(tmp_path)
+    del _calls[:]
+    with mlpr.JobQueue() as JQ:
+        r1 = RepeatTextQ.execute(textfile=path, textfile_out=dict(ext='.txt'), num_repeats=2)
+        r2 = RepeatTextQ.execute(textfile=r1.outputs['textfile_out'], textfile_out=dict(ext='.txt'), num_repeats=3)
+        r3 = RepeatTextQ.execute(textfile=r2.outputs['textfile_out'], textfile_out=dict(ext='.txt'), num_repeats=4)
+        # queued, but not run yet
+        assert not r3.isFinished()
+        JQ.wait()
+        metrics = JQ.metrics()
+    # each job ran once, in the order of the dependencies
+    assert _calls == [2, 3, 4]
+    for r in [r1, r2, r3]:
+        assert r.retcode == 0
+    assert mt.loadText(path=r3.outputs['textfile_out']) == txt * 24
+    assert metrics['num_finished'] == 3
+    assert metrics['num_waiting'] == 0
+    assert metrics['num_running'] == 0
+    assert metrics['run_time']['max'] is not None
+
+
+def test_jobqueue_failing_upstream(tmp_path):
+    path, txt = _write_random_text(tmp_path)
+    del _calls[:]
+    with mlpr.JobQueue() as JQ:
+        r_failing = RepeatTextQ.execute(textfile=path, textfile_out=dict(ext='.txt'), num_repeats=-1)
+        r_dependent = RepeatTextQ.execute(textfile=r_failing.outputs['textfile_out'], textfile_out=dict(ext='.txt'), num_repeats=2)
+        r_dependent2 = RepeatTextQ.execute(textfile=r_dependent.outputs['textfile_out'], textfile_out=dict(ext='.txt'), num_repeats=3)
+        r_independent = RepeatTextQ.execute(textfile=path, textfile_out=dict(ext='.txt'), num_repeats=5)
+        failing_output = r_failing.outputs['textfile_out']  # (pending)
+        JQ.wait()
+        # a job queued after its upstream job failed fails right away
+        r_late = RepeatTextQ.execute(textfile=failing_output, textfile_out=dict(ext='.txt'), num_repeats=6)
+        assert r_late.isFinished()
+    assert r_failing.retcode not in [0, 7]
+    # the failure cascades to the dependents (transitively), which never run
+    assert r_dependent.retcode == 7
+    assert r_dependent2.retcode == 7
+    assert r_late.retcode == 7
+    assert r_independent.retcode == 0
+    assert sorted(_calls) == [-1, 5]
+    assert mt.loadText(path=r_independent.outputs['textfile_out']) == txt * 5
+
+
+def test_jobqueue_cache_hits(tmp_path):
+    path, txt = _write_random_text(tmp_path)
+    del _calls[:]
+    # run once outside of a job queue, to store the results in the cache
+    r = RepeatTextQ.execute(textfile=path, textfile_out=dict(ext='.txt'), num_repeats=2)
+    assert r.retcode == 0
+    assert _calls == [2]
+
+    with mlpr.JobQueue(num_cache_check_workers=2) as JQ:
+        r1 = RepeatTextQ.execute(textfile=path, textfile_out=dict(ext='.txt'), num_repeats=2)
+        r2 = RepeatTextQ.execute(textfile=r1.outputs['textfile_out'], textfile_out=dict(ext='.txt'), num_repeats=3)
+        r3 = RepeatTextQ.execute(textfile=path, textfile_out=dict(ext='.txt'), num_repeats=2, _force_run=True)
+        JQ.wait()
+        # the cached result was loaded by the pool of the cache checker
+        assert JQ._cache_checker._executor is not None
+        assert JQ._cache_checker.numPending() == 0
+    # r1 was found in the cache (loaded by the cache checker), r2 was not in
+    # the cache, and r3 was forced to run
+    assert sorted(_calls) == [2, 2, 3]
+    assert r1.retcode == 0
+    assert mt.loadText(path=r1.outputs['textfile_out']) == txt * 2
+    assert r2.retcode == 0
+    assert mt.loadText(path=r2.outputs['textfile_out']) == txt * 6
+    assert r3.retcode == 0
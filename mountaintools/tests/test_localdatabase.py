@@ -0,0 +1,118 @@
+import hashlib
+import pytest
+from mountainclient.localdatabase import LocalDatabaseFiles, LocalDatabaseSqlite, open_local_database, migrate_local_database
+
+
+def _keyhash(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _open(tmp_path, backend):
+    return open_local_database(str(tmp_path / 'database'), backend=backend)
+
+
+@pytest.mark.parametrize('backend', ['files', 'sqlite'])
+def test_local_database_get_set(tmp_path, backend):
+    db = _open(tmp_path, backend)
+    k1 = _keyhash('key1')
+    assert db.getValue(k1) is None
+    assert db.setValue(k1, None, 'value1', overwrite=False)
+    assert db.getValue(k1) == 'value1'
+    # not overwritten
+    assert not db.setValue(k1, None, 'value2', overwrite=False)
+    assert db.getValue(k1) == 'value1'
+    assert db.setValue(k1, None, 'value2', overwrite=True)
+    assert db.getValue(k1) == 'value2'
+    # deleted
+    assert not db.setValue(k1, None, None, overwrite=False)
+    assert db.getValue(k1) == 'value2'
+    assert db.setValue(k1, None, None, overwrite=True)
+    assert db.getValue(k1) is None
+
+    # subkeys
+    k2 = _keyhash('key2')
+    assert db.getSubKeys(k2) == []
+    assert db.setValue(k2, 'a', 'value_a', overwrite=False)
+    assert db.setValue(k2, 'b', 'value_b', overwrite=False)
+    assert not db.setValue(k2, 'a', 'value_a2', overwrite=False)
+    assert db.getValue(k2, 'a') == 'value_a'
+    assert db.getValue(k2, 'c') is None
+    assert sorted(db.getSubKeys(k2)) == ['a', 'b']
+    assert db.getAllSubKeyValues(k2) == dict(a='value_a', b='value_b')
+    assert db.setValue(k2, 'a', None, overwrite=True)
+    assert db.getAllSubKeyValues(k2) == dict(b='value_b')
+    db.deleteSubKeys(k2)
+    assert db.getSubKeys(k2) == []
+    # the subkeys are separate from the value of the key
+    assert db.getValue(k2) is None
+
+
+@pytest.mark.parametrize('backend', ['files', 'sqlite'])
+def test_local_database_get_set_values(tmp_path, backend):
+    db = _open(tmp_path, backend)
+    keyhashes = [_keyhash('key{}'.format(i)) for i in range(1200)]
+    assert db.getValues(keyhashes) == dict()
+    assert db.setValues([(k, 'v' + k) for k in keyhashes[:1000]], overwrite=False) == [True] * 1000
+    ret = db.setValues([(keyhashes[0], 'new'), (keyhashes[1100], 'new')], overwrite=False)
+    assert ret == [False, True]
+    values = db.getValues(keyhashes)
+    assert len(values) == 1001
+    assert values[keyhashes[0]] == 'v' + keyhashes[0]
+    assert values[keyhashes[1100]] == 'new'
+    assert keyhashes[1050] not in values
+
+
+def test_local_database_backends_agree(tmp_path):
+    dbs = [LocalDatabaseFiles(str(tmp_path / 'files')), LocalDatabaseSqlite(str(tmp_path / 'sqlite'))]
+    operations = [
+        ('key1', None, 'a', False),
+        ('key1', None, 'b', False),
+        ('key2', None, 'c', True),
+        ('key2', None, 'd', True),
+        ('key3', 's1', 'e', False),
+        ('key3', 's1', 'f', False),
+        ('key3', 's2', 'g', True),
+        ('key1', None, None, False),
+        ('key2', None, None, True),
+    ]
+    for key, subkey, value, overwrite in operations:
+        rets = [db.setValue(_keyhash(key), subkey, value, overwrite) for db in dbs]
+        assert rets[0] == rets[1]
+    for db in dbs:
+        assert sorted(db.iterateItems()) == sorted([
+            (_keyhash('key1'), None, 'a'),
+            (_keyhash('key3'), 's1', 'e'),
+            (_keyhash('key3'), 's2', 'g'),
+        ])
+
+
+def test_migrate_local_database(tmp_path):
+    path = str(tmp_path / 'database')
+    src = LocalDatabaseFiles(path)
+    items = [(_keyhash('key{}'.format(i)), None, 'value{}'.format(i)) for i in range(50)]
+    items = items + [(_keyhash('key_with_subkeys'), 'sub{}'.format(i), 'subvalue{}'.format(i)) for i in range(5)]
+    for keyhash, subkey, value in items:
+        src.setValue(keyhash, subkey, value, overwrite=False)
+    # the directory database is used until it is migrated
+    assert isinstance(open_local_database(path), LocalDatabaseFiles)
+
+    assert migrate_local_database(path=path) == len(items)
+    db = open_local_database(path)
+    assert isinstance(db, LocalDatabaseSqlite)
+    assert sorted(db.iterateItems(), key=str) == sorted(items, key=str)
+    assert db.getAllSubKeyValues(_keyhash('key_with_subkeys')) == dict([('sub{}'.format(i), 'subvalue{}'.format(i)) for i in range(5)])
+    # the directory database is left in place
+    assert sorted(src.iterateItems(), key=str) == sorted(items, key=str)
+
+    # migrating again keeps the values that are already in the sqlite database
+    db.setValue(_keyhash('key0'), None, 'changed', overwrite=True)
+    src.setValue(_keyhash('new_key'), None, 'new_value', overwrite=False)
+    assert migrate_local_database(path=path) == len(items) + 1
+    assert db.getValue(_keyhash('key0')) == 'changed'
+    assert db.getValue(_keyhash('new_key')) == 'new_value'
+
+    # and the migrated database can be exported back to the directory layout
+    dest = LocalDatabaseFiles(str(tmp_path / 'database2'))
+    for keyhash, subkey, value in db.iterateItems():
+        dest.setValue(keyhash, subkey, value, overwrite=False)
+    assert sorted(dest.iterateItems(), key=str) == sorted(db.iterateItems(), key=str)
@@ -1,78 +1,76 @@
 from .filterrecording import FilterRecording
 import numpy as np
+import os
+import threading
+from collections import OrderedDict
 from scipy import special
+try:
+    # scipy.fft keeps float32 input in single precision and releases the GIL
+    from scipy import fft as _fft
+except ImportError:
+    from numpy import fft as _fft
 
 
 class BandpassFilterRecording(FilterRecording):
-    def __init__(self, *, recording, freq_min, freq_max, freq_wid):
-        FilterRecording.__init__(self, recording=recording, chunk_size=3000 * 10)
+    def __init__(self, *, recording, freq_min, freq_max, freq_wid, dtype=None, num_threads=None):
+        if num_threads is None:
+            # one thread by default, since several filtering jobs often run
+            # side by side (one per worker)
+            num_threads = int(os.environ.get('SPIKEFOREST_FILTER_NUM_THREADS', 1))
+        FilterRecording.__init__(self, recording=recording, chunk_size=3000 * 10, num_threads=num_threads)
+        self._recording = recording
         self._params = dict(
             name='bandpass_filter',
             freq_min=freq_min,
             freq_max=freq_max,
             freq_wid=freq_wid
         )
-        self._recording = recording
+        if dtype is None:
+            dtype = 'float64'
+        self._dtype = np.dtype(dtype)
+        if self._dtype != np.float64:
+            self._params['dtype'] = self._dtype.name
+        # the chunks are filtered in parallel, but the underlying recording is read by one thread at a time
+        self._read_lock = threading.Lock()
 
     def paramsForHash(self):
         return self._params
 
     def filterChunk(self, *, start_frame, end_frame):
+        # overlap-save: filter the padded chunk and keep the part that is unaffected by wrap-around
         padding = 3000
         i1 = start_frame - padding
         i2 = end_frame + padding
-        padded_chunk = self._read_chunk(i1, i2)
+        with self._read_lock:
+            padded_chunk = self._read_chunk(i1, i2)
         if i1 < 0:
-            for m in range(padded_chunk.shape[0]):
-                padded_chunk[m, :-i1] = padded_chunk[m, -i1]
+            padded_chunk[:, :-i1] = padded_chunk[:, -i1][:, np.newaxis]
         if i2 > self._recording.get_num_frames():
-            for m in range(padded_chunk.shape[0]):
-                aa = (i2 - self._recording.get_num_frames())
-                padded_chunk[m, -aa:] = padded_chunk[m, aa - 1]
+            aa = (i2 - self._recording.get_num_frames())
+            padded_chunk[:, -aa:] = padded_chunk[:, aa - 1][:, np.newaxis]
         filtered_padded_chunk = self._do_filter(padded_chunk)
         return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
 
     def _create_filter_kernel(self, N, samplerate, freq_min, freq_max, freq_wid=1000):
-        # Matches ahb's code /matlab/processors/ms_bandpass_filter.m
-        # improved ahb, changing tanh to erf, correct -3dB pts  6/14/16
-        T = N / samplerate  # total time
-        df = 1 / T  # frequency grid
-        relwid = 3.0  # relative bottom-end roll-off width param, kills low freqs by factor 1e-5.
-
-        k_inds = np.arange(0, N)
-        k_inds = np.where(k_inds <= (N + 1) / 2, k_inds, k_inds - N)
-
-        fgrid = df * k_inds
-        absf = np.abs(fgrid)
-
-        val = np.ones(fgrid.shape)
-        if freq_min != 0:
-            val = val * (1 + special.erf(relwid * (absf - freq_min) / freq_min)) / 2  # pylint: disable=no-member
-            val = np.where(np.abs(k_inds) < 0.1, 0, val)  # kill DC part exactly
-        if freq_max != 0:
-            val = val * (1 - special.erf((absf - freq_max) / freq_wid)) / 2  # pylint: disable=no-member
-        val = np.sqrt(val)  # note sqrt of filter func to apply to spectral intensity not ampl
-        return val
+        return _create_filter_kernel(N, samplerate, freq_min, freq_max, freq_wid)
 
     def _do_filter(self, chunk):
         samplerate = self._recording.get_sampling_frequency()
-        M = chunk.shape[0]
-        chunk2 = chunk
         # Subtract off the mean of each channel unless we are doing only a low-pass filter
         # if self._params['freq_min']!=0:
         #    for m in range(M):
         #        chunk2[m,:]=chunk2[m,:]-np.mean(chunk2[m,:])
         # Do the actual filtering with a DFT with real input
-        chunk_fft = np.fft.rfft(chunk2)
-        kernel = self._create_filter_kernel(
-            chunk2.shape[1],
+        chunk_fft = _fft.rfft(chunk, axis=1)
+        kernel = _get_rfft_filter_kernel(
+            chunk.shape[1],
             samplerate,
-            self._params['freq_min'], self._params['freq_max'], self._params['freq_wid']
+            self._params['freq_min'], self._params['freq_max'], self._params['freq_wid'],
+            dtype=chunk_fft.real.dtype
         )
-        kernel = kernel[0:chunk_fft.shape[1]]  # because this is the DFT of real data
-        chunk_fft = chunk_fft * np.tile(kernel, (M, 1))
-        chunk_filtered = np.fft.irfft(chunk_fft)
-        return chunk_filtered
+        chunk_fft *= kernel
+        chunk_filtered = _fft.irfft(chunk_fft, n=chunk.shape[1], axis=1)
+        return chunk_filtered.astype(self._dtype, copy=False)
 
     def _read_chunk(self, i1, i2):
         M = len(self._recording.get_channel_ids())
@@ -85,15 +83,65 @@ class BandpassFilterRecording(FilterRecording):
             i2b = N
         else:
             i2b = i2
-        ret = np.zeros((M, i2 - i1))
+        ret = np.zeros((M, i2 - i1), dtype=self._dtype)
         ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b)
         return ret
 
 
-def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, resample=None):
+def _create_filter_kernel(N, samplerate, freq_min, freq_max, freq_wid=1000):
+    # Matches ahb's code /matlab/processors/ms_bandpass_filter.m
+    # improved ahb, changing tanh to erf, correct -3dB pts  6/14/16
+    T = N / samplerate  # total time
+    df = 1 / T  # frequency grid
+    relwid = 3.0  # relative bottom-end roll-off width param, kills low freqs by factor 1e-5.
+
+    k_inds = np.arange(0, N)
+    k_inds = np.where(k_inds <= (N + 1) / 2, k_inds, k_inds - N)
+
+    fgrid = df * k_inds
+    absf = np.abs(fgrid)
+
+    val = np.ones(fgrid.shape)
+    if freq_min != 0:
+        val = val * (1 + special.erf(relwid * (absf - freq_min) / freq_min)) / 2  # pylint: disable=no-member
+        val = np.where(np.abs(k_inds) < 0.1, 0, val)  # kill DC part exactly
+    if freq_max != 0:
+        val = val * (1 - special.erf((absf - freq_max) / freq_wid)) / 2  # pylint: disable=no-member
+    val = np.sqrt(val)  # note sqrt of filter func to apply to spectral intensity not ampl
+    return val
+
+
+# The kernels only depend on the chunk size, samplerate and band, so they are
+# computed once and shared by all chunks (and all filter objects). The most
+# recently used ones are kept.
+_filter_kernels = OrderedDict()
+_filter_kernels_lock = threading.Lock()
+_max_num_filter_kernels = 16
+
+
+def _get_rfft_filter_kernel(N, samplerate, freq_min, freq_max, freq_wid, *, dtype):
+    key = (N, samplerate, freq_min, freq_max, freq_wid, np.dtype(dtype).str)
+    with _filter_kernels_lock:
+        kernel = _filter_kernels.get(key, None)
+        if kernel is not None:
+            _filter_kernels.move_to_end(key)
+    if kernel is None:
+        kernel = _create_filter_kernel(N, samplerate, freq_min, freq_max, freq_wid)
+        kernel = kernel[0:N // 2 + 1].astype(dtype)  # because this is the DFT of real data
+        kernel.flags.writeable = False
+        with _filter_kernels_lock:
+            _filter_kernels[key] = kernel
+            while len(_filter_kernels) > _max_num_filter_kernels:
+                _filter_kernels.popitem(last=False)
+    return kernel
+
+
+def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, resample=None, dtype=None, num_threads=None):
     return BandpassFilterRecording(
         recording=recording,
         freq_min=freq_min,
         freq_max=freq_max,
         freq_wid=freq_wid,
+        dtype=dtype,
+        num_threads=num_threads
     )
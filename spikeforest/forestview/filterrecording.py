@@ -1,14 +1,17 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 import spikeextractors as se
 import numpy as np
 from mountaintools import client as mt
 
 
 class FilterRecording(se.RecordingExtractor):
-    def __init__(self, *, recording, chunk_size=10000):
+    def __init__(self, *, recording, chunk_size=10000, num_threads=1):
         se.RecordingExtractor.__init__(self)
         self._recording = recording
         self._chunk_size = chunk_size
+        # filterChunk must be thread-safe for num_threads > 1
+        self._num_threads = num_threads
         self.copy_channel_properties(recording)
 
     def paramsForHash(self):
@@ -42,9 +45,10 @@ class FilterRecording(se.RecordingExtractor):
             channel_ids = self.get_channel_ids()
         ich1 = int(start_frame / self._chunk_size)
         ich2 = int((end_frame - 1) / self._chunk_size)
+        filtered_chunks = self._get_filtered_chunks(range(ich1, ich2 + 1))
         filtered_chunk_list = []
         for ich in range(ich1, ich2 + 1):
-            filtered_chunk0 = self._get_filtered_chunk(ich)
+            filtered_chunk0 = filtered_chunks[ich]
             if ich == ich1:
                 start0 = start_frame - ich * self._chunk_size
             else:
@@ -61,6 +65,14 @@ class FilterRecording(se.RecordingExtractor):
     def filterChunk(self, *, start_frame, end_frame):
         raise NotImplementedError('filterChunk not implemented')
 
+    def _get_filtered_chunks(self, inds):
+        # filter the chunks in parallel
+        inds = list(inds)
+        if (self._num_threads <= 1) or (len(inds) <= 1):
+            return dict([(ind, self._get_filtered_chunk(ind)) for ind in inds])
+        with ThreadPoolExecutor(max_workers=min(self._num_threads, len(inds))) as executor:
+            return dict(zip(inds, executor.map(self._get_filtered_chunk, inds)))
+
     def _get_filtered_chunk(self, ind):
         start0 = ind * self._chunk_size
         end0 = (ind + 1) * self._chunk_size
@@ -1,9 +1,11 @@
 import numpy as np
+import copy
+import io
 import struct
 import os
-import requests
-import tempfile
 import traceback
+import threading
+from collections import OrderedDict
 
 
 class MdaHeader:
@@ -53,7 +55,11 @@ def npy_dtype_to_string(dt):
 class DiskReadMda:
     def __init__(self, path, header=None):
         self._npy_mode = False
+        if path.startswith('sha1dir://'):
+            # resolve the directory index once, rather than on every read
+            path = _resolve_sha1dir_url(path)
         self._path = path
+        self._memmap_array = None
         if (file_extension(path) == '.npy'):
             raise Exception('DiskReadMda implementation has not been tested for npy files')
             # self._npy_mode = True
@@ -92,8 +98,17 @@ class DiskReadMda:
             return A.itemsize
         return self._header.num_bytes_per_entry
 
-    def readChunk(self, i1=-1, i2=-1, i3=-1, N1=1, N2=1, N3=1):
+    def readChunk(self, i1=-1, i2=-1, i3=-1, N1=1, N2=1, N3=1, copy=True):
+        # For local files the chunk is read from a read-only memory map of the
+        # file. With copy=False it may be a (read-only) view into that map.
         # print("Reading chunk {} {} {} {} {} {}".format(i1,i2,i3,N1,N2,N3))
+        if not self._npy_mode:
+            A = self._memmap()
+            if A is not None:
+                X = self._read_chunk_from_memmap(A, i1=i1, i2=i2, i3=i3, N1=N1, N2=N2, N3=N3)
+                if (X is not None) and copy:
+                    X = np.array(X)
+                return X
         if (i2 < 0):
             if self._npy_mode:
                 A = np.load(self._path, mmap_mode='r')
@@ -124,16 +139,54 @@ class DiskReadMda:
             X = self._read_chunk_1d(i1 + N1 * i2 + N1 * N2 * i3, N1 * N2 * N3)
             return np.reshape(X, (N1, N2, N3), order='F')
 
+    def _memmap(self):
+        # The header is only read once, so the map is also made once per reader
+        if self._memmap_array is None:
+            if is_url(self._path):
+                return None
+            self._memmap_array = _get_memmap(self._path, self._header)
+        return self._memmap_array
+
+    def _read_chunk_from_memmap(self, A, *, i1, i2, i3, N1, N2, N3):
+        # Returns views into the memory map (no copy)
+        if (i2 < 0):
+            if (i1 < 0) or (i1 + N1 > A.size):
+                print('Problem reading chunk from file: ' + self._path)
+                return None
+            return A[i1:i1 + N1]
+        elif (i3 < 0):
+            if N1 != self.N1():
+                print("Unable to support N1 {} != {}".format(N1, self.N1()))
+                return None
+            if (i1 != 0) or (A.size % N1 != 0) or (i2 + N2 > A.size // N1):
+                # not aligned with the columns, fall back to the flat view
+                X = self._read_chunk_from_memmap(A, i1=i1 + N1 * i2, i2=-1, i3=-1, N1=N1 * N2, N2=1, N3=1)
+                if X is None:
+                    return None
+                return np.reshape(X, (N1, N2), order='F')
+            return A.reshape((N1, -1), order='F')[:, i2:i2 + N2]
+        else:
+            if N1 != self.N1():
+                print("Unable to support N1 {} != {}".format(N1, self.N1()))
+                return None
+            if N2 != self.N2():
+                print("Unable to support N2 {} != {}".format(N2, self.N2()))
+                return None
+            if (i1 != 0) or (i2 != 0) or (A.size % (N1 * N2) != 0) or (i3 + N3 > A.size // (N1 * N2)):
+                X = self._read_chunk_from_memmap(A, i1=i1 + N1 * i2 + N1 * N2 * i3, i2=-1, i3=-1, N1=N1 * N2 * N3, N2=1, N3=1)
+                if X is None:
+                    return None
+                return np.reshape(X, (N1, N2, N3), order='F')
+            return A.reshape((N1, N2, -1), order='F')[:, :, i3:i3 + N3]
+
     def _read_chunk_1d(self, i, N):
         offset = self._header.header_size + self._header.num_bytes_per_entry * i
         if is_url(self._path):
-            tmp_fname = _download_bytes_to_tmpfile(self._path, offset, offset + self._header.num_bytes_per_entry * N)
-            try:
-                ret = self._read_chunk_1d_helper(tmp_fname, N, offset=0)
-            except:
-                ret = None
-            # os.remove(tmp_fname)
-            return ret
+            # only the blocks containing the range are downloaded (and cached)
+            data = _read_url_bytes(self._path, offset, offset + self._header.num_bytes_per_entry * N)
+            if (data is None) or (len(data) != self._header.num_bytes_per_entry * N):
+                return None
+            return np.frombuffer(data, dtype=self._header.dt)
         return self._read_chunk_1d_helper(self._path, N, offset=offset)
 
     def _read_chunk_1d_helper(self, path0, N, *, offset):
@@ -149,36 +202,87 @@ class DiskReadMda:
             return None
 
 
+# Read-only maps of local files, shared by the readers of the same file
+_memmaps = OrderedDict()  # (path, size, mtime) -> array
+_memmaps_lock = threading.Lock()
+_max_num_memmaps = 32
+
+
+def _get_memmap(path, header):
+    try:
+        stat0 = os.stat(path)
+    except OSError:
+        return None
+    num_entries = int(np.prod(header.dims))
+    if num_entries == 0:
+        return None
+    if stat0.st_size < header.header_size + num_entries * header.num_bytes_per_entry:
+        # truncated file -- let the caller handle it the old way
+        return None
+    key = (os.path.abspath(path), stat0.st_size, stat0.st_mtime_ns)
+    with _memmaps_lock:
+        A = _memmaps.get(key, None)
+        if A is not None:
+            _memmaps.move_to_end(key)
+            if (A.dtype == header.dt) and (A.size == num_entries):
+                return A
+    # plain ndarray view, so that the chunks are not np.memmap instances
+    A = np.asarray(np.memmap(path, dtype=header.dt, mode='r', offset=header.header_size, shape=(num_entries,)))
+    with _memmaps_lock:
+        for key0 in [k for k in _memmaps.keys() if k[0] == key[0]]:
+            # the file has changed
+            del _memmaps[key0]
+        _memmaps[key] = A
+        while len(_memmaps) > _max_num_memmaps:
+            _memmaps.popitem(last=False)
+    return A
+
+
 def is_url(path):
     path = path or ''
     return path.startswith('http://') or path.startswith('https://') or path.startswith(
         'kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://')
 
 
-def _download_bytes_to_tmpfile(url, start, end):
-    headers = {"Range": "bytes={}-{}".format(start, end - 1)}
-    r = requests.get(url, headers=headers, stream=True)
-    _, tmp_fname = tempfile.mkstemp()
-    with open(tmp_fname, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-    return tmp_fname
+def _read_url_bytes(path, start, end):
+    # local SHA-1 cache (or its chunks) when possible, otherwise http range
+    # requests through a block cache (see MountainClient.readFileBytes)
+    from mountaintools import client as mt
+    return mt.readFileBytes(path, start=start, end=end)
+
+
+def _resolve_sha1dir_url(path):
+    from mountaintools import client as mt
+    sha1 = mt.computeFileSha1(path)
+    if not sha1:
+        raise Exception('Unable to find file: ' + path)
+    return 'sha1://' + sha1
+
+
+# Headers of remote files, so that they are not downloaded for every reader
+_remote_headers = dict()
+_remote_headers_lock = threading.Lock()
 
 
 def _read_header(path):
     if is_url(path):
-        tmp_fname = _download_bytes_to_tmpfile(path, 0, 200)
-        if not tmp_fname:
-            raise Exception('Problem downloading bytes from ' + path)
-        try:
-            ret = _read_header(tmp_fname)
-        except:
-            ret = None
-        os.remove(tmp_fname)
-        return ret
+        with _remote_headers_lock:
+            H = _remote_headers.get(path, None)
+        if H is None:
+            data = _read_url_bytes(path, 0, 200)
+            if data is None:
+                raise Exception('Problem reading bytes from ' + path)
+            H = _read_header_from_file(io.BytesIO(data))
+            if H is None:
+                return None
+            with _remote_headers_lock:
+                _remote_headers[path] = H
+        return copy.copy(H)
 
-    f = open(path, "rb")
+    return _read_header_from_file(open(path, "rb"))
+
+
+def _read_header_from_file(f):
     try:
         dt_code = _read_int32(f)
         _ = _read_int32(f)  # num bytes per entry
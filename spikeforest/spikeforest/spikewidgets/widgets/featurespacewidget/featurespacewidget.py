@@ -1,6 +1,7 @@
 from matplotlib import pyplot as plt
 from sklearn.decomposition import PCA
 import numpy as np
+from ...devel.snippets import choose_random_events, extract_snippets
 
 
 class FeatureSpaceWidget:
@@ -37,18 +38,22 @@ class FeatureSpaceWidget:
         if channels is None:
             channels = channel_ids
         list = []
+        units_with_spikes = []
         for unit in units:
             st = self._OX.get_unit_spike_train(unit_id=unit)
             if st is not None:
-                spikes = self._get_random_spike_waveforms(unit=unit, max_num=self._max_num_spikes_per_unit,
-                                                          channels=channels)
-                item = dict(
-                    representative_waveforms=spikes,
-                    title='Unit {}'.format(int(unit))
-                )
-                list.append(item)
+                units_with_spikes.append(unit)
             else:
                 print(unit, ' spike train is None')
+        # extract the waveforms of all units at once
+        all_spikes = self._get_random_spike_waveforms_for_units(units=units_with_spikes, max_num=self._max_num_spikes_per_unit,
+                                                                channels=channels)
+        for unit, spikes in zip(units_with_spikes, all_spikes):
+            item = dict(
+                representative_waveforms=spikes,
+                title='Unit {}'.format(int(unit))
+            )
+            list.append(item)
         print(np.shape(list[0]['representative_waveforms']))
         opts = {'channel': -1,
                 'feature_extraction': 'PCA',
@@ -98,20 +103,13 @@ class FeatureSpaceWidget:
         return features_obj
 
     def _get_random_spike_waveforms(self, *, unit, max_num, channels):
-        st = self._OX.get_unit_spike_train(unit_id=unit)
-        num_events = len(st)
-        if num_events > max_num:
-            event_indices = np.random.choice(range(num_events), size=max_num, replace=False)
-        else:
-            event_indices = range(num_events)
+        return self._get_random_spike_waveforms_for_units(units=[unit], max_num=max_num, channels=channels)[0]
 
-        spikes = self._IX.get_snippets(reference_frames=st[event_indices].astype(int), snippet_len=self._snippet_len,
-                                       channel_ids=channels)
-        if len(spikes) > 0:
-            spikes = np.dstack(tuple(spikes))
-        else:
-            spikes = np.zeros((self._IX.get_num_channels(), self._snippet_len, 0))
-        return spikes
+    def _get_random_spike_waveforms_for_units(self, *, units, max_num, channels):
+        event_frames = choose_random_events(sorting=self._OX, unit_ids=units, max_num=max_num)
+        snippets = extract_snippets(recording=self._IX, event_frames=event_frames, snippet_len=self._snippet_len,
+                                    channel_ids=channels)
+        return [snippets[i, :, :, :len(frames)] for i, frames in enumerate(event_frames)]
 
     def _get_ylim_for_item(self, average_waveform=None, representative_waveforms=None):
         if average_waveform is None:
@@ -1,5 +1,6 @@
 from matplotlib import pyplot as plt
 import numpy as np
+from ...devel.snippets import choose_random_events, extract_snippets
 
 class UnitWaveformsWidget:
     def __init__(self, *, recording, sorting, channels=None, unit_ids=None, width=14, height=7, snippet_len=100,
@@ -35,37 +36,34 @@ class UnitWaveformsWidget:
         if channels is None:
             channels = channel_ids
         list = []
+        units_with_spikes = []
         for unit in units:
             st = self._OX.get_unit_spike_train(unit_id=unit)
             if st is not None:
-                spikes = self._get_random_spike_waveforms(unit=unit, max_num=self._max_num_spikes_per_unit,
-                                                          channels=channels)
-                item = dict(
-                    representative_waveforms=spikes,
-                    title='Unit {}'.format(int(unit))
-                )
-                list.append(item)
+                units_with_spikes.append(unit)
             else:
                 print(unit, ' spike train is None')
+        # extract the waveforms of all units at once
+        all_spikes = self._get_random_spike_waveforms_for_units(units=units_with_spikes, max_num=self._max_num_spikes_per_unit,
+                                                                channels=channels)
+        for unit, spikes in zip(units_with_spikes, all_spikes):
+            item = dict(
+                representative_waveforms=spikes,
+                title='Unit {}'.format(int(unit))
+            )
+            list.append(item)
         with plt.rc_context({'axes.edgecolor': 'gray'}):
             # self._plot_spike_shapes_multi(list,channel_locations=channel_locations[np.array(channels),:])
             self._plot_spike_shapes_multi(list, channel_locations=None)
 
     def _get_random_spike_waveforms(self, *, unit, max_num, channels):
-        st = self._OX.get_unit_spike_train(unit_id=unit)
-        num_events = len(st)
-        if num_events > max_num:
-            event_indices = np.random.choice(range(num_events), size=max_num, replace=False)
-        else:
-            event_indices = range(num_events)
+        return self._get_random_spike_waveforms_for_units(units=[unit], max_num=max_num, channels=channels)[0]
 
-        spikes = self._IX.get_snippets(reference_frames=st[event_indices].astype(int), snippet_len=self._snippet_len,
-                                      channel_ids=channels)
-        if len(spikes)>0:
-            spikes = np.dstack(tuple(spikes))
-        else:
-            spikes = np.zeros((self._IX.get_num_channels(), self._snippet_len, 0))
-        return spikes
+    def _get_random_spike_waveforms_for_units(self, *, units, max_num, channels):
+        event_frames = choose_random_events(sorting=self._OX, unit_ids=units, max_num=max_num)
+        snippets = extract_snippets(recording=self._IX, event_frames=event_frames, snippet_len=self._snippet_len,
+                                    channel_ids=channels)
+        return [snippets[i, :, :, :len(frames)] for i, frames in enumerate(event_frames)]
 
     def _plot_spike_shapes(self, *, representative_waveforms=None, average_waveform=None, channel_locations=None,
                            ylim=None, max_representatives=None, color='blue', title=''):
@@ -1,4 +1,4 @@
-from .compare_sortings_with_truth import GenSortingComparisonTable, GenSortingComparisonTableNew
+from .compare_sortings_with_truth import GenSortingComparisonTable, GenSortingComparisonTableNew, GenSortingComparisonTableBatch, store_batch_comparison_results_in_cache, comparison_with_truth_is_in_cache
 from .aggregate_sorting_results import aggregate_sorting_results
 from .compute_units_info import compute_units_info, ComputeUnitsInfo
 from .computerecordinginfo import ComputeRecordingInfo
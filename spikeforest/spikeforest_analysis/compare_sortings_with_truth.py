@@ -1,6 +1,9 @@
 # from spikeforest import spikewidgets as sw
 import mlprocessors as mlpr
 import json
+import os
+from copy import deepcopy
+from mountaintools import client as mt
 
 import spikeextractors as si
 import spiketoolkit as st
@@ -75,15 +78,147 @@ class GenSortingComparisonTable(mlpr.Processor):
         if (self.units_true is not None) and (len(self.units_true) > 0):
             sorting_true = si.SubSortingExtractor(parent_sorting=sorting_true, unit_ids=self.units_true)
 
-        SC = SortingComparison(sorting_true, sorting, delta_tp=30)
-        df = get_comparison_data_frame(comparison=SC)
-        # sw.SortingComparisonTable(comparison=SC).getDataframe()
-        json = df.transpose().to_dict()
-        html = df.to_html(index=False)
+        json, html = _gen_sorting_comparison_table(sorting_true=sorting_true, sorting=sorting)
         _write_json_file(json, self.json_out)
         _write_json_file(html, self.html_out)
 
 
+# batched version of GenSortingComparisonTable for all the sortings of one recording
+class GenSortingComparisonTableBatch(mlpr.Processor):
+    """
+    Compare a list of sortings of the same recording with the ground truth.
+
+    The ground truth is loaded only once, and the table for each sorting is the
+    same as the output of GenSortingComparisonTable. Use
+    store_batch_comparison_results_in_cache() on the result to split it into
+    one GenSortingComparisonTable result per sorting.
+    """
+    VERSION = '0.1.0'
+    firings_list = mlpr.Input('List of firings files (sortings)', multi=True)
+    firings_true = mlpr.Input('True firings file')
+    units_true = mlpr.IntegerListParameter('List of true units to consider')
+    json_out = mlpr.Output('The json and html tables for each firings file, as a .json file')
+    CONTAINER = GenSortingComparisonTable.CONTAINER
+
+    def run(self):
+        print('GenSortingComparisonTableBatch: {} firings files, firings_true={}, units_true={}'.format(len(self.firings_list), self.firings_true, self.units_true))
+        sorting_true = SFMdaSortingExtractor(firings_file=self.firings_true)
+        if (self.units_true is not None) and (len(self.units_true) > 0):
+            sorting_true = si.SubSortingExtractor(parent_sorting=sorting_true, unit_ids=self.units_true)
+        sorting_true = _PreloadedSortingExtractor(sorting_true)
+
+        tables = []
+        for firings in self.firings_list:
+            print('Comparing with truth: {}'.format(firings))
+            sorting = SFMdaSortingExtractor(firings_file=firings)
+            json, html = _gen_sorting_comparison_table(sorting_true=sorting_true, sorting=sorting)
+            tables.append(dict(json=json, html=html))
+        _write_json_file(dict(tables=tables), self.json_out)
+
+
+def store_batch_comparison_results_in_cache(*, batch_result, firings_list, firings_true, units_true):
+    """
+    Split the result of a GenSortingComparisonTableBatch job into one result
+    per firings file, and store each in the job cache under the signature of
+    the equivalent GenSortingComparisonTable job, so that running that job
+    afterwards is a cache hit.
+
+    Parameters
+    ----------
+    batch_result: MountainJobResult
+        The (finished and successful) result of the batch job
+    firings_list, firings_true, units_true:
+        The same inputs as were given to the batch job
+
+    Returns
+    -------
+    list of MountainJobResult
+        The GenSortingComparisonTable result for each firings file
+    """
+    if batch_result.retcode != 0:
+        raise Exception('Cannot store results of a batch comparison job that did not succeed (retcode={})'.format(batch_result.retcode))
+    batch_obj = mt.loadObject(path=batch_result.outputs['json_out'])
+    if batch_obj is None:
+        raise Exception('Unable to load output of batch comparison job: {}'.format(batch_result.outputs['json_out']))
+    tables = batch_obj['tables']
+    if len(tables) != len(firings_list):
+        raise Exception('Unexpected number of tables in output of batch comparison job: {} <> {}'.format(len(tables), len(firings_list)))
+
+    jobs = GenSortingComparisonTable.createJobs([
+        dict(
+            firings=firings,
+            firings_true=firings_true,
+            units_true=units_true,
+            json_out={'ext': '.json'},
+            html_out={'ext': '.html'}
+        )
+        for firings in firings_list
+    ])
+    results = []
+    with mlpr.TemporaryDirectory() as tmpdir:
+        for ii, (job, table) in enumerate(zip(jobs, tables)):
+            json_fname = os.path.join(tmpdir, 'json_out_{}.json'.format(ii))
+            html_fname = os.path.join(tmpdir, 'html_out_{}.html'.format(ii))
+            _write_json_file(table['json'], json_fname)
+            _write_json_file(table['html'], html_fname)
+            R = mlpr.MountainJobResult()
+            R.retcode = 0
+            R.timed_out = False
+            R.runtime_info = deepcopy(batch_result.runtime_info)
+            R.console_out = batch_result.console_out
+            R.outputs = dict(
+                json_out=mt.saveFile(path=json_fname),
+                html_out=mt.saveFile(path=html_fname)
+            )
+            job.storeResultInCache(R)
+            results.append(R)
+    return results
+
+
+def comparison_with_truth_is_in_cache(*, firings, firings_true, units_true):
+    """
+    Whether the job cache has a result for the GenSortingComparisonTable job
+    with these inputs (for example, stored by an earlier batch comparison),
+    so that it need not be included in a new batch.
+    """
+    job = GenSortingComparisonTable.createJob(
+        firings=firings,
+        firings_true=firings_true,
+        units_true=units_true,
+        json_out={'ext': '.json'},
+        html_out={'ext': '.html'}
+    )
+    return mt.getValue(key=job.runtimeInfoSignature(), check_alt=True) is not None
+
+
+def _gen_sorting_comparison_table(*, sorting_true, sorting):
+    SC = SortingComparison(sorting_true, sorting, delta_tp=30)
+    df = get_comparison_data_frame(comparison=SC)
+    # sw.SortingComparisonTable(comparison=SC).getDataframe()
+    json = df.transpose().to_dict()
+    html = df.to_html(index=False)
+    return json, html
+
+
+class _PreloadedSortingExtractor(si.SortingExtractor):
+    # keeps the spike trains of all units in memory, so they are extracted from the firings only once
+    def __init__(self, sorting):
+        si.SortingExtractor.__init__(self)
+        self._unit_ids = list(sorting.get_unit_ids())
+        self._spike_trains = dict([(unit_id, sorting.get_unit_spike_train(unit_id=unit_id)) for unit_id in self._unit_ids])
+
+    def get_unit_ids(self):
+        return self._unit_ids
+
+    def get_unit_spike_train(self, unit_id, start_frame=None, end_frame=None):
+        times = self._spike_trains[unit_id]
+        if start_frame is not None:
+            times = times[times >= start_frame]
+        if end_frame is not None:
+            times = times[times < end_frame]
+        return times
+
+
 def get_comparison_data_frame(*, comparison):
     import pandas as pd
     SC = comparison
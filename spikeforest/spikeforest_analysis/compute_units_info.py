@@ -6,6 +6,7 @@ import spikeextractors as si
 from .bandpass_filter import bandpass_filter
 from .sfmdaextractors import SFMdaRecordingExtractor
 from .sfmdaextractors import SFMdaSortingExtractor
+from .snippets import choose_random_events, extract_snippets, compute_templates_from_snippets, compute_template_snrs
 
 # _CONTAINER = 'sha1://5627c39b9bd729fc011cbfce6e8a7c37f8bcbc6b/spikeforest_basic.simg'
 # _CONTAINER = 'sha1://0944f052e22de0f186bb6c5cb2814a71f118f2d1/spikeforest_basic.simg' #MAY26JJJ
@@ -17,37 +18,19 @@ def write_json_file(fname, obj):
 
 
 def get_random_spike_waveforms(*, recording, sorting, unit, snippet_len, max_num, channels=None):
-    st = sorting.get_unit_spike_train(unit_id=unit)
-    num_events = len(st)
-    if num_events > max_num:
-        event_indices = np.random.choice(range(num_events), size=max_num, replace=False)
-    else:
-        event_indices = range(num_events)
+    event_frames = choose_random_events(sorting=sorting, unit_ids=[unit], max_num=max_num)
+    snippets = extract_snippets(recording=recording, event_frames=event_frames, snippet_len=snippet_len, channel_ids=channels)
+    return snippets[0]
 
-    spikes = recording.get_snippets(reference_frames=st[event_indices].astype(int), snippet_len=snippet_len, channel_ids=channels)
-    if len(spikes) > 0:
-        spikes = np.dstack(tuple(spikes))
-    else:
-        spikes = np.zeros((recording.get_num_channels(), snippet_len, 0))
-    return spikes
 
-
-def compute_unit_templates(*, recording, sorting, unit_ids, snippet_len=50, max_num=100, channels=None):
-    ret = []
-    for unit in unit_ids:
-        # print('Unit {} of {}'.format(unit,len(unit_ids)))
-        waveforms = get_random_spike_waveforms(recording=recording, sorting=sorting, unit=unit, snippet_len=snippet_len, max_num=max_num, channels=None)
-        template = np.median(waveforms, axis=2)
-        ret.append(template)
-    return ret
+def compute_unit_templates(*, recording, sorting, unit_ids, snippet_len=50, max_num=100, channels=None, chunk_size=None):
+    event_frames = choose_random_events(sorting=sorting, unit_ids=unit_ids, max_num=max_num)
+    snippets = extract_snippets(recording=recording, event_frames=event_frames, snippet_len=snippet_len, chunk_size=chunk_size)
+    return list(compute_templates_from_snippets(snippets))
 
 
 def compute_template_snr(template, channel_noise_levels):
-    channel_snrs = []
-    for ch in range(template.shape[0]):
-        # channel_snrs.append((np.max(template[ch,:])-np.min(template[ch,:]))/channel_noise_levels[ch])
-        channel_snrs.append((np.max(np.abs(template[ch, :]))) / channel_noise_levels[ch])
-    return float(np.max(channel_snrs))
+    return float(compute_template_snrs(template[np.newaxis, :, :], channel_noise_levels)[0])
 
 
 def compute_channel_noise_levels(recording):
@@ -55,12 +38,9 @@ def compute_channel_noise_levels(recording):
     # M=len(channel_ids)
     samplerate = int(recording.get_sampling_frequency())
     X = recording.get_traces(start_frame=samplerate * 1, end_frame=samplerate * 2)
-    ret = []
-    for ii in range(len(channel_ids)):
-        # noise_level=np.std(X[ii,:])
-        noise_level = np.median(np.abs(X[ii, :])) / 0.6745  # median absolute deviation (MAD)
-        ret.append(noise_level)
-    return ret
+    # noise_level=np.std(X[ii,:])
+    noise_levels = np.median(np.abs(X), axis=1) / 0.6745  # median absolute deviation (MAD)
+    return list(noise_levels[0:len(channel_ids)])
 
 
 class ComputeUnitsInfo(mlpr.Processor):
@@ -80,18 +60,16 @@ class ComputeUnitsInfo(mlpr.Processor):
         write_json_file(self.json_out, ret)
 
 
-def compute_units_info(*, recording, sorting, channel_ids=[], unit_ids=[]):
+def compute_units_info(*, recording, sorting, channel_ids=[], unit_ids=[], chunk_size=None):
     if (channel_ids) and (len(channel_ids) > 0):
         recording = si.SubRecordingExtractor(parent_recording=recording, channel_ids=channel_ids)
 
-    # load into memory
-    print('Loading recording into RAM...')
-    recording = si.NumpyRecordingExtractor(timeseries=recording.get_traces(), samplerate=recording.get_sampling_frequency())
+    if chunk_size is None:
+        chunk_size = int(recording.get_sampling_frequency() * 2)
 
-    # do filtering
-    print('Filtering...')
-    recording = bandpass_filter(recording=recording, freq_min=300, freq_max=6000)
-    recording = si.NumpyRecordingExtractor(timeseries=recording.get_traces(), samplerate=recording.get_sampling_frequency())
+    # filter lazily -- the recording is read (and filtered) one chunk at a time
+    M = len(recording.get_channel_ids())
+    recording = bandpass_filter(recording=recording, freq_min=300, freq_max=6000, cache_max_bytes=M * 30000 * 8 * 4)
 
     if (not unit_ids) or (len(unit_ids) == 0):
         unit_ids = sorting.get_unit_ids()
@@ -101,7 +79,7 @@ def compute_units_info(*, recording, sorting, channel_ids=[], unit_ids=[]):
 
     # No longer use subset to compute the templates
     print('Computing unit templates...')
-    templates = compute_unit_templates(recording=recording, sorting=sorting, unit_ids=unit_ids, max_num=100)
+    templates = compute_unit_templates(recording=recording, sorting=sorting, unit_ids=unit_ids, max_num=100, chunk_size=chunk_size)
 
     print(recording.get_channel_ids())
 
@@ -1,16 +1,63 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
 import spikeextractors as se
 import numpy as np
 
 
 class FilterRecording(se.RecordingExtractor):
-    def __init__(self, *, recording, chunk_size=10000):
+    def __init__(self, *, recording, chunk_size=10000, num_threads=1, cache_max_bytes=None, cache_dir=None, prefetch=2):
+        """
+        Parameters
+        ----------
+        recording: RecordingExtractor
+            The recording to filter
+        chunk_size: int
+            Number of timepoints in each filtered chunk
+        num_threads: int
+            Number of threads for filtering chunks. For num_threads > 1,
+            filterChunk must be thread-safe (see _read_lock), and chunks are
+            prefetched in the background during sequential access.
+        cache_max_bytes: int or None
+            Memory budget of the filtered chunk cache (default 800 MB)
+        cache_dir: str or None
+            If given, chunks that are evicted from memory are stored (as
+            float32) in a subdirectory keyed by _cache_key(), and reused
+            later, including by other instances
+        prefetch: int
+            Number of chunks to prefetch ahead of sequential access
+        """
         se.RecordingExtractor.__init__(self)
         self._recording = recording
         self._chunk_size = chunk_size
-        self._filtered_chunk_cache = FilteredChunkCache()
+        # filterChunk must be thread-safe for num_threads > 1
+        self._num_threads = num_threads
+        self._cache_max_bytes = cache_max_bytes
+        self._cache_dir = cache_dir
+        self._prefetch = prefetch
+        self._filtered_chunk_cache = None  # created on first use, see _cache()
+        self._last_chunk_index = None
+        self._init_threading()
         self.copy_channel_properties(recording)
 
+    def _init_threading(self):
+        # use this to serialize access to the underlying recording in filterChunk
+        self._read_lock = threading.Lock()
+        self._executor = None
+        self._prefetched_chunks = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_read_lock', '_executor', '_prefetched_chunks']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_threading()
+
     def get_channel_ids(self):
         return self._recording.get_channel_ids()
 
@@ -29,9 +76,12 @@ class FilterRecording(se.RecordingExtractor):
             channel_ids = self.get_channel_ids()
         ich1 = int(start_frame / self._chunk_size)
         ich2 = int((end_frame - 1) / self._chunk_size)
+        filtered_chunks = self._get_filtered_chunks(list(range(ich1, ich2 + 1)))
+        all_channel_ids = self.get_channel_ids()
+        chan_idx = [all_channel_ids.index(chan) for chan in channel_ids]
         filtered_chunk_list = []
         for ich in range(ich1, ich2 + 1):
-            filtered_chunk0 = self._get_filtered_chunk(ich)
+            filtered_chunk0 = filtered_chunks[ich]
             if ich == ich1:
                 start0 = start_frame - ich * self._chunk_size
             else:
@@ -40,7 +90,6 @@ class FilterRecording(se.RecordingExtractor):
                 end0 = end_frame - ich * self._chunk_size
             else:
                 end0 = self._chunk_size
-            chan_idx = [self.get_channel_ids().index(chan) for chan in channel_ids]
             filtered_chunk_list.append(filtered_chunk0[chan_idx, start0:end0])
         return np.concatenate(filtered_chunk_list, axis=1)
 
@@ -48,40 +97,166 @@ class FilterRecording(se.RecordingExtractor):
     def filterChunk(self, *, start_frame, end_frame):
         raise NotImplementedError('filterChunk not implemented')
 
-    def _get_filtered_chunk(self, ind):
-        code = str(ind)
-        chunk0 = self._filtered_chunk_cache.get(code)
-        if chunk0 is not None:
-            return chunk0
+    def _cache_key(self):
+        # A string identifying the filtered data, for the on-disk cache.
+        # Subclasses that can be identified (e.g., by a hash of the recording
+        # and the filter parameters) should override this.
+        return None
+
+    def _cache(self):
+        if self._filtered_chunk_cache is None:
+            spill_dir = None
+            if self._cache_dir is not None:
+                key = self._cache_key()
+                if key is not None:
+                    spill_dir = os.path.join(self._cache_dir, key)
+                else:
+                    print('WARNING: not using on-disk cache for filtered chunks, because there is no cache key for {}'.format(type(self).__name__))
+            self._filtered_chunk_cache = FilteredChunkCache(max_bytes=self._cache_max_bytes, spill_dir=spill_dir)
+        return self._filtered_chunk_cache
+
+    def _num_chunks(self):
+        return int((self.get_num_frames() + self._chunk_size - 1) / self._chunk_size)
+
+    def _filter_chunk_by_index(self, ind):
+        return self.filterChunk(start_frame=ind * self._chunk_size, end_frame=(ind + 1) * self._chunk_size)
+
+    def _get_filtered_chunks(self, inds):
+        # returns a dict of filtered chunks by index
+        cache = self._cache()
+        # sequential access: moving forward from the previously read chunk
+        sequential = (len(inds) > 0) and (self._last_chunk_index is not None) and (self._last_chunk_index <= inds[0] <= self._last_chunk_index + 1) and (inds[-1] > self._last_chunk_index)
+        self._collect_prefetched_chunks(keep_pending=sequential, inds=inds)
+        ret = dict()
+        missing_inds = []
+        for ind in inds:
+            code = str(ind)
+            future = self._prefetched_chunks.pop(ind, None)
+            if future is not None:
+                chunk0 = future.result()
+                cache.add(code, chunk0)
+            else:
+                chunk0 = cache.get(code)
+            if chunk0 is not None:
+                ret[ind] = chunk0
+            else:
+                missing_inds.append(ind)
+
+        if (self._num_threads <= 1) or (len(missing_inds) <= 1):
+            chunks = [self._filter_chunk_by_index(ind) for ind in missing_inds]
         else:
-            start0 = ind * self._chunk_size
-            end0 = (ind + 1) * self._chunk_size
-            chunk1 = self.filterChunk(start_frame=start0, end_frame=end0)
-            self._filtered_chunk_cache.add(code, chunk1)
-            return chunk1
+            # filter the missing chunks in parallel
+            chunks = list(self._get_executor().map(self._filter_chunk_by_index, missing_inds))
+        for ind, chunk0 in zip(missing_inds, chunks):
+            cache.add(str(ind), chunk0)
+            ret[ind] = chunk0
+
+        if len(inds) > 0:
+            if sequential:
+                self._prefetch_chunks(range(inds[-1] + 1, inds[-1] + 1 + self._prefetch))
+            self._last_chunk_index = inds[-1]
+        return ret
+
+    def _collect_prefetched_chunks(self, *, keep_pending, inds):
+        # The finished prefetches go into the cache, so that they count
+        # against its memory budget. Unless the access is still sequential,
+        # the pending ones that are not requested now will not be needed, so
+        # they are cancelled (or, if already running, their results dropped).
+        cache = self._cache()
+        for ind, future in list(self._prefetched_chunks.items()):
+            if future.done():
+                del self._prefetched_chunks[ind]
+                if (not future.cancelled()) and (future.exception() is None):
+                    cache.add(str(ind), future.result())
+            elif (not keep_pending) and (ind not in inds):
+                del self._prefetched_chunks[ind]
+                future.cancel()
+
+    def _prefetch_chunks(self, inds):
+        # filter upcoming chunks in the background (sequential access was detected)
+        if self._num_threads <= 1:
+            return
+        cache = self._cache()
+        for ind in inds:
+            if ind >= self._num_chunks():
+                break
+            if (ind in self._prefetched_chunks) or (cache.has(str(ind))):
+                continue
+            self._prefetched_chunks[ind] = self._get_executor().submit(self._filter_chunk_by_index, ind)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._num_threads)
+        return self._executor
 
 
 class FilteredChunkCache():
-    def __init__(self):
-        self._chunks_by_code = dict()
-        self._codes = []
-        self._total_size = 0
-        self._max_size = 1024 * 1024 * 100
+    def __init__(self, *, max_bytes=None, spill_dir=None):
+        """
+        In-memory LRU cache of filtered chunks with a memory budget.
+
+        If spill_dir is given, evicted chunks are stored there as float32 .npy
+        files and are loaded from there on a later cache miss.
+        """
+        if max_bytes is None:
+            max_bytes = 1024 * 1024 * 100 * 8
+        self._chunks_by_code = OrderedDict()
+        self._dtypes_by_code = dict()
+        self._total_bytes = 0
+        self._max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        if self._spill_dir is not None:
+            os.makedirs(self._spill_dir, exist_ok=True)
 
     def add(self, code, chunk):
+        if code in self._chunks_by_code:
+            self._total_bytes = self._total_bytes - self._chunks_by_code[code].nbytes
         self._chunks_by_code[code] = chunk
-        self._codes.append(code)
-        self._total_size = self._total_size + chunk.size
-        if self._total_size > self._max_size:
-            ii = 0
-            while (ii < len(self._codes)) and (self._total_size > self._max_size / 2):
-                self._total_size = self._total_size - self._chunks_by_code[self._codes[ii]].size
-                del self._chunks_by_code[self._codes[ii]]
-                ii = ii + 1
-            self._codes = self._codes[ii:]
+        self._chunks_by_code.move_to_end(code)
+        self._dtypes_by_code[code] = chunk.dtype
+        self._total_bytes = self._total_bytes + chunk.nbytes
+        # evict least recently used chunks (but never the one just added)
+        while (self._total_bytes > self._max_bytes) and (len(self._chunks_by_code) > 1):
+            code0, chunk0 = self._chunks_by_code.popitem(last=False)
+            self._total_bytes = self._total_bytes - chunk0.nbytes
+            self._spill(code0, chunk0)
 
     def get(self, code):
         if code in self._chunks_by_code:
+            self._chunks_by_code.move_to_end(code)
             return self._chunks_by_code[code]
-        else:
+        chunk = self._load_spilled(code)
+        if chunk is not None:
+            self.add(code, chunk)
+        return chunk
+
+    def has(self, code):
+        if code in self._chunks_by_code:
+            return True
+        return (self._spill_dir is not None) and os.path.exists(self._spill_path(code))
+
+    def _spill_path(self, code):
+        return os.path.join(self._spill_dir, 'chunk_{}.npy'.format(code))
+
+    def _spill(self, code, chunk):
+        if self._spill_dir is None:
+            return
+        path = self._spill_path(code)
+        if os.path.exists(path):
+            return
+        tmp_path = path + '.tmp{}.npy'.format(threading.get_ident())
+        np.save(tmp_path, chunk.astype(np.float32, copy=False))
+        os.replace(tmp_path, path)
+
+    def _load_spilled(self, code):
+        if self._spill_dir is None:
+            return None
+        path = self._spill_path(code)
+        if not os.path.exists(path):
+            return None
+        try:
+            chunk = np.load(path)
+        except Exception as e:  # catch *all* exceptions
+            print('Problem loading filtered chunk from {}: {}'.format(path, e))
             return None
+        return chunk.astype(self._dtypes_by_code.get(code, np.float32), copy=False)
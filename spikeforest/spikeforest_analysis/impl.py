@@ -168,6 +168,7 @@ def _clear_job_results(*, jobs, incomplete_only=True):
 
 
 def _download_recordings(*, jobs):
+    fnames = []
     for _, job in enumerate(jobs):
         val = mt.getValue(key=job)
         if not val:
@@ -175,8 +176,12 @@ def _download_recordings(*, jobs):
                 if 'directory' in job['recording']:
                     dsdir = job['recording']['directory']
                     fname = dsdir + '/raw.mda'
-                    print('REALIZING FILE: ' + fname)
-                    mt.realizeFile(path=fname)
+                    if fname not in fnames:
+                        fnames.append(fname)
+    print('REALIZING {} FILES'.format(len(fnames)))
+    for fname, path in zip(fnames, mt.realizeFiles(fnames)):
+        if not path:
+            print('WARNING: unable to realize file: ' + fname)
 
 
 def _make_timestamp():
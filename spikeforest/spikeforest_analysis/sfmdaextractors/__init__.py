@@ -1,2 +1,2 @@
 from .sfmdaextractors import SFMdaRecordingExtractor, SFMdaSortingExtractor
-from . import mdaio
+from spikeforest.extractors.sfmdaextractors import mdaio
@@ -3,7 +3,7 @@ from spikeextractors import SortingExtractor
 
 import json
 import numpy as np
-from .mdaio import DiskReadMda, readmda, writemda32, writemda64
+from spikeforest.extractors.sfmdaextractors.mdaio import DiskReadMda, readmda, writemda32, writemda64
 import os
 import mtlogging
 import mlprocessors as mlpr
@@ -17,6 +17,8 @@ class SFMdaRecordingExtractor(RecordingExtractor):
         self._timeseries_path = dataset_directory + '/' + raw_fname
         self._dataset_params = read_dataset_params(dataset_directory, params_fname)
         self._samplerate = self._dataset_params['samplerate'] * 1.0
+        # If download is False, a remote timeseries file is streamed: only the
+        # blocks that are read are transferred (see MountainClient.readFileBytes)
         if download:
             path0 = mt.realizeFile(path=self._timeseries_path)
             if not path0:
@@ -29,10 +31,8 @@ class SFMdaRecordingExtractor(RecordingExtractor):
 
         timeseries_path_or_url = self._timeseries_path
         if not mt.isLocalPath(timeseries_path_or_url):
-            a = mt.findFile(timeseries_path_or_url)
-            if not a:
+            if not mt.findFile(timeseries_path_or_url):
                 raise Exception('Cannot find timeseries file: ' + timeseries_path_or_url)
-            timeseries_path_or_url = a
 
         # if is_kbucket_url(timeseries0):
         #     download_needed = is_url(ca.findFile(path=timeseries0))
@@ -54,6 +54,7 @@ class SFMdaRecordingExtractor(RecordingExtractor):
 
         self._num_channels = X.N1()
         self._num_timepoints = X.N2()
+        self._timeseries_reader = None  # created on first call to get_traces
         for m in range(self._num_channels):
             self.set_channel_property(m, 'location', self._geom[m, :])
 
@@ -80,17 +81,20 @@ class SFMdaRecordingExtractor(RecordingExtractor):
 
     @mtlogging.log(name='SFMdaRecordingExtractor:get_traces')
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if not mt.isLocalPath(self._timeseries_path):
-            raise Exception('Cannot get traces -- timeseries file is not downloaded')
         if start_frame is None:
             start_frame = 0
         if end_frame is None:
             end_frame = self.get_num_frames()
         if channel_ids is None:
             channel_ids = self.get_channel_ids()
-        X = DiskReadMda(self._timeseries_path)
-        recordings = X.readChunk(i1=0, i2=start_frame, N1=X.N1(), N2=end_frame - start_frame)
-        recordings = recordings[channel_ids, :]
+        if self._timeseries_reader is None:
+            self._timeseries_reader = DiskReadMda(self._timeseries_path)
+        X = self._timeseries_reader
+        # for a local file this may be a read-only view into a map of the file
+        recordings = X.readChunk(i1=0, i2=start_frame, N1=X.N1(), N2=end_frame - start_frame, copy=False)
+        recordings = recordings[_channel_index(channel_ids), :]
+        if not recordings.flags.writeable:
+            recordings = np.array(recordings)
         return recordings
 
     @staticmethod
@@ -195,6 +199,14 @@ def is_url(path):
         'kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://')
 
 
+def _channel_index(channel_ids):
+    # Use a slice (a view, rather than a copy) for a contiguous range of channels
+    channel_ids = list(channel_ids)
+    if (len(channel_ids) > 0) and (channel_ids == list(range(channel_ids[0], channel_ids[0] + len(channel_ids)))) and (channel_ids[0] >= 0):
+        return slice(channel_ids[0], channel_ids[0] + len(channel_ids))
+    return channel_ids
+
+
 def read_dataset_params(dsdir, params_fname):
     fname1 = dsdir + '/' + params_fname
     fname2 = mt.realizeFile(path=fname1)
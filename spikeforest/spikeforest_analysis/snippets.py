@@ -0,0 +1,136 @@
+import warnings
+import numpy as np
+
+
+def choose_random_events(*, sorting, unit_ids, max_num):
+    """
+    Choose (at most) max_num random events of each unit.
+
+    Parameters
+    ----------
+    sorting: SortingExtractor
+    unit_ids: list of int
+    max_num: int
+        Max number of events per unit
+
+    Returns
+    -------
+    list of np.ndarray
+        The (integer) frames of the chosen events, for each unit
+    """
+    ret = []
+    for unit in unit_ids:
+        st = sorting.get_unit_spike_train(unit_id=unit)
+        num_events = len(st)
+        if num_events > max_num:
+            event_indices = np.random.choice(range(num_events), size=max_num, replace=False)
+        else:
+            event_indices = range(num_events)
+        ret.append(np.array(st[event_indices]).astype(int))
+    return ret
+
+
+def extract_snippets(*, recording, event_frames, snippet_len, channel_ids=None, chunk_size=None):
+    """
+    Extract the snippets around a set of events of several units at once.
+
+    The events are sorted by time, and the recording is read in segments
+    that cover the snippets of nearby events (at most chunk_size apart), so
+    each part of the recording is read only once, and sparse events do not
+    cause whole chunks to be read. The snippets are the same as those of
+    recording.get_snippets(): zero-padded at the edges of the recording, and
+    all zeros for events outside of the recording.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+    event_frames: list of np.ndarray
+        The frames of the events, for each unit
+    snippet_len: int or tuple
+        Length of the snippets, or (num. samples before, num. samples after)
+    channel_ids: list of int or None
+        The channels to use (default all)
+    chunk_size: int or None
+        Max. span of the events read at once (default 2 seconds)
+
+    Returns
+    -------
+    np.ndarray
+        units x channels x snippet_len x max. number of events. The entries
+        past the number of events of a unit are nan.
+    """
+    if isinstance(snippet_len, (tuple, list, np.ndarray)):
+        snippet_len_before = int(snippet_len[0])
+        snippet_len_after = int(snippet_len[1])
+    else:
+        snippet_len_before = int((snippet_len + 1) / 2)
+        snippet_len_after = int(snippet_len) - snippet_len_before
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    if chunk_size is None:
+        chunk_size = int(recording.get_sampling_frequency() * 2)
+    M = len(channel_ids)
+    N = recording.get_num_frames()
+    T = snippet_len_before + snippet_len_after
+
+    num_events = [len(frames) for frames in event_frames]
+    ret = np.full((len(event_frames), M, T, max(num_events + [0])), np.nan)
+    for i, num in enumerate(num_events):
+        ret[i, :, :, :num] = 0
+
+    if sum(num_events) == 0:
+        return ret
+    all_frames = np.concatenate([np.array(frames, dtype=np.int64) for frames in event_frames])
+    all_units = np.concatenate([np.full(num, i) for i, num in enumerate(num_events)])
+    all_slots = np.concatenate([np.arange(num) for num in num_events])
+    order = np.argsort(all_frames, kind='mergesort')
+    all_frames = all_frames[order]
+    all_units = all_units[order]
+    all_slots = all_slots[order]
+
+    # the events outside of the recording are left as zeros
+    ii_first = np.searchsorted(all_frames, 0, side='left')
+    ii_last = np.searchsorted(all_frames, N, side='left')
+    # split the events into groups wherever the snippets do not overlap
+    group_starts = ii_first + np.concatenate([[0], np.where(np.diff(all_frames[ii_first:ii_last]) > T)[0] + 1])
+    group_ends = np.concatenate([group_starts[1:], [ii_last]])
+
+    offsets = np.arange(-snippet_len_before, snippet_len_after)
+    for ii1, ii_end in zip(group_starts, group_ends):
+        while ii1 < ii_end:
+            # the events of the group within chunk_size of the first one
+            ii2 = ii1 + np.searchsorted(all_frames[ii1:ii_end], all_frames[ii1] + chunk_size, side='left')
+            # the span of their snippets, zero-padded outside of the recording
+            t1 = int(all_frames[ii1]) - snippet_len_before
+            t2 = int(all_frames[ii2 - 1]) + snippet_len_after
+            traces = np.zeros((M, t2 - t1))
+            traces[:, max(t1, 0) - t1:min(t2, N) - t1] = recording.get_traces(channel_ids=channel_ids, start_frame=max(t1, 0), end_frame=min(t2, N))
+            snippets = traces[:, (all_frames[ii1:ii2] - t1)[:, np.newaxis] + offsets[np.newaxis, :]]  # M x num_events x T
+            ret[all_units[ii1:ii2], :, :, all_slots[ii1:ii2]] = snippets.transpose((1, 0, 2))
+            ii1 = ii2
+    return ret
+
+
+def compute_templates_from_snippets(snippets):
+    """
+    The median waveforms (units x channels x snippet_len) of the output of
+    extract_snippets(). The template of a unit without events is all nan.
+    """
+    if snippets.shape[3] == 0:
+        return np.full(snippets.shape[0:3], np.nan)
+    if not np.any(np.isnan(snippets)):
+        return np.median(snippets, axis=3)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='All-NaN slice encountered')
+        return np.nanmedian(snippets, axis=3)
+
+
+def compute_template_snrs(templates, channel_noise_levels):
+    """
+    The SNR of each template (units x channels x snippet_len): the max
+    absolute value on each channel relative to the channel noise level,
+    maximized over the channels.
+    """
+    channel_snrs = np.max(np.abs(templates), axis=2) / np.array(channel_noise_levels)[np.newaxis, :]
+    return np.max(channel_snrs, axis=1)
+
@@ -3,15 +3,28 @@ import spikeextractors as se
 from scipy.optimize import linear_sum_assignment
 
 
+# Label codes of the events (see SortingComparison._do_counting). CL labels are
+# given codes _LABEL_CL + 2 * j (sorting 1) and _LABEL_CL + 2 * j + 1 (sorting 2)
+# for the j-th pair of units with CL events.
+_LABEL_UNPAIRED = 0
+_LABEL_TP = 1
+_LABEL_FN = 2
+_LABEL_FP = 3
+_LABEL_CL = 4
+
+
 class SortingComparison():
     def __init__(self, sorting1, sorting2, sorting1_name=None, sorting2_name=None, delta_tp=10, minimum_accuracy=0.5,
-                 count=False, verbose=False):
+                 count=False, verbose=False, sparse_matching=False):
         self._sorting1 = sorting1
         self._sorting2 = sorting2
         self.sorting1_name = sorting1_name
         self.sorting2_name = sorting2_name
         self._delta_tp = delta_tp
         self._min_accuracy = minimum_accuracy
+        # restrict the unit assignment to pairs with agreement above minimum_accuracy and solve it
+        # separately for each connected group of such pairs (for large sortings, e.g. 1000+ units)
+        self._sparse_matching = sparse_matching
         if verbose:
             print("Matching...")
         self._do_matching()
@@ -29,17 +42,34 @@ class SortingComparison():
         return self._sorting2
 
     def getLabels1(self, unit_id):
+        return np.array(self._label_table)[self.getLabelCodes1(unit_id)]
+
+    def getLabels2(self, unit_id):
+        return np.array(self._label_table)[self.getLabelCodes2(unit_id)]
+
+    def getLabelCodes1(self, unit_id):
         if unit_id in self._sorting1.get_unit_ids():
+            self.computeCounts()
             return self._labels_st1[unit_id]
         else:
             raise Exception("Unit_id is not a valid unit")
 
-    def getLabels2(self, unit_id):
-        if unit_id in self._sorting1.get_unit_ids():
-            return self._labels_st1[unit_id]
+    def getLabelCodes2(self, unit_id):
+        if unit_id in self._sorting2.get_unit_ids():
+            self.computeCounts()
+            return self._labels_st2[unit_id]
         else:
             raise Exception("Unit_id is not a valid unit")
 
+    def getLabelTable(self):
+        self.computeCounts()
+        return self._label_table
+
+    def getConfusionMatrix(self):
+        self.computeCounts()
+        st1_idxs, st2_idxs = self._do_confusion()
+        return self._confusion_matrix, st1_idxs, st2_idxs
+
     def getMappedSorting1(self):
         return MappedSortingExtractor(self._sorting2, self._unit_map12)
 
@@ -169,100 +199,71 @@ class SortingComparison():
         N1 = len(unit1_ids)
         N2 = len(unit2_ids)
 
+        # Load the spike trains once
+        spike_trains1 = [np.array(sorting1.get_unit_spike_train(u1)) for u1 in unit1_ids]
+        spike_trains2 = [np.array(sorting2.get_unit_spike_train(u2)) for u2 in unit2_ids]
+
         # Compute events counts
         event_counts1 = np.zeros((N1)).astype(np.int64)
         for i1, u1 in enumerate(unit1_ids):
-            times1 = sorting1.get_unit_spike_train(u1)
-            event_counts1[i1] = len(times1)
-            self._event_counts_1[u1] = len(times1)
+            event_counts1[i1] = len(spike_trains1[i1])
+            self._event_counts_1[u1] = len(spike_trains1[i1])
         event_counts2 = np.zeros((N2)).astype(np.int64)
         for i2, u2 in enumerate(unit2_ids):
-            times2 = sorting2.get_unit_spike_train(u2)
-            event_counts2[i2] = len(times2)
-            self._event_counts_2[u2] = len(times2)
+            event_counts2[i2] = len(spike_trains2[i2])
+            self._event_counts_2[u2] = len(spike_trains2[i2])
 
-        # Compute matching events
-        matching_event_counts = np.zeros((N1, N2)).astype(np.int64)
-        scores = np.zeros((N1, N2))
-        for i1, u1 in enumerate(unit1_ids):
-            times1 = sorting1.get_unit_spike_train(u1)
-            for i2, u2 in enumerate(unit2_ids):
-                times2 = sorting2.get_unit_spike_train(u2)
-                num_matches = count_matching_events(times1, times2, delta=self._delta_tp)
-                # test_unmatched=get_unmatched_times(times1,times2,delta=self._delta_tp)
-                # print(u1,u2,'num_matches',num_matches,'num_unmatched',len(test_unmatched),'sum',num_matches+len(test_unmatched),'total',len(times1))
-                matching_event_counts[i1, i2] = num_matches
-                scores[i1, i2] = self._compute_agreement_score(num_matches, event_counts1[i1], event_counts2[i2])
+        # Compute matching events (all pairs at once, only pairs with matching events are kept)
+        pair_inds1, pair_inds2, pair_counts = count_matching_event_pairs(spike_trains1, spike_trains2, delta=self._delta_tp)
+        pair_scores = pair_counts / (event_counts1[pair_inds1] + event_counts2[pair_inds2] - pair_counts)
 
         # Find best matches for spiketrains 1
         for i1, u1 in enumerate(unit1_ids):
-            scores0 = scores[i1, :]
             self._matching_event_counts_12[u1] = dict()
-            if len(scores0) > 0:
-                if np.max(scores0) > 0:
-                    inds0 = np.where(scores0 > 0)[0]
-                    for i2 in inds0:
-                        self._matching_event_counts_12[u1][unit2_ids[i2]] = matching_event_counts[i1, i2]
-                    i2_best = np.argmax(scores0)
-                    self._best_match_units_12[u1] = unit2_ids[i2_best]
-                else:
-                    self._best_match_units_12[u1] = -1
-            else:
-                self._best_match_units_12[u1] = -1
-
-        # Find best matches for spiketrains 2
+            self._best_match_units_12[u1] = -1
         for i2, u2 in enumerate(unit2_ids):
-            scores0 = scores[:, i2]
             self._matching_event_counts_21[u2] = dict()
-            if len(scores0) > 0:
-                if np.max(scores0) > 0:
-                    inds0 = np.where(scores0 > 0)[0]
-                    for i1 in inds0:
-                        self._matching_event_counts_21[u2][unit1_ids[i1]] = matching_event_counts[i1, i2]
-                    i1_best = np.argmax(scores0)
-                    self._best_match_units_21[u2] = unit1_ids[i1_best]
-                else:
-                    self._best_match_units_21[u2] = -1
-            else:
-                self._best_match_units_21[u2] = -1
+            self._best_match_units_21[u2] = -1
+        for i1, i2, count in zip(pair_inds1.tolist(), pair_inds2.tolist(), pair_counts.tolist()):
+            self._matching_event_counts_12[unit1_ids[i1]][unit2_ids[i2]] = count
+            self._matching_event_counts_21[unit2_ids[i2]][unit1_ids[i1]] = count
+        # (best = highest score, lowest index among ties)
+        for i1, i2 in zip(*_best_pairs(pair_inds1, pair_inds2, pair_scores)):
+            self._best_match_units_12[unit1_ids[i1]] = unit2_ids[i2]
+
+        # Find best matches for spiketrains 2
+        for i2, i1 in zip(*_best_pairs(pair_inds2, pair_inds1, pair_scores)):
+            self._best_match_units_21[unit2_ids[i2]] = unit1_ids[i1]
 
         # Assign best matches
-        [inds1, inds2] = linear_sum_assignment(-scores)
-        inds1 = list(inds1)
-        inds2 = list(inds2)
-        # if len(unit2_ids) > 0:
-        #     k2 = np.max(unit2_ids) + 1
-        # else:
-        #     k2 = 1
+        if self._sparse_matching:
+            # only the candidate pairs that can end up in the unit map take part in the assignment
+            candidates = pair_scores > self._min_accuracy
+            [inds1, inds2] = _sparse_linear_sum_assignment(pair_inds1[candidates], pair_inds2[candidates],
+                                                           pair_scores[candidates], N1, N2)
+        else:
+            scores = np.zeros((N1, N2))
+            scores[pair_inds1, pair_inds2] = pair_scores
+            [inds1, inds2] = linear_sum_assignment(-scores)
+        assignment12 = dict(zip(inds1, inds2))
+        assignment21 = dict(zip(inds2, inds1))
         for i1, u1 in enumerate(unit1_ids):
-            if i1 in inds1:
-                aa = inds1.index(i1)
-                i2 = inds2[aa]
-                u2 = unit2_ids[i2]
+            if i1 in assignment12:
+                u2 = unit2_ids[assignment12[i1]]
                 if self.getAgreementFraction(u1, u2) > self._min_accuracy:
                     self._unit_map12[u1] = u2
                 else:
                     self._unit_map12[u1] = -1
             else:
-                # self._unit_map12[u1] = k2
-                # k2 = k2+1
                 self._unit_map12[u1] = -1
-        # if len(unit1_ids) > 0:
-        #     k1 = np.max(unit1_ids) + 1
-        # else:
-        #     k1 = 1
         for i2, u2 in enumerate(unit2_ids):
-            if i2 in inds2:
-                aa = inds2.index(i2)
-                i1 = inds1[aa]
-                u1 = unit1_ids[i1]
+            if i2 in assignment21:
+                u1 = unit1_ids[assignment21[i2]]
                 if self.getAgreementFraction(u1, u2) > self._min_accuracy:
                     self._unit_map21[u2] = u1
                 else:
                     self._unit_map21[u2] = -1
             else:
-                # self._unit_map21[u2] = k1
-                # k1 = k1+1
                 self._unit_map21[u2] = -1
 
     def _do_counting(self, verbose=False):
@@ -270,82 +271,136 @@ class SortingComparison():
         sorting2 = self._sorting2
         unit1_ids = sorting1.get_unit_ids()
         unit2_ids = sorting2.get_unit_ids()
-        self._labels_st1 = dict()
-        self._labels_st2 = dict()
-        # N1 = len(unit1_ids)
-        # N2 = len(unit2_ids)
-        # Evaluate
-        for u1 in unit1_ids:
-            st1 = sorting1.get_unit_spike_train(u1)
-            lab_st1 = np.array(['UNPAIRED'] * len(st1))
-            self._labels_st1[u1] = lab_st1
-        for u2 in unit2_ids:
-            st2 = sorting2.get_unit_spike_train(u2)
-            lab_st2 = np.array(['UNPAIRED'] * len(st2))
-            self._labels_st2[u2] = lab_st2
+        N1 = len(unit1_ids)
+        N2 = len(unit2_ids)
+        delta = self._delta_tp
+        unit2_index = dict([(u2, i2) for i2, u2 in enumerate(unit2_ids)])
+
+        # Labels are stored as integer codes into self._label_table (see getLabels1/getLabels2)
+        spike_trains1 = [np.array(sorting1.get_unit_spike_train(u1)).ravel() for u1 in unit1_ids]
+        spike_trains2 = [np.array(sorting2.get_unit_spike_train(u2)).ravel() for u2 in unit2_ids]
+        labels1 = [np.full(len(st1), _LABEL_UNPAIRED, dtype=np.int32) for st1 in spike_trains1]
+        labels2 = [np.full(len(st2), _LABEL_UNPAIRED, dtype=np.int32) for st2 in spike_trains2]
+        orders2 = [np.argsort(st2, kind='mergesort') for st2 in spike_trains2]
+        sorted_trains2 = [st2[order2] for st2, order2 in zip(spike_trains2, orders2)]
 
         if verbose:
             print('Finding TP')
-        for u1 in sorting1.get_unit_ids():
-            if self.getMappedSorting1().getMappedUnitIds(u1) != -1:
-                lab_st1 = self._labels_st1[u1]
-                lab_st2 = self._labels_st2[self.getMappedSorting1().getMappedUnitIds(u1)]
-                mapped_st = self.getMappedSorting1().get_unit_spike_train(u1)
-                # from gtst: TP, TPO, TPSO, FN, FNO, FNSO
-                for sp_i, n_sp in enumerate(sorting1.get_unit_spike_train(u1)):
-                    id_sp = np.where((mapped_st > n_sp - self._delta_tp) & (mapped_st < n_sp + self._delta_tp))[0]
-                    if len(id_sp) == 1:
-                        lab_st1[sp_i] = 'TP'
-                        lab_st2[id_sp] = 'TP'
-            else:
-                lab_st1 = np.array(['FN'] * len(sorting1.get_unit_spike_train(u1)))
+        # a spike is TP if exactly one spike of the mapped unit lies within (t - delta, t + delta)
+        mapped_units1 = []
+        for i1, u1 in enumerate(unit1_ids):
+            u2 = self._unit_map12[u1]
+            if u2 == -1:
+                continue
+            mapped_units1.append(i1)
+            i2 = unit2_index[u2]
+            lo, hi = _find_events_in_window(sorted_trains2[i2], spike_trains1[i1], delta)
+            tp = (hi - lo) == 1
+            labels1[i1][tp] = _LABEL_TP
+            labels2[i2][orders2[i2][lo[tp]]] = _LABEL_TP
 
         # find CL-CLO-CLSO
         if verbose:
             print('Finding CL')
-        for u1 in sorting1.get_unit_ids():
-            lab_st1 = self._labels_st1[u1]
-            st1 = sorting1.get_unit_spike_train(u1)
-            for l_gt, lab in enumerate(lab_st1):
-                if lab == 'UNPAIRED':
-                    for u2 in sorting2.get_unit_ids():
-                        if u2 in self.getMappedSorting1().getMappedUnitIds() \
-                                and self.getMappedSorting1().getMappedUnitIds(u1) != -1:
-                            lab_st2 = self._labels_st2[u2]
-                            st2 = sorting2.get_unit_spike_train(u2)
-
-                            n_up = st1[l_gt]
-                            id_sp = np.where((st2 > n_up - self._delta_tp) & (st2 < n_up + self._delta_tp))[0]
-                            if len(id_sp) == 1 and lab_st2[id_sp] == 'UNPAIRED':
-                                lab_st1[l_gt] = 'CL_' + str(u1) + '_' + str(u2)
-                                lab_st2[id_sp] = 'CL_' + str(u2) + '_' + str(u1)
-                                # if lab_st2[id_sp] == 'UNPAIRED':
-                                #     lab_st2[id_sp] = 'CL_NP'
+        # An unpaired spike of a mapped unit u1 is a CL with a mapped unit u2 if exactly one spike of u2
+        # lies within the window and that spike is still unpaired. Each spike of u2 is claimed by the
+        # first such spike of sorting 1 (in unit order, then spike order), and when a spike of sorting 1
+        # claims spikes of several units, the label refers to the last of them (in unit order).
+        mapped_unit2_ids = set(self._unit_map12.values())
+        cl_units2 = [i2 for i2, u2 in enumerate(unit2_ids) if u2 in mapped_unit2_ids]
+        offsets1 = np.cumsum([0] + [len(st1) for st1 in spike_trains1])
+        offsets2 = np.cumsum([0] + [len(st2) for st2 in spike_trains2])
+        cl_pairs = np.zeros((0,), dtype=np.int64)
+        if len(mapped_units1) > 0 and len(cl_units2) > 0:
+            # unpaired events of sorting 1 (global index g) and candidate events of sorting 2 (global index k),
+            # the latter sorted by time
+            g = np.concatenate([offsets1[i1] + np.where(labels1[i1] == _LABEL_UNPAIRED)[0] for i1 in mapped_units1])
+            k = np.concatenate([offsets2[i2] + orders2[i2] for i2 in cl_units2])
+            times1 = np.concatenate(spike_trains1)[g] if len(g) > 0 else np.zeros((0,))
+            times2 = np.concatenate(spike_trains2)[k]
+            units1 = np.repeat(np.arange(N1), np.diff(offsets1))
+            units2 = np.repeat(np.arange(N2), np.diff(offsets2))
+            ii = np.argsort(times2, kind='mergesort')
+            k = k[ii]
+            times2 = times2[ii]
+            lo, hi = _find_events_in_window(times2, times1, delta)
+            nn = hi - lo
+            # expand all (event1, event2) pairs within the window
+            c1 = np.repeat(np.arange(len(g)), nn)
+            c2 = np.repeat(lo, nn) + np.arange(len(c1)) - np.repeat(np.cumsum(nn) - nn, nn)
+            cand_g = g[c1]
+            cand_k = k[c2]
+            cand_u2 = units2[cand_k]
+            # keep the (event1, unit2) groups with exactly one event of unit2 in the window
+            group_codes = cand_g * N2 + cand_u2
+            uniq, inv, group_counts = np.unique(group_codes, return_inverse=True, return_counts=True)
+            single = group_counts[inv.ravel()] == 1
+            cand_g = cand_g[single]
+            cand_k = cand_k[single]
+            cand_u2 = cand_u2[single]
+            labels2_all = np.concatenate(labels2)
+            unpaired = labels2_all[cand_k] == _LABEL_UNPAIRED
+            cand_g = cand_g[unpaired]
+            cand_k = cand_k[unpaired]
+            cand_u2 = cand_u2[unpaired]
+            # each event2 is claimed by the first event1
+            ii = np.lexsort((cand_g, cand_k))
+            first = np.ones(len(ii), dtype=bool)
+            first[1:] = cand_k[ii[1:]] != cand_k[ii[:-1]]
+            win_g = cand_g[ii[first]]
+            win_k = cand_k[ii[first]]
+            win_u2 = cand_u2[ii[first]]
+            # each event1 is labelled with the last unit2 it claimed
+            ii = np.lexsort((win_u2, win_g))
+            last = np.ones(len(ii), dtype=bool)
+            last[:-1] = win_g[ii[1:]] != win_g[ii[:-1]]
+            last_g = win_g[ii[last]]
+            last_u2 = win_u2[ii[last]]
+
+            win_pairs = units1[win_g] * N2 + win_u2
+            last_pairs = units1[last_g] * N2 + last_u2
+            cl_pairs, inv = np.unique(np.concatenate((win_pairs, last_pairs)), return_inverse=True)
+            inv = inv.ravel()
+            codes2 = _LABEL_CL + 2 * inv[:len(win_pairs)] + 1
+            codes1 = _LABEL_CL + 2 * inv[len(win_pairs):]
+            for i2 in np.unique(units2[win_k]):
+                inds = np.where(units2[win_k] == i2)[0]
+                labels2[i2][win_k[inds] - offsets2[i2]] = codes2[inds]
+            for i1 in np.unique(units1[last_g]):
+                inds = np.where(units1[last_g] == i1)[0]
+                labels1[i1][last_g[inds] - offsets1[i1]] = codes1[inds]
+
+        self._label_table = ['UNPAIRED', 'TP', 'FN', 'FP']
+        self._cl_unit_pairs = []
+        for pair in cl_pairs:
+            u1 = unit1_ids[pair // N2]
+            u2 = unit2_ids[pair % N2]
+            self._label_table.append('CL_' + str(u1) + '_' + str(u2))
+            self._label_table.append('CL_' + str(u2) + '_' + str(u1))
+            self._cl_unit_pairs.append((u1, u2))
 
         if verbose:
             print('Finding FP and FN')
-        for u1 in sorting1.get_unit_ids():
-            lab_st1 = self._labels_st1[u1]
-            for l_gt, lab in enumerate(lab_st1):
-                if lab == 'UNPAIRED':
-                    lab_st1[l_gt] = 'FN'
+        for lab_st1 in labels1:
+            lab_st1[lab_st1 == _LABEL_UNPAIRED] = _LABEL_FN
+        for lab_st2 in labels2:
+            lab_st2[lab_st2 == _LABEL_UNPAIRED] = _LABEL_FP
 
-        for u2 in sorting2.get_unit_ids():
-            lab_st2 = self._labels_st2[u2]
-            for l_gt, lab in enumerate(lab_st2):
-                if lab == 'UNPAIRED':
-                    lab_st2[l_gt] = 'FP'
+        self._labels_st1 = dict(zip(unit1_ids, labels1))
+        self._labels_st2 = dict(zip(unit2_ids, labels2))
 
-        TOT_ST1 = sum([len(sorting1.get_unit_spike_train(unit)) for unit in sorting1.get_unit_ids()])
-        TOT_ST2 = sum([len(sorting2.get_unit_spike_train(unit)) for unit in sorting2.get_unit_ids()])
+        TOT_ST1 = int(offsets1[-1])
+        TOT_ST2 = int(offsets2[-1])
         total_spikes = TOT_ST1 + TOT_ST2
-        TP = sum([len(np.where('TP' == self._labels_st1[unit])[0]) for unit in sorting1.get_unit_ids()])
-        CL = sum(
-            [len([i for i, v in enumerate(self._labels_st1[unit]) if 'CL' in v]) for unit in sorting1.get_unit_ids()])
-        FN = sum([len(np.where('FN' == self._labels_st1[unit])[0]) for unit in sorting1.get_unit_ids()])
-        FP = sum([len(np.where('FP' == self._labels_st2[unit])[0]) for unit in sorting2.get_unit_ids()])
+        labels1_all = np.concatenate(labels1) if N1 > 0 else np.zeros((0,), dtype=np.int32)
+        labels2_all = np.concatenate(labels2) if N2 > 0 else np.zeros((0,), dtype=np.int32)
+        TP = int(np.sum(labels1_all == _LABEL_TP))
+        CL = int(np.sum(labels1_all >= _LABEL_CL))
+        FN = int(np.sum(labels1_all == _LABEL_FN))
+        FP = int(np.sum(labels2_all == _LABEL_FP))
         self.counts = {'TP': TP, 'CL': CL, 'FN': FN, 'FP': FP, 'TOT': total_spikes, 'TOT_ST1': TOT_ST1,
                        'TOT_ST2': TOT_ST2}
+        self._counts = self.counts
 
         if verbose:
             print('TP :', TP)
@@ -389,28 +444,34 @@ class SortingComparison():
         st2_matched = unit_map_matched
         st2_unmatched = []
 
+        # number of CL events per (unit1, unit2) pair, from the CL label codes of sorting 1
+        num_cl = dict()
+        for u1 in unit1_ids:
+            cl_counts = np.bincount(self._labels_st1[u1], minlength=len(self._label_table))
+            for j, (u1b, u2) in enumerate(self._cl_unit_pairs):
+                if u1b == u1 and cl_counts[_LABEL_CL + 2 * j] > 0:
+                    num_cl[(u1, u2)] = int(cl_counts[_LABEL_CL + 2 * j])
+
         for u_i, u1 in enumerate(np.array(sorting1.get_unit_ids())[idxs_matched]):
             lab_st1 = self._labels_st1[u1]
-            tp = len(np.where('TP' == lab_st1)[0])
+            tp = np.sum(lab_st1 == _LABEL_TP)
             conf_matrix[u_i, u_i] = int(tp)
             for u2 in sorting2.get_unit_ids():
-                lab_st2 = self._labels_st2[u2]
-                cl_str = str(u1) + '_' + str(u2)
-                cl = len([i for i, v in enumerate(lab_st1) if 'CL' in v and cl_str in v])
+                cl = num_cl.get((u1, u2), 0)
                 if cl != 0:
                     st_p = np.where(u2 == unit_map_matched)
                     conf_matrix[u_i, st_p] = int(cl)
-            fn = len(np.where('FN' == lab_st1)[0])
+            fn = np.sum(lab_st1 == _LABEL_FN)
             conf_matrix[u_i, -1] = int(fn)
 
         for u_i, u1 in enumerate(np.array(sorting1.get_unit_ids())[idxs_unmatched]):
             lab_st1 = self._labels_st1[u1]
-            fn = len(np.where('FN' == lab_st1)[0])
+            fn = np.sum(lab_st1 == _LABEL_FN)
             conf_matrix[u_i + len(idxs_matched), -1] = int(fn)
 
         for _, u2 in enumerate(sorting2.get_unit_ids()):
             lab_st2 = self._labels_st2[u2]
-            fp = len(np.where('FP' == lab_st2)[0])
+            fp = np.sum(lab_st2 == _LABEL_FP)
             st_p = np.where(u2 == unit_map_matched)[0]
             if len(st_p) != 0:
                 conf_matrix[-1, st_p] = int(fp)
@@ -431,21 +492,18 @@ class SortingComparison():
         if verbose:
             print('Finding TP')
         # from gtst: TP, TPO, TPSO, FN, FNO, FNSO
-        for sp_i, n_sp in enumerate(spiketrain1):
-            id_sp = np.where((spiketrain2 > n_sp - delta_tp) & (spiketrain2 < n_sp + delta_tp))[0]
-            if len(id_sp) == 1:
-                lab_st1[sp_i] = 'TP'
-                lab_st2[id_sp] = 'TP'
+        spiketrain1 = np.array(spiketrain1)
+        spiketrain2 = np.array(spiketrain2)
+        order2 = np.argsort(spiketrain2, kind='mergesort')
+        lo, hi = _find_events_in_window(spiketrain2[order2], spiketrain1, delta_tp)
+        tp = (hi - lo) == 1
+        lab_st1[tp] = 'TP'
+        lab_st2[order2[lo[tp]]] = 'TP'
 
         if verbose:
             print('Finding FP and FN')
-        for l_gt, lab in enumerate(lab_st1):
-            if lab == 'UNPAIRED':
-                lab_st1[l_gt] = 'FN'
-
-        for l_gt, lab in enumerate(lab_st2):
-            if lab == 'UNPAIRED':
-                lab_st2[l_gt] = 'FP'
+        lab_st1[lab_st1 == 'UNPAIRED'] = 'FN'
+        lab_st2[lab_st2 == 'UNPAIRED'] = 'FP'
 
         return lab_st1, lab_st2
 
@@ -513,6 +571,222 @@ def count_matching_events(times1, times2, delta=10):
     return len(inds2) + 1
 
 
+def count_matching_events_matrix(spike_trains1, spike_trains2, delta=10, chunk_size=1000000):
+    """
+    Compute the matching event counts for all pairs of units at once.
+
+    Equivalent to calling count_matching_events(spike_trains1[i1], spike_trains2[i2], delta=delta)
+    for every pair (i1, i2), but all spike trains are merged and sorted by time only once and the
+    full N1xN2 matrix is filled by a sweep over the candidate (spike1, spike2) pairs within delta
+    of each other. The count of a pair of units with events at identical times depends on how
+    count_matching_events orders the tied events, so those pairs are counted with
+    count_matching_events itself.
+
+    Parameters
+    ----------
+    spike_trains1: list of 1D arrays
+        Spike trains of the units of sorting 1
+    spike_trains2: list of 1D arrays
+        Spike trains of the units of sorting 2
+    delta: int
+        Maximum time difference for two events to match
+    chunk_size: int
+        Maximum number of sorting 1 events expanded into candidate pairs at a time (bounds memory)
+
+    Returns
+    -------
+    counts: 2D int64 array of shape (N1, N2)
+    """
+    counts = np.zeros((len(spike_trains1), len(spike_trains2)), dtype=np.int64)
+    inds1, inds2, pair_counts = count_matching_event_pairs(spike_trains1, spike_trains2, delta=delta, chunk_size=chunk_size)
+    counts[inds1, inds2] = pair_counts
+    return counts
+
+
+def count_matching_event_pairs(spike_trains1, spike_trains2, delta=10, chunk_size=1000000):
+    """
+    Sparse version of count_matching_events_matrix: only the pairs of units with at
+    least one matching event are returned, so memory does not grow with N1xN2.
+
+    Returns
+    -------
+    inds1: 1D int64 array
+        Unit indices in sorting 1
+    inds2: 1D int64 array
+        Unit indices in sorting 2
+    counts: 1D int64 array
+        Number of matching events of each pair (all > 0), sorted by (inds1, inds2)
+    """
+    N1 = len(spike_trains1)
+    N2 = len(spike_trains2)
+    empty = np.zeros((0,), dtype=np.int64)
+    if N1 == 0 or N2 == 0:
+        return empty, empty, empty
+
+    times1, units1 = _concatenate_spike_trains(spike_trains1)
+    times2, units2 = _concatenate_spike_trains(spike_trains2)
+    if len(times1) == 0 or len(times2) == 0:
+        return empty, empty, empty
+
+    # global rank of every event in the merged (stable) time ordering
+    times_concat = np.concatenate((times1, times2))
+    order = np.argsort(times_concat, kind='mergesort')
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    ranks1 = ranks[:len(times1)]
+    ranks2 = ranks[len(times1):]
+
+    # sort the events of each sorting by rank and find the neighboring events of the same unit
+    times1, units1, ranks1, prev_ranks1, next_ranks1 = _sort_events_by_rank(times1, units1, ranks1)
+    times2, units2, ranks2, prev_ranks2, next_ranks2 = _sort_events_by_rank(times2, units2, ranks2)
+
+    # Two events e1 (unit u1) and e2 (unit u2) are adjacent in the pairwise merge of u1 and u2 iff no
+    # other event of u1 or u2 lies between them. Each adjacent pair within delta is a link, and
+    # count_matching_events counts the chains of consecutive links:
+    #     num_matches = num_links - num_events_shared_by_two_links
+    fwd_links = []
+    bwd_links = []
+    tied_codes = []
+    for i in range(0, len(times1), chunk_size):
+        sl = slice(i, i + chunk_size)
+        lo = np.searchsorted(times2, times1[sl] - delta, side='left')
+        hi = np.searchsorted(times2, times1[sl] + delta, side='right')
+        nn = hi - lo
+        if np.sum(nn) == 0:
+            continue
+        # expand all candidate pairs (j1, j2) within delta
+        j1 = np.repeat(np.arange(i, i + len(nn)), nn)
+        offsets = np.arange(len(j1)) - np.repeat(np.cumsum(nn) - nn, nn)
+        j2 = np.repeat(lo, nn) + offsets
+        # pairs of units with events at identical times
+        tied = times1[j1] == times2[j2]
+        tied_codes.append(units1[j1[tied]] * N2 + units2[j2[tied]])
+        r1 = ranks1[j1]
+        r2 = ranks2[j2]
+        # e2 is the first event of its unit after e1, and e1's unit has no event in between
+        fwd = (r2 > r1) & (prev_ranks2[j2] < r1) & (next_ranks1[j1] > r2)
+        # e2 is the last event of its unit before e1, and e1's unit has no event in between
+        bwd = (r2 < r1) & (next_ranks2[j2] > r1) & (prev_ranks1[j1] < r2)
+        fwd_links.append((j1[fwd], j2[fwd]))
+        bwd_links.append((j1[bwd], j2[bwd]))
+    if len(fwd_links) == 0:
+        return empty, empty, empty
+    fwd_j1 = np.concatenate([a for a, _ in fwd_links])
+    fwd_j2 = np.concatenate([b for _, b in fwd_links])
+    bwd_j1 = np.concatenate([a for a, _ in bwd_links])
+    bwd_j2 = np.concatenate([b for _, b in bwd_links])
+
+    link_codes, num_links = np.unique(np.concatenate((units1[fwd_j1] * N2 + units2[fwd_j2],
+                                                      units1[bwd_j1] * N2 + units2[bwd_j2])), return_counts=True)
+    # events of sorting 1 linked both backward and forward to the same unit of sorting 2
+    shared1 = np.intersect1d(fwd_j1 * N2 + units2[fwd_j2], bwd_j1 * N2 + units2[bwd_j2], assume_unique=True)
+    # events of sorting 2 linked both backward and forward to the same unit of sorting 1
+    # (a forward link seen from e1 is a backward link seen from e2, and vice versa)
+    shared2 = np.intersect1d(bwd_j2 * N1 + units1[bwd_j1], fwd_j2 * N1 + units1[fwd_j1], assume_unique=True)
+    shared_codes = np.concatenate((units1[shared1 // N2] * N2 + shared1 % N2,
+                                   (shared2 % N1) * N2 + units2[shared2 // N1]))
+    # every shared event belongs to a pair with links
+    num_shared = np.bincount(np.searchsorted(link_codes, shared_codes), minlength=len(link_codes))
+    pair_codes = link_codes
+    pair_counts = num_links - num_shared
+
+    # The chains above assume a fixed order of tied events of the two sortings, whereas
+    # count_matching_events uses the (unstable) default sort. Count the pairs with ties as it does.
+    tied_codes = np.unique(np.concatenate(tied_codes))
+    if len(tied_codes) > 0:
+        tied_counts = np.array([
+            count_matching_events(np.array(spike_trains1[code // N2]).ravel(), np.array(spike_trains2[code % N2]).ravel(), delta=delta)
+            for code in tied_codes.tolist()
+        ], dtype=np.int64)
+        keep = ~np.isin(pair_codes, tied_codes)
+        pair_codes = np.concatenate((pair_codes[keep], tied_codes))
+        pair_counts = np.concatenate((pair_counts[keep], tied_counts))
+        order = np.argsort(pair_codes)
+        pair_codes = pair_codes[order]
+        pair_counts = pair_counts[order]
+        nonzero = pair_counts > 0
+        pair_codes = pair_codes[nonzero]
+        pair_counts = pair_counts[nonzero]
+
+    return pair_codes // N2, pair_codes % N2, pair_counts
+
+
+def _concatenate_spike_trains(spike_trains):
+    times = np.concatenate([np.array(st).ravel() for st in spike_trains])
+    units = np.concatenate([np.full(len(np.array(st).ravel()), i, dtype=np.int64) for i, st in enumerate(spike_trains)])
+    return times, units
+
+
+def _sort_events_by_rank(times, units, ranks):
+    inds = np.argsort(ranks)
+    times = times[inds]
+    units = units[inds]
+    ranks = ranks[inds]
+    # neighboring events of the same unit (ordering by unit then rank)
+    inds_u = np.lexsort((ranks, units))
+    same_as_prev = np.zeros(len(inds_u), dtype=bool)
+    same_as_prev[1:] = units[inds_u[1:]] == units[inds_u[:-1]]
+    prev_ranks = np.full(len(ranks), -1, dtype=np.int64)
+    next_ranks = np.full(len(ranks), np.iinfo(np.int64).max, dtype=np.int64)
+    prev_ranks[inds_u[1:][same_as_prev[1:]]] = ranks[inds_u[:-1][same_as_prev[1:]]]
+    next_ranks[inds_u[:-1][same_as_prev[1:]]] = ranks[inds_u[1:][same_as_prev[1:]]]
+    return times, units, ranks, prev_ranks, next_ranks
+
+
+def _best_pairs(inds_a, inds_b, scores):
+    # for each index in inds_a, the index in inds_b with the highest score (lowest index among ties)
+    if len(inds_a) == 0:
+        return inds_a, inds_b
+    ii = np.lexsort((inds_b, -scores, inds_a))
+    first = np.ones(len(ii), dtype=bool)
+    first[1:] = inds_a[ii[1:]] != inds_a[ii[:-1]]
+    return inds_a[ii[first]], inds_b[ii[first]]
+
+
+def _sparse_linear_sum_assignment(inds1, inds2, scores, N1, N2):
+    """
+    Maximize the total score of a one-to-one assignment given the nonzero scores
+    (inds1[k], inds2[k], scores[k]). Units not connected by a nonzero score can be
+    assigned independently, so the problem is solved separately for each connected
+    component of the bipartite graph of units.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    if len(inds1) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+    graph = coo_matrix((np.ones(len(inds1)), (inds1, N1 + inds2)), shape=(N1 + N2, N1 + N2))
+    _, node_labels = connected_components(graph, directed=False)
+    components = node_labels[inds1]
+    order = np.argsort(components, kind='mergesort')
+    components = components[order]
+    boundaries = np.concatenate(([0], np.where(components[1:] != components[:-1])[0] + 1, [len(components)]))
+    assigned1 = []
+    assigned2 = []
+    for b0, b1 in zip(boundaries[:-1], boundaries[1:]):
+        ii = order[b0:b1]
+        if len(ii) == 1:
+            assigned1.append(inds1[ii])
+            assigned2.append(inds2[ii])
+            continue
+        rows, sub_inds1 = np.unique(inds1[ii], return_inverse=True)
+        cols, sub_inds2 = np.unique(inds2[ii], return_inverse=True)
+        sub_scores = np.zeros((len(rows), len(cols)))
+        sub_scores[sub_inds1.ravel(), sub_inds2.ravel()] = scores[ii]
+        sub_rows, sub_cols = linear_sum_assignment(-sub_scores)
+        # pairs with zero score are left unassigned
+        keep = sub_scores[sub_rows, sub_cols] > 0
+        assigned1.append(rows[sub_rows[keep]])
+        assigned2.append(cols[sub_cols[keep]])
+    return np.concatenate(assigned1), np.concatenate(assigned2)
+
+
+def _find_events_in_window(sorted_times, times, delta):
+    # range [lo, hi) of sorted_times strictly within (t - delta, t + delta) for each t in times
+    lo = np.searchsorted(sorted_times, times - delta, side='right')
+    hi = np.searchsorted(sorted_times, times + delta, side='left')
+    return lo, hi
+
+
 def confusion_matrix(gtst, sst, pairs, plot_fig=True, xlabel=None, ylabel=None):
     '''
 
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import spikeextractors as se
+from spikeforest_analysis.sortingcomparison import SortingComparison, count_matching_events, count_matching_events_matrix, count_matching_event_pairs
+
+
+def _make_tied_spike_trains(seed):
+    # integer spike times in a short time range, so that many events of the
+    # two sortings fall on identical frames
+    rng = np.random.RandomState(seed)
+    spike_trains1 = [np.sort(rng.randint(0, 3000, size=rng.randint(50, 200))) for _ in range(4)]
+    spike_trains2 = []
+    for st1 in spike_trains1:
+        st2 = st1[rng.rand(len(st1)) < 0.8]
+        st2 = st2 + rng.randint(-2, 3, size=len(st2))
+        spike_trains2.append(np.sort(st2))
+    spike_trains2.append(np.sort(rng.randint(0, 3000, size=150)))
+    return spike_trains1, spike_trains2
+
+
+def _count_matching_events_reference(times1, times2, delta):
+    # the original pairwise count, with the default sort of numpy (which
+    # decides the order of the tied events of the two spike trains)
+    times_concat = np.concatenate((times1, times2))
+    membership = np.concatenate((np.ones(times1.shape) * 1, np.ones(times2.shape) * 2))
+    indices = times_concat.argsort()
+    membership_sorted = membership[indices]
+    diffs = np.diff(times_concat[indices])
+    inds = np.where((diffs <= delta) & (membership_sorted[0:-1] != membership_sorted[1:]))[0]
+    if len(inds) == 0:
+        return 0
+    return int(np.sum(inds[:-1] + 1 != inds[1:])) + 1
+
+
+def test_count_matching_events():
+    times1 = np.array([100, 200, 300, 1000])
+    times2 = np.array([105, 260, 300, 2000])
+    # 100-105 and 300-300 match, 200 and 260 are too far apart
+    assert count_matching_events(times1, times2, delta=10) == 2
+    assert count_matching_events(times1, np.array([]), delta=10) == 0
+
+
+def test_count_matching_events_matrix_with_tied_times():
+    for seed in range(5):
+        spike_trains1, spike_trains2 = _make_tied_spike_trains(seed)
+        num_tied = sum([len(np.intersect1d(st1, st2)) for st1 in spike_trains1 for st2 in spike_trains2])
+        assert num_tied > 0
+        for delta in [0, 3, 10]:
+            expected = np.zeros((len(spike_trains1), len(spike_trains2)), dtype=np.int64)
+            for i1, st1 in enumerate(spike_trains1):
+                for i2, st2 in enumerate(spike_trains2):
+                    expected[i1, i2] = _count_matching_events_reference(st1, st2, delta=delta)
+                    assert count_matching_events(st1, st2, delta=delta) == expected[i1, i2]
+            counts = count_matching_events_matrix(spike_trains1, spike_trains2, delta=delta, chunk_size=50)
+            assert np.array_equal(counts, expected)
+            inds1, inds2, pair_counts = count_matching_event_pairs(spike_trains1, spike_trains2, delta=delta)
+            assert np.all(pair_counts > 0)
+            assert np.array_equal(expected[inds1, inds2], pair_counts)
+            assert np.sum(pair_counts) == np.sum(expected)
+
+
+def _make_sorting(spike_trains):
+    sorting = se.NumpySortingExtractor()
+    for unit_id, times in spike_trains.items():
+        sorting.add_unit(unit_id, np.array(times))
+    return sorting
+
+
+def test_sorting_comparison_labels():
+    sorting1 = _make_sorting({
+        1: [100, 200, 300, 400, 500],
+        2: [1000, 1100, 1200, 1300],
+        3: [3000],
+    })
+    # unit 2 of sorting 2 matches unit 1 of sorting 1 (and not unit 2)
+    sorting2 = _make_sorting({
+        2: [102, 205, 305, 405, 700],
+        4: [503, 1003, 1102, 1204, 1302],
+        5: [2000, 2100],
+    })
+    SC = SortingComparison(sorting1, sorting2, delta_tp=10, count=True)
+    assert SC.getBestUnitMatch1(1) == 2
+    assert SC.getBestUnitMatch1(2) == 4
+    assert SC.getBestUnitMatch1(3) == -1
+    assert SC.getLabelTable() == ['UNPAIRED', 'TP', 'FN', 'FP', 'CL_1_4', 'CL_4_1']
+
+    # 500 has no event of unit 2 within delta, but is within delta of 503 of unit 4
+    assert list(SC.getLabels1(1)) == ['TP', 'TP', 'TP', 'TP', 'CL_1_4']
+    assert list(SC.getLabels1(2)) == ['TP', 'TP', 'TP', 'TP']
+    assert list(SC.getLabels1(3)) == ['FN']
+    assert list(SC.getLabels2(2)) == ['TP', 'TP', 'TP', 'TP', 'FP']
+    assert list(SC.getLabels2(4)) == ['CL_4_1', 'TP', 'TP', 'TP', 'TP']
+    assert list(SC.getLabels2(5)) == ['FP', 'FP']
+    assert list(SC.getLabelCodes2(4)) == [5, 1, 1, 1, 1]
+    with pytest.raises(Exception):
+        # a unit of sorting 1 only
+        SC.getLabels2(3)
+    with pytest.raises(Exception):
+        SC.getLabels1(4)
+
+    assert SC.counts == {'TP': 8, 'CL': 1, 'FN': 1, 'FP': 3, 'TOT': 22, 'TOT_ST1': 10, 'TOT_ST2': 12}
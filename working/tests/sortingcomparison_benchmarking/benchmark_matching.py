@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Benchmark the all-pairs matcher (count_matching_events_matrix) used by
+# SortingComparison._do_matching against the original pairwise loop over
+# count_matching_events, and check that the counts are identical.
+
+import argparse
+import time
+import numpy as np
+from spikeforest_analysis.sortingcomparison import count_matching_events, count_matching_events_matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sorting comparison matching engine')
+    parser.add_argument('--num_units_true', type=int, default=100)
+    parser.add_argument('--num_units_sorted', type=int, default=300)
+    parser.add_argument('--duration_sec', type=float, default=600)
+    parser.add_argument('--firing_rate', type=float, default=5, help='Mean firing rate (Hz)')
+    parser.add_argument('--samplerate', type=float, default=30000)
+    parser.add_argument('--delta', type=int, default=30)
+    parser.add_argument('--skip_pairwise', action='store_true', help='Only time the all-pairs matcher')
+    args = parser.parse_args()
+
+    spike_trains_true, spike_trains_sorted = _make_spike_trains(args)
+    print('Total events: {} (true), {} (sorted)'.format(
+        sum([len(st) for st in spike_trains_true]), sum([len(st) for st in spike_trains_sorted])))
+
+    timer = time.time()
+    counts = count_matching_events_matrix(spike_trains_true, spike_trains_sorted, delta=args.delta)
+    elapsed_matrix = time.time() - timer
+    print('count_matching_events_matrix: {:.3f} sec'.format(elapsed_matrix))
+
+    if args.skip_pairwise:
+        return
+
+    timer = time.time()
+    counts_pairwise = np.zeros(counts.shape, dtype=np.int64)
+    for i1, times1 in enumerate(spike_trains_true):
+        for i2, times2 in enumerate(spike_trains_sorted):
+            counts_pairwise[i1, i2] = count_matching_events(times1, times2, delta=args.delta)
+    elapsed_pairwise = time.time() - timer
+    print('pairwise count_matching_events: {:.3f} sec'.format(elapsed_pairwise))
+    print('Speedup: {:.1f}x'.format(elapsed_pairwise / elapsed_matrix))
+
+    assert np.array_equal(counts, counts_pairwise), 'Matching event counts differ'
+    print('Counts are identical.')
+
+
+def _make_spike_trains(args):
+    rng = np.random.RandomState(0)
+    num_frames = int(args.duration_sec * args.samplerate)
+    spike_trains_true = []
+    for _ in range(args.num_units_true):
+        num_events = rng.poisson(args.firing_rate * args.duration_sec)
+        spike_trains_true.append(np.sort(rng.randint(0, num_frames, size=num_events)).astype(np.float64))
+    # sorted units: jittered, incomplete copies of true units (some split in two) plus noise units
+    spike_trains_sorted = []
+    for i2 in range(args.num_units_sorted):
+        if i2 < args.num_units_true:
+            times = spike_trains_true[i2]
+            times = times[rng.rand(len(times)) < 0.8]
+            times = times + rng.randint(-args.delta, args.delta + 1, size=len(times))
+        else:
+            num_events = rng.poisson(args.firing_rate * args.duration_sec)
+            times = rng.randint(0, num_frames, size=num_events).astype(np.float64)
+        spike_trains_sorted.append(np.sort(times))
+    return spike_trains_true, spike_trains_sorted
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ import numpy as np
 import spikeextractors as se
 from spikeforest import mdaio
 from spikeforest_analysis import bandpass_filter
+from spikeforest_analysis.snippets import choose_random_events, extract_snippets
 import mlprocessors as mlpr
 
 from spikeforest import SFMdaRecordingExtractor, SFMdaSortingExtractor
@@ -226,21 +227,9 @@ class FilterTimeseries(mlpr.Processor):
 
 
 def _get_random_spike_waveforms(*, recording, sorting, unit, max_num=50, channels=None, snippet_len=100):
-    st = sorting.get_unit_spike_train(unit_id=unit)
-    num_events = len(st)
-    if num_events > max_num:
-        event_indices = np.random.choice(
-            range(num_events), size=max_num, replace=False)
-    else:
-        event_indices = range(num_events)
-
-    spikes = recording.get_snippets(reference_frames=st[event_indices].astype(int), snippet_len=snippet_len,
-                                    channel_ids=channels)
-    if len(spikes) > 0:
-        spikes = np.dstack(tuple(spikes))
-    else:
-        spikes = np.zeros((recording.get_num_channels(), snippet_len, 0))
-    return spikes
+    event_frames = choose_random_events(sorting=sorting, unit_ids=[unit], max_num=max_num)
+    snippets = extract_snippets(recording=recording, event_frames=event_frames, snippet_len=snippet_len, channel_ids=channels)
+    return snippets[0]
 
 
 def get_channels_in_neighborhood(rx, *, central_channel, max_size):
@@ -315,19 +304,15 @@ def create_spikesprays(*, rx, sx_true, sx_sorted, neighborhood_size, num_spikes,
     avg = np.mean(waveforms0, axis=2)
     peak_chan = np.argmax(np.max(np.abs(avg), axis=1), axis=0)
     nbhd_channels = get_channels_in_neighborhood(rx, central_channel=peak_chan, max_size=7)
-    waveforms1 = _get_random_spike_waveforms(recording=rx, sorting=sx_true, unit=unit_id_true, channels=nbhd_channels)
-    if unit_id_sorted in sx_sorted.get_unit_ids():
-        waveforms2 = _get_random_spike_waveforms(recording=rx, sorting=sx_sorted, unit=unit_id_sorted, channels=nbhd_channels)
-    else:
-        waveforms2 = np.zeros((waveforms1.shape[0], waveforms1.shape[1], 0))
-    if unit_id_true in sx_unmatched_true.get_unit_ids():
-        waveforms3 = _get_random_spike_waveforms(recording=rx, sorting=sx_unmatched_true, unit=unit_id_true, channels=nbhd_channels)
-    else:
-        waveforms3 = np.zeros((waveforms1.shape[0], waveforms1.shape[1], 0))
-    if unit_id_sorted in sx_unmatched_sorted.get_unit_ids():
-        waveforms4 = _get_random_spike_waveforms(recording=rx, sorting=sx_unmatched_sorted, unit=unit_id_sorted, channels=nbhd_channels)
-    else:
-        waveforms4 = np.zeros((waveforms1.shape[0], waveforms1.shape[1], 0))
+    # extract the waveforms of the four spike sprays at once (units that do not exist get no events)
+    event_frames = []
+    for sx0, unit_id0 in [(sx_true, unit_id_true), (sx_sorted, unit_id_sorted), (sx_unmatched_true, unit_id_true), (sx_unmatched_sorted, unit_id_sorted)]:
+        if unit_id0 in sx0.get_unit_ids():
+            event_frames.extend(choose_random_events(sorting=sx0, unit_ids=[unit_id0], max_num=50))
+        else:
+            event_frames.append(np.zeros((0,), dtype=int))
+    snippets = extract_snippets(recording=rx, event_frames=event_frames, snippet_len=100, channel_ids=nbhd_channels)
+    waveforms1, waveforms2, waveforms3, waveforms4 = [snippets[i, :, :, :len(frames)] for i, frames in enumerate(event_frames)]
 
     ret = []
     ret.append(create_spikespray_object(waveforms1, 'true', nbhd_channels))